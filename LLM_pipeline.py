@@ -1,17 +1,33 @@
 import re
-from typing import List
+import time
+from typing import Iterator, List
 
 from haystack import Document, Pipeline
-from haystack.document_stores.in_memory import InMemoryDocumentStore
-from haystack.components.embedders import SentenceTransformersDocumentEmbedder, SentenceTransformersTextEmbedder
-from haystack.components.retrievers.in_memory import InMemoryBM25Retriever, InMemoryEmbeddingRetriever
-from haystack.components.joiners import DocumentJoiner
-from haystack.components.rankers import TransformersSimilarityRanker
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
 from haystack.components.readers import ExtractiveReader
 from haystack.components.builders import PromptBuilder
+from haystack.components.retrievers.in_memory import InMemoryBM25Retriever
+from haystack.document_stores.types import DuplicatePolicy
 
 from src.groq_model import GroqGenerator
-from src.helper import load_json, get_api_token, print_pretty_results, output_pipeline_as_yaml, load_pipeline_from_yaml
+from src.response_cache import ResponseCache
+from src.embedding_cache import EmbeddingCache
+from src.parallel_embedding import ParallelDocumentEmbedder
+from src.store_snapshot import save_document_store, load_document_store
+from src.batch_helper import DocumentMatrix, embed_queries, batch_embedding_retrieval, batch_rank, batch_read
+from src.inference_scheduler import InferenceScheduler
+from src.chunking import documents_per_song, answers_per_song
+from src.corpus_stream import iter_songs, batched
+from src.song_index import song_documents, add_to_song_index, song_index_from_store, diff_songs, stored_contents
+from src.hybrid_fusion import FusionJoiner, HeadRanker, rank_fused
+from src.tracing import Tracer, maybe_span, traced
+from src.inference_backend import BACKENDS, apply_to_text_embedder, apply_to_reader, apply_to_ranker, overlap_at_k, current_rss_mb
+from src.ann_index import ANNEmbeddingRetriever, FlatIndex, recall_at_k
+from src.bm25_index import IndexedBM25Retriever
+from src.versioned_store import VersionedInMemoryDocumentStore
+from src.compact_store import CompactDocumentStore
+from src.query_cache import CachedTextEmbedder, CachedEmbeddingRetriever, CachedBM25Retriever
+from src.helper import get_api_token, print_pretty_results, output_pipeline_as_yaml, load_pipeline_from_yaml
 
 
 # TODO: 
@@ -22,41 +38,253 @@ from src.helper import load_json, get_api_token, print_pretty_results, output_pi
 '''
 
 class NLP_pipeline():
-    def __init__(self) -> None:
+    def __init__(self, ann_index:str = None, ann_parameters:dict = None, query_cache_size:int = 1024,
+                 split_length:int = None, split_overlap:int = 1, compact_store:bool = False, embedding_dtype:str = "float32",
+                 bm25_index:bool = False) -> None:
         # Initialize the Document Store and its embedding
-        self.document_store = InMemoryDocumentStore()
-
-    def load_data(self, json_path:str):
-        # Load JSON data
-        self.data = load_json(json_path)
-        # replace all newline characters with a space (still needed?)
-        for song_name, lyrics in self.data.items():
-            self.data[song_name] = lyrics.replace('\n', ' ')
+        # the store counts its writes, so query caches and indexes know when the corpus changed
+        # a compact store keeps contents in one buffer and embeddings in one float32/float16 matrix, for millions of passages
+        self.compact_store = compact_store
+        self.embedding_dtype = embedding_dtype
+        self.document_store = CompactDocumentStore(embedding_dtype=embedding_dtype) if compact_store else VersionedInMemoryDocumentStore()
+        # approximate nearest neighbour index for embedding retrieval ("ivf", "hnsw" or "flat"), None scans all documents
+        self.ann_index = ann_index
+        self.ann_parameters = ann_parameters
+        # LRU caches of query embeddings and retrieval results, 0 disables them
+        self.query_cache_size = query_cache_size
+        # BM25 scores from an inverted index instead of scoring every document per query, same ranking
+        self.bm25_index = bm25_index
+        # songs are split into passages of split_length sentences overlapping by split_overlap, None keeps whole songs
+        # the reader and ranker then only see the matching passages, results are aggregated back to one per song
+        self.split_length = split_length
+        self.split_overlap = split_overlap
+        # fusion, per-retriever top_k and re-ranking of the hybrid pipeline, see configure_hybrid
+        self.hybrid_config = {}
+        # per-component spans of the pipelines, see enable_tracing
+        self.tracer = None
+        # {title: {"hash", "ids"}} of the indexed songs, for incremental updates (see src/song_index.py)
+        self.song_index = {}
+        self.data = None
+        self.data_path = None
+        self.doc_embedder = None
+        self.embedding_cache = None
+
+    def load_data(self, json_path:str, stream:bool = False):
+        # a .jsonl corpus (see preprocess.py) or a flat {title: lyrics} .json
+        # with stream=True nothing is loaded here, create_embeddings_with_retriever reads the songs batch by batch
+        self.data_path = json_path
+        self.data = None if stream else self._read_songs(json_path)
+
+    def _read_songs(self, json_path:str) -> dict:
+        return dict(self._iter_songs(json_path))
+
+    def _iter_songs(self, json_path:str) -> Iterator:
+        for song_name, lyrics in iter_songs(json_path):
+            # replace all newline characters with a space (still needed?)
+            lyrics = lyrics.replace('\n', ' ')
             # remove everything that is in [] brackets and the brackets themselves
-            self.data[song_name] = re.sub(r'\[.*?\]', '', self.data[song_name])
-
-    def create_embeddings_with_retriever(self):
-        # Create documents with correct format 
-        documents = [Document(content=lyrics, meta={"title": title}) for title, lyrics in self.data.items()]
-
-        # Prepare indexing pipeline
-        doc_embedder = SentenceTransformersDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2")
-        doc_embedder.warm_up()
-
-        # Apply embeddings
-        docs_with_embeddings = doc_embedder.run(documents)
-        self.document_store.write_documents(docs_with_embeddings["documents"])
-
-        self.bm25_retriever = InMemoryBM25Retriever(self.document_store)
-        self.embedding_retriever = InMemoryEmbeddingRetriever(self.document_store)
+            yield song_name, re.sub(r'\[.*?\]', '', lyrics)
+
+    def create_embeddings_with_retriever(self, cache_dir:str = "cache/embeddings", evict_stale_models:bool = True,
+                                         index_batch_size:int = 10000, embedding_workers:int = 1, threads_per_worker:int = None):
+        # Prepare indexing pipeline, the embedder stays for incremental updates
+        if embedding_workers > 1:
+            # every batch is sharded over a pool of processes, each with its own model replica and threads_per_worker torch threads
+            self.doc_embedder = ParallelDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2", n_workers=embedding_workers,
+                                                         threads_per_worker=threads_per_worker)
+        else:
+            self.doc_embedder = SentenceTransformersDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2")
+        self.embedding_cache = EmbeddingCache(cache_dir, self.doc_embedder.model) if cache_dir else None
+        if self.embedding_cache is not None:
+            # caches of other models are kept for 30 days after their last use, switching back does not re-embed everything
+            self.embedding_cache.evict_stale_models() if evict_stale_models else None
+
+        # songs are embedded and written index_batch_size at a time, so Documents with their embeddings as lists of
+        # floats only exist for one batch; streamed from the json with load_data(stream=True), the songs themselves too
+        if self.data is None and self.data_path is None:
+            raise ValueError("No songs to index, call load_data first")
+        songs = self._iter_songs(self.data_path) if self.data is None else self.data.items()
+        n_songs, n_documents = 0, 0
+        try:
+            for batch in batched(songs, max(index_batch_size, 1)):
+                # Create documents with correct format, title and lyrics hash in the meta keep the ids stable
+                documents = song_documents(dict(batch), split_length=self.split_length, split_overlap=self.split_overlap)
+                n_songs += len(batch)
+                n_documents += len(documents)
+                self.document_store.write_documents(self._embed_documents(documents))
+                add_to_song_index(self.song_index, documents)
+        finally:
+            if isinstance(self.doc_embedder, ParallelDocumentEmbedder):
+                # the workers hold a model replica each, incremental updates embed few songs and load one model when needed
+                self.doc_embedder.close()
+                self.doc_embedder = None
+        if self.split_length:
+            print(f"Split {n_songs} songs into {n_documents} passages")
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
+            print(f"Embedding cache: {self.embedding_cache.stats()}")
+        if self.compact_store:
+            # the store holds the only copy of the corpus now
+            self.data = None
+            print(f"Compact document store: {self.document_store.memory_usage()}")
+
+        self.create_retrievers()
+
+    def _embed_documents(self, documents:List[Document]) -> List[Document]:
+        # Apply embeddings, with a cache only new or changed songs are embedded, the caller flushes the cache
+        if self.doc_embedder is None:
+            # e.g. updates after load_snapshot, the model is only loaded once there is something to embed
+            self.doc_embedder = SentenceTransformersDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2")
+        if self.embedding_cache is not None:
+            return self.embedding_cache.embed_documents(documents, self.doc_embedder, flush=False)
+        self.doc_embedder.warm_up()
+        return self.doc_embedder.run(documents)["documents"]
+
+    # --- incremental updates: only added or changed songs are embedded, BM25 statistics and indexes follow the change ---
+    def upsert_songs(self, songs:dict, prune_cache:bool = True) -> dict:
+        # songs: {title: lyrics} cleaned like in load_data, songs with the same lyrics as indexed are skipped
+        # needs create_embeddings_with_retriever or load_snapshot first
+        added, changed, unchanged, _ = diff_songs(self.song_index, songs)
+        version = self.document_store.version
+        documents = song_documents({title: songs[title] for title in added + changed},
+                                   split_length=self.split_length, split_overlap=self.split_overlap)
+        documents = self._embed_documents(documents) if documents else []
+        removed_ids = [doc_id for title in changed for doc_id in self.song_index.pop(title)["ids"]]
+
+        # the store updates its BM25 statistics per written or deleted document
+        self.document_store.delete_documents(removed_ids)
+        self.document_store.write_documents(documents, policy=DuplicatePolicy.OVERWRITE)
+        add_to_song_index(self.song_index, documents)
+        self.embedding_cache.flush() if self.embedding_cache is not None else None
+        self._update_indexes([doc.id for doc in documents], removed_ids, version)
+        if self.data is not None:
+            self.data.update({title: songs[title] for title in added + changed})
+        if prune_cache and changed:
+            self._prune_embedding_cache()
+        return {"added": len(added), "changed": len(changed), "unchanged": len(unchanged), "written_documents": len(documents)}
+
+    def delete_songs(self, titles:List, prune_cache:bool = True) -> int:
+        # returns the number of deleted documents (songs or passages)
+        version = self.document_store.version
+        removed_ids = [doc_id for title in titles if title in self.song_index for doc_id in self.song_index.pop(title)["ids"]]
+        self.document_store.delete_documents(removed_ids)
+        self._update_indexes([], removed_ids, version)
+        for title in titles:
+            self.data.pop(title, None) if self.data is not None else None
+        if prune_cache and removed_ids:
+            self._prune_embedding_cache()
+        return len(removed_ids)
+
+    def _prune_embedding_cache(self):
+        # vectors of deleted songs and of old lyrics of changed songs leave the cache, only the indexed contents stay
+        if self.embedding_cache is not None:
+            self.embedding_cache.prune(stored_contents(self.document_store))
+
+    def update_from_json(self, json_path:str, delete_missing:bool = True, batch_size:int = 10000) -> dict:
+        # diff a new preprocessed json against the index: new and changed songs are embedded and written,
+        # songs that are no longer in the json are deleted (unless delete_missing is False)
+        # the json is streamed batch_size songs at a time, only the titles of all songs are kept for the deletions
+        report = {"added": 0, "changed": 0, "unchanged": 0, "written_documents": 0}
+        titles = set()
+        for batch in batched(self._iter_songs(json_path), max(batch_size, 1)):
+            songs = dict(batch)
+            titles.update(songs)
+            for key, value in self.upsert_songs(songs, prune_cache=False).items():
+                report[key] += value
+        removed = [title for title in self.song_index if title not in titles]
+        report["removed"] = len(removed) if delete_missing else 0
+        report["deleted_documents"] = self.delete_songs(removed, prune_cache=False) if delete_missing else 0
+        # the cache is pruned once for the whole update instead of per batch
+        if report["changed"] or report["deleted_documents"]:
+            self._prune_embedding_cache()
+        print(f"Index update from {json_path}: {report}")
+        return report
+
+    def _update_indexes(self, added_ids:List, removed_ids:List, since_version:int):
+        # the embedding matrix, the BM25 index and the ANN index get the changed ids instead of a rebuild
+        if hasattr(self, "document_matrix"):
+            self.document_matrix.update(added_ids, removed_ids, since_version=since_version)
+        if self.bm25_index and hasattr(self, "bm25_retriever"):
+            self.bm25_retriever.update(added_ids, removed_ids, since_version=since_version)
+        if self.ann_index and hasattr(self, "embedding_retriever"):
+            self.embedding_retriever.update(added_ids, removed_ids, since_version=since_version)
+
+    def create_retrievers(self):
+        if self.bm25_index:
+            self.bm25_retriever = IndexedBM25Retriever(self.document_store, cache_size=self.query_cache_size)
+            self.bm25_retriever.sync()
+        else:
+            self.bm25_retriever = CachedBM25Retriever(self.document_store, cache_size=self.query_cache_size)
+        if self.ann_index:
+            self.embedding_retriever = ANNEmbeddingRetriever(self.document_store, index_type=self.ann_index, index_parameters=self.ann_parameters,
+                                                             cache_size=self.query_cache_size)
+            self.embedding_retriever.sync()
+        else:
+            self.embedding_retriever = CachedEmbeddingRetriever(self.document_store, cache_size=self.query_cache_size)
+        # all document embeddings as one matrix for batched retrieval
+        self.document_matrix = DocumentMatrix(self.document_store)
 
         # for hybrid retrieval
-        self.document_joiner = DocumentJoiner()
-        self.ranker = TransformersSimilarityRanker(model="BAAI/bge-reranker-base")
+        self.document_joiner = FusionJoiner()
+        self.ranker = HeadRanker(model="BAAI/bge-reranker-base")
+        self.configure_hybrid(**self.hybrid_config)
+
+    def configure_hybrid(self, join_mode:str = "reciprocal_rank_fusion", weights:List = None, bm25_top_k:int = 10,
+                         embedding_top_k:int = 10, head_size:int = None, skip_agreement:float = None, agreement_top_n:int = 3):
+        # join_mode: "reciprocal_rank_fusion", "weighted_score" (min-max normalized, weights for [bm25, embedding]) or "concatenate"
+        # the cross-encoder only re-ranks the first head_size fused documents (None: all of them) and is skipped
+        # when at least skip_agreement of the top agreement_top_n documents of both retrievers are the same
+        self.hybrid_config = {"join_mode": join_mode, "weights": weights, "bm25_top_k": bm25_top_k, "embedding_top_k": embedding_top_k,
+                              "head_size": head_size, "skip_agreement": skip_agreement, "agreement_top_n": agreement_top_n}
+        self.document_joiner.join_mode = join_mode
+        self.document_joiner.weights = [float(w) / sum(weights) for w in weights] if weights else None
+        self.document_joiner.agreement_top_n = agreement_top_n
+        self.ranker.head_size = head_size
+        self.ranker.skip_agreement = skip_agreement
+
+    def save_snapshot(self, snapshot_path:str = "snapshots/document_store"):
+        # store documents, embeddings and BM25 statistics, so other processes can skip the indexing
+        save_document_store(self.document_store, snapshot_path)
+        print(f"Document store with {self.document_store.count_documents()} documents saved to {snapshot_path}")
+
+    def load_snapshot(self, snapshot_path:str = "snapshots/document_store"):
+        # the restored store is always a CompactDocumentStore, its embedding matrix is a memory map of the snapshot
+        self.document_store = load_document_store(snapshot_path, embedding_dtype=self.embedding_dtype)
+        self.song_index = song_index_from_store(self.document_store)
+        self.create_retrievers()
+        print(f"Document store with {self.document_store.count_documents()} documents loaded from {snapshot_path}")
+
+    def report_ann_recall(self, query:List, k:int = 10) -> float:
+        # compare the ANN index against an exact scan, to tune e.g. n_probe or ef_search
+        exact_index = FlatIndex(self.document_store.embedding_similarity_function)
+        ids, matrix = self.document_matrix.get()
+        exact_index.build(ids, matrix)
+        query_embeddings = embed_queries(self.text_embedder, query)
+        self.embedding_retriever.sync()
+        recall = recall_at_k(self.embedding_retriever.index, exact_index, query_embeddings, k=k)
+        print(f"Recall@{k} of the {self.ann_index} index: {recall:.3f}")
+        return recall
+
+    def report_bm25_parity(self, query:List, top_k:int = 10) -> dict:
+        # compare the BM25 index against InMemoryBM25Retriever: same ids in the same order and the latency of both
+        reference_retriever = InMemoryBM25Retriever(self.document_store, top_k=top_k)
+        self.bm25_retriever.cache.clear()
+        start = time.perf_counter()
+        reference = [reference_retriever.run(query=q)["documents"] for q in query]
+        reference_latency = (time.perf_counter() - start) / len(query)
+        start = time.perf_counter()
+        indexed = [self.bm25_retriever.run(query=q, top_k=top_k)["documents"] for q in query]
+        latency = (time.perf_counter() - start) / len(query)
+        same_ranking = sum([doc.id for doc in r] == [doc.id for doc in i] for r, i in zip(reference, indexed))
+        max_score_difference = max((abs(a.score - b.score) for r, i in zip(reference, indexed) for a, b in zip(r, i)), default=0.0)
+        report = {"queries": len(query), "same_ranking": same_ranking / len(query), "max_score_difference": max_score_difference,
+                  "latency_ms": 1000 * latency, "reference_latency_ms": 1000 * reference_latency}
+        print(f"BM25 parity@{top_k}: {report}")
+        return report
 
     def create_text_embedder(self):
         # prompt/query embedding
-        self.text_embedder = SentenceTransformersTextEmbedder(model="sentence-transformers/all-MiniLM-L6-v2")
+        self.text_embedder = CachedTextEmbedder(model="sentence-transformers/all-MiniLM-L6-v2", cache_size=self.query_cache_size)
 
     def create_prompt_builder(self):
         # Create a custom prompt with prompt builder
@@ -69,8 +297,22 @@ class NLP_pipeline():
 
         self.prompt_builder = PromptBuilder(template=template)
     
-    def create_llm_generator(self):
-        self.llm_generator = GroqGenerator(get_api_token("auth_tokens/groq.json"))
+    def create_llm_generator(self, api_base_url:str = None, max_concurrency:int = 8,
+                             requests_per_minute:float = None, tokens_per_minute:float = None,
+                             generation_kwargs:dict = None, cache_path:str = None):
+        # api_base_url can point to a local stub server (see start_groq_stub in src/local_stubs.py)
+        # concurrency limit and per minute budgets apply to the batch mode of run_rag_pipeline
+        # with a cache_path replies are cached, near-identical prompts are matched with the query embedder
+        # only deterministic requests are cached, e.g. generation_kwargs={"temperature": 0}
+        api_key = get_api_token("auth_tokens/groq.json") if api_base_url is None else "stub"
+        if getattr(self, "llm_generator", None) is not None:
+            # stops the event loop and connection pool of the previous generator
+            self.llm_generator.close()
+        self.response_cache = ResponseCache(cache_path, embedder=getattr(self, "text_embedder", None)) if cache_path else None
+        self.llm_generator = GroqGenerator(api_key, api_base_url=api_base_url, max_concurrency=max_concurrency,
+                                           requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                                           generation_kwargs=generation_kwargs, response_cache=self.response_cache)
+        self.llm_generator.tracer = self.tracer
 
     def create_hybrid_extractive_pipeline(self, plot_pipeline:bool = False, output_pipeline:bool = True):
         # Create pipeline components
@@ -84,12 +326,14 @@ class NLP_pipeline():
 
         # Connect components
         self.hybrid_extractive_qa_pipeline.connect("text_embedder", "embedding_retriever")
-        self.hybrid_extractive_qa_pipeline.connect("bm25_retriever", "document_joiner")
-        self.hybrid_extractive_qa_pipeline.connect("embedding_retriever", "document_joiner")
-        self.hybrid_extractive_qa_pipeline.connect("document_joiner", "ranker")
+        self.hybrid_extractive_qa_pipeline.connect("bm25_retriever.documents", "document_joiner.bm25_documents")
+        self.hybrid_extractive_qa_pipeline.connect("embedding_retriever.documents", "document_joiner.embedding_documents")
+        self.hybrid_extractive_qa_pipeline.connect("document_joiner.documents", "ranker.documents")
+        self.hybrid_extractive_qa_pipeline.connect("document_joiner.agreement", "ranker.agreement")
 
         output_pipeline_as_yaml(self.hybrid_extractive_qa_pipeline, "pipelines/hybrid_qa_pipeline.yaml") if output_pipeline else None
         self.hybrid_extractive_qa_pipeline.draw("hybrid_extractive_qa_pipeline.png") if plot_pipeline else None
+        self.tracer.trace_pipeline(self.hybrid_extractive_qa_pipeline, "hybrid_extractive_qa_pipeline") if self.tracer else None
 
 
     def create_extractive_pipeline(self, plot_pipeline:bool = False, output_pipeline:bool = True):
@@ -110,6 +354,7 @@ class NLP_pipeline():
 
         output_pipeline_as_yaml(self.extractive_qa_pipeline, "pipelines/extractive_qa_pipeline.yaml") if output_pipeline else None
         self.extractive_qa_pipeline.draw("extractive_qa_pipeline.png") if plot_pipeline else None
+        self.tracer.trace_pipeline(self.extractive_qa_pipeline, "extractive_qa_pipeline") if self.tracer else None
 
     def create_rag_pipeline(self, plot_pipeline:bool = False, output_pipeline:bool = True):
         # Create pipeline components
@@ -128,67 +373,360 @@ class NLP_pipeline():
 
         output_pipeline_as_yaml(self.rag_pipeline, "pipelines/rag_pipeline.yaml") if output_pipeline else None
         self.rag_pipeline.draw("rag_pipeline.png") if plot_pipeline else None
+        self.tracer.trace_pipeline(self.rag_pipeline, "rag_pipeline") if self.tracer else None
 
-    def load_pipeline(self, pipeline_path:str):
-        # CANT LOAD DOCUMENT STORE FROM PIPELINE 
+    def load_pipeline(self, pipeline_path:str, snapshot_path:str = None):
+        # the yaml only contains the component graph, the documents come from the snapshot
         self.extractive_qa_pipeline = load_pipeline_from_yaml(pipeline_path)
+        self.tracer.trace_pipeline(self.extractive_qa_pipeline, "extractive_qa_pipeline") if self.tracer else None
+        if snapshot_path:
+            self.load_snapshot(snapshot_path)
+            # retrievers from the yaml point to a new empty store, let them use the restored one
+            for _, instance in self.extractive_qa_pipeline.walk():
+                if hasattr(instance, "document_store"):
+                    instance.document_store = self.document_store
         print(f"Pipeline loaded from {pipeline_path}")
 
-    def run_extractive_pipeline(self, query:List):
-        responses = []
-        for q in query:
-            response = self.extractive_qa_pipeline.run(
-                data={"text_embedder": {"text": q},
-                                        "reader": {"query": q, "top_k": 3}})
-
-            responses.append(response)
+    # --- passages: the reader and ranker return all passages, they are cut to top_k after aggregating per song ---
+    def _passage_top_k(self, top_k:int):
+        # with passages the default top_k of the component applies (ranker 10, reader 20), so enough songs remain
+        # after aggregating; the scores are computed for every candidate anyway
+        return None if self.split_length else top_k
+
+    def _per_song(self, response:dict, top_k:int) -> dict:
+        if not self.split_length:
+            return response
+        if "reader" in response:
+            response["reader"]["answers"] = answers_per_song(response["reader"]["answers"], top_k)
+        if "ranker" in response:
+            response["ranker"]["documents"] = documents_per_song(response["ranker"]["documents"], top_k)
+        return response
+
+    # --- tracing: wall/CPU time, peak RSS, batch size and token usage of every component, also in batch and scheduled mode ---
+    def enable_tracing(self, trace_path:str = "traces/spans.jsonl", export_format:str = "jsonl"):
+        # traces the pipelines created so far and all later ones, export_format "jsonl" or "otel" (OTLP/JSON)
+        self.tracer = Tracer()
+        self.trace_path = trace_path
+        self.trace_format = export_format
+        for name in ("extractive_qa_pipeline", "hybrid_extractive_qa_pipeline", "rag_pipeline"):
+            self.tracer.trace_pipeline(getattr(self, name), name) if hasattr(self, name) else None
+        # run_batch and run_async of the generator open their own spans
+        if getattr(self, "llm_generator", None) is not None:
+            self.llm_generator.tracer = self.tracer
+
+    def report_traces(self):
+        # p50/p95 per stage of the spans since the last report, then they are appended to trace_path
+        if self.tracer is None or not self.tracer.spans:
+            return
+        self.tracer.print_summary()
+        exported = self.tracer.export(self.trace_path, self.trace_format)
+        print(f"{exported} spans written to {self.trace_path}")
+
+    def run_extractive_pipeline(self, query:List, batch:bool = False):
+        if batch:
+            responses = self.run_extractive_batch(query)
+        else:
+            responses = []
+            for q in query:
+                response = self.extractive_qa_pipeline.run(
+                    data={"text_embedder": {"text": q},
+                                            "reader": {"query": q, "top_k": self._passage_top_k(3)}})
+
+                responses.append(self._per_song(response, 3))
 
         print(responses)
+        self.report_traces()
+        return responses
 
 
-    def run_hybrid_extractive_pipeline(self, query:List):
-        responses = []
-        for q in query:
-            response = self.hybrid_extractive_qa_pipeline.run(
-                                        {"text_embedder": {"text": q}, "bm25_retriever": {"query": q}, "ranker": {"query": q, "top_k": 3}})
-            
-            responses.append(response)
+    def run_hybrid_extractive_pipeline(self, query:List, batch:bool = False):
+        if batch:
+            responses = self.run_hybrid_extractive_batch(query)
+        else:
+            responses = []
+            for q in query:
+                response = self.hybrid_extractive_qa_pipeline.run(
+                                            {"text_embedder": {"text": q},
+                                             "bm25_retriever": {"query": q, "top_k": self.hybrid_config["bm25_top_k"]},
+                                             "embedding_retriever": {"top_k": self.hybrid_config["embedding_top_k"]},
+                                             "ranker": {"query": q, "top_k": self._passage_top_k(3)}})
+
+                responses.append(self._per_song(response, 3))
 
         print(responses)
+        self.report_traces()
+        return responses
+
+    def run_rag_pipeline(self, query:List, batch:bool = False, stream:bool = False):
+        if stream:
+            return self.run_rag_stream(query)
+        if batch:
+            responses = self.run_rag_batch(query)
+        else:
+            responses = []
+            for q in query:
+                response = self.rag_pipeline.run({"text_embedder": {"text": q}, 
+                                                "embedding_retriever": {"top_k": 3},
+                                                "prompt_builder": {"question": q}})
+                responses.append(response)
 
-    def run_rag_pipeline(self, query:List):
+        print_pretty_results(query, responses)
+        self.report_traces()
+        return responses
+
+    # --- streaming mode: tokens are printed as they arrive, the time to first token is the visible latency ---
+    def stream_rag(self, q:str, top_k:int = 3, stats:dict = None) -> Iterator[str]:
+        # same steps as the rag pipeline, but the reply comes as an iterator of tokens
+        # stats receives ttft (including retrieval), generator_ttft, retrieval_time, total_time, tokens and tokens_per_sec
+        stats = stats if stats is not None else {}
+        start = time.perf_counter()
+        query_embedding = self.text_embedder.run(text=q)["embedding"]
+        documents = self.embedding_retriever.run(query_embedding=query_embedding, top_k=top_k)["documents"]
+        prompt = self.prompt_builder.run(question=q, documents=documents)["prompt"]
+        stats["retrieval_time"] = time.perf_counter() - start
+
+        generator_stats = {}
+        ttft = None
+        for token in self.llm_generator.stream(prompt, stats=generator_stats):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            yield token
+        stats.update(generator_stats)
+        stats.update({"generator_ttft": generator_stats["ttft"], "ttft": ttft, "total_time": time.perf_counter() - start})
+
+    def run_rag_stream(self, query:List, top_k:int = 3):
         responses = []
         for q in query:
-            response = self.rag_pipeline.run({"text_embedder": {"text": q}, 
-                                            "embedding_retriever": {"top_k": 3},
-                                            "prompt_builder": {"question": q}})
-            responses.append(response)
-
-        print_pretty_results(query, responses)
-
-
-query = [
-    "21 guns",
-    "american idiot",
-]
-NLP_pipeline = NLP_pipeline()
-# --- data loading and embedding creation ---
-NLP_pipeline.load_data("output/greenday_lyrics_preprocessed.json")
-NLP_pipeline.create_embeddings_with_retriever()
-NLP_pipeline.create_text_embedder()
-
-# --- qa pipeline ---
-NLP_pipeline.create_extractive_pipeline()
-NLP_pipeline.run_extractive_pipeline(query)
-
-# --- hybrid qa pipeline ---
-# NLP_pipeline.create_hybrid_extractive_pipeline()
-# NLP_pipeline.run_hybrid_extractive_pipeline(query)
-
-# --- RAG pipeline ---
-# create prompt list that contains song with the following text around it "create song lyrics similar to [song]"
-# NLP_pipeline.create_prompt_builder()
-# NLP_pipeline.create_llm_generator()
-# NLP_pipeline.create_rag_pipeline()
-# NLP_pipeline.run_rag_pipeline(query)
-
+            stats = {}
+            print("Question:", q)
+            print("Answer:", end=" ", flush=True)
+            tokens = []
+            for token in self.stream_rag(q, top_k=top_k, stats=stats):
+                print(token, end="", flush=True)
+                tokens.append(token)
+            ttft = f"{stats['ttft']:.3f}s" if stats["ttft"] is not None else "-"
+            print(f"\n[ttft {ttft}, {stats['tokens']} tokens, {stats['tokens_per_sec']:.1f} tokens/sec]\n")
+            responses.append({"generator": {"replies": ["".join(tokens)], "meta": [stats]}})
+        return responses
+
+    # --- CPU inference backends: "fp32", "int8" (dynamic quantization) or "onnx" (onnxruntime) ---
+    def _probe_models(self, query:List, k:int, candidates:List = None) -> dict:
+        # top-k of every model, the ranker and reader get the same candidates for both backends,
+        # so a difference comes from the model and not from the retrieval before it
+        start = time.perf_counter()
+        query_embeddings = embed_queries(self.text_embedder, query)
+        documents = batch_embedding_retrieval(self.document_matrix, query_embeddings, top_k=k)
+        results = {"embedder": [[doc.id for doc in docs] for docs in documents], "candidates": documents}
+        candidates = candidates or documents
+        if getattr(self, "ranker", None) is not None:
+            ranked = batch_rank(self.ranker, query, candidates, top_k=k)
+            results["ranker"] = [[doc.id for doc in docs] for docs in ranked]
+        if getattr(self, "reader", None) is not None:
+            answers = batch_read(self.reader, query, candidates, top_k=k)
+            results["reader"] = [[answer.data for answer in a if answer.data is not None] for a in answers]
+        results["latency"] = (time.perf_counter() - start) / len(query)
+        return results
+
+    def set_inference_backend(self, backend:str = "int8", cache_dir:str = "cache/models", check_queries:List = None,
+                              k:int = 5, min_agreement:float = 0.9):
+        # switches the query embedder, reader and ranker (whichever exist) from fp32 to the backend,
+        # ONNX exports are cached in cache_dir. With check_queries the top-k of every model is compared against fp32.
+        if getattr(self, "inference_backend", "fp32") != "fp32":
+            raise ValueError(f"The models already run with {self.inference_backend}, create a new pipeline to switch again")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend '{backend}', choose one of {BACKENDS}")
+        if check_queries:
+            reference = self._probe_models(check_queries, k)
+            rss_before = current_rss_mb()
+
+        apply_to_text_embedder(self.text_embedder, backend, cache_dir)
+        # cached query embeddings were computed by the fp32 model
+        self.text_embedder.cache.clear()
+        if getattr(self, "ranker", None) is not None:
+            apply_to_ranker(self.ranker, backend, cache_dir)
+        if getattr(self, "reader", None) is not None:
+            apply_to_reader(self.reader, backend, cache_dir)
+        self.inference_backend = backend
+
+        if not check_queries:
+            return None
+        candidate = self._probe_models(check_queries, k, candidates=reference["candidates"])
+        report = {"backend": backend, "latency_fp32_ms": 1000 * reference["latency"], "latency_ms": 1000 * candidate["latency"],
+                  "rss_change_mb": current_rss_mb() - rss_before}
+        for model in ("embedder", "ranker", "reader"):
+            if model in reference:
+                report[f"{model}_overlap@{k}"] = overlap_at_k(reference[model], candidate[model], k)
+        print(f"Inference backend {backend}: {report}")
+        for model in ("embedder", "ranker", "reader"):
+            if report.get(f"{model}_overlap@{k}", 1.0) < min_agreement:
+                print(f"Warning: the {model} agrees with fp32 on only {report[f'{model}_overlap@{k}']:.2f} of the top-{k} (< {min_agreement})")
+        return report
+
+    # --- batch mode: every model runs once for all queries instead of once per query ---
+    # the run_*_batch and run_*_scheduled methods do not go through a Pipeline, with enable_tracing they get a span
+    # per call and one per stage (embedder, retriever, joiner, ranker, reader), named like the pipeline components
+    def stage(self, name:str, queries:List):
+        return maybe_span(self.tracer, name, {"component": name, "batch_size": len(queries)})
+
+    def embed_batch(self, query:List):
+        with self.stage("embedder", query):
+            return embed_queries(self.text_embedder, query)
+
+    def retrieve_batch(self, query_embeddings, top_k:int = 10):
+        with self.stage("retriever", query_embeddings):
+            if self.ann_index:
+                return self.embedding_retriever.search_batch(query_embeddings, top_k=top_k)
+            return batch_embedding_retrieval(self.document_matrix, query_embeddings, top_k=top_k)
+
+    @traced("run_extractive_batch")
+    def run_extractive_batch(self, query:List, top_k:int = 3):
+        query_embeddings = self.embed_batch(query)
+        documents = self.retrieve_batch(query_embeddings, top_k=self.embedding_retriever.top_k)
+        with self.stage("reader", query):
+            answers = batch_read(self.reader, query, documents, top_k=self._passage_top_k(top_k))
+        return [self._per_song({"reader": {"answers": a}}, top_k) for a in answers]
+
+    def join_hybrid_batch(self, query:List, embedding_documents:List):
+        # fused documents and the agreement of both retrievers per query
+        joined_documents, agreements = [], []
+        with self.stage("joiner", query):
+            for q, documents in zip(query, embedding_documents):
+                bm25_documents = self.bm25_retriever.run(query=q, top_k=self.hybrid_config["bm25_top_k"])["documents"]
+                joined = self.document_joiner.run(bm25_documents=bm25_documents, embedding_documents=documents)
+                joined_documents.append(joined["documents"])
+                agreements.append(joined["agreement"])
+        return joined_documents, agreements
+
+    def rank_hybrid_batch(self, rank, query:List, joined_documents:List, agreements:List, top_k:int = 3):
+        # rank is the cross-encoder over many queries, batch_rank or the scheduler
+        with self.stage("ranker", query):
+            return rank_fused(rank, query, joined_documents, agreements, top_k=self._passage_top_k(top_k),
+                              head_size=self.ranker.head_size, skip_agreement=self.ranker.skip_agreement, stats=self.ranker.stats)
+
+    @traced("run_hybrid_extractive_batch")
+    def run_hybrid_extractive_batch(self, query:List, top_k:int = 3):
+        query_embeddings = self.embed_batch(query)
+        embedding_documents = self.retrieve_batch(query_embeddings, top_k=self.hybrid_config["embedding_top_k"])
+        joined_documents, agreements = self.join_hybrid_batch(query, embedding_documents)
+        rank = lambda queries, documents, k: batch_rank(self.ranker, queries, documents, top_k=k)
+        ranked_documents = self.rank_hybrid_batch(rank, query, joined_documents, agreements, top_k)
+        return [self._per_song({"ranker": {"documents": d}}, top_k) for d in ranked_documents]
+
+    def report_hybrid_configs(self, query:List, configs:List[dict], top_k:int = 3) -> List[dict]:
+        # latency and recall@top_k of hybrid configurations (keyword arguments of configure_hybrid), to pick the cheapest
+        # one that is good enough. The reference is a cross-encoder pass over all concatenated BM25 and embedding results.
+        current_config = dict(self.hybrid_config)
+        self.configure_hybrid(join_mode="concatenate")
+        reference = [[doc.id for doc in r["ranker"]["documents"]] for r in self.run_hybrid_extractive_batch(query, top_k=top_k)]
+
+        report = []
+        for config in configs:
+            self.configure_hybrid(**config)
+            self.bm25_retriever.cache.clear()
+            self.ranker.stats = {}
+            start = time.perf_counter()
+            responses = self.run_hybrid_extractive_batch(query, top_k=top_k)
+            latency = (time.perf_counter() - start) / len(query)
+            result = [[doc.id for doc in r["ranker"]["documents"]] for r in responses]
+            report.append({**config, "latency_ms": 1000 * latency, f"recall@{top_k}": overlap_at_k(reference, result, top_k),
+                           "ranked_pairs_per_query": self.ranker.stats["ranked_pairs"] / len(query),
+                           "skipped": self.ranker.stats["skipped"] / len(query)})
+            print(report[-1])
+        self.configure_hybrid(**current_config)
+        self.ranker.stats = {}
+        return report
+
+    @traced("run_rag_batch")
+    def run_rag_batch(self, query:List, top_k:int = 3):
+        query_embeddings = self.embed_batch(query)
+        documents = self.retrieve_batch(query_embeddings, top_k=top_k)
+        prompts = [self.prompt_builder.run(question=q, documents=docs)["prompt"] for q, docs in zip(query, documents)]
+        # all prompts are sent concurrently, within the concurrency limit and budgets of the generator
+        return [{"generator": reply} for reply in self.llm_generator.run_batch(prompts)]
+
+    # --- scheduled mode: for many concurrent callers (see server.py), model calls of all callers are micro-batched ---
+    def create_scheduler(self, max_batch_size:int = 16, max_wait_ms:float = 10.0, model_settings:dict = None):
+        # needs the text embedder and, for the matching run_* methods, the reader and the ranker
+        self.scheduler = InferenceScheduler(self, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, model_settings=model_settings)
+
+    # the stage spans here include the wait for the micro-batch, the scheduler adds a span per micro-batch
+    @traced("run_extractive_scheduled")
+    def run_extractive_scheduled(self, query:List, top_k:int = 3):
+        with self.stage("embedder", query):
+            query_embeddings = self.scheduler.embed(query)
+        documents = self.retrieve_batch(query_embeddings, top_k=self.embedding_retriever.top_k)
+        with self.stage("reader", query):
+            answers = self.scheduler.read(query, documents, top_k=self._passage_top_k(top_k))
+        return [self._per_song({"reader": {"answers": a}}, top_k) for a in answers]
+
+    @traced("run_hybrid_extractive_scheduled")
+    def run_hybrid_extractive_scheduled(self, query:List, top_k:int = 3):
+        with self.stage("embedder", query):
+            query_embeddings = self.scheduler.embed(query)
+        embedding_documents = self.retrieve_batch(query_embeddings, top_k=self.hybrid_config["embedding_top_k"])
+        joined_documents, agreements = self.join_hybrid_batch(query, embedding_documents)
+        ranked_documents = self.rank_hybrid_batch(self.scheduler.rank, query, joined_documents, agreements, top_k)
+        return [self._per_song({"ranker": {"documents": d}}, top_k) for d in ranked_documents]
+
+    @traced("run_rag_scheduled")
+    def run_rag_scheduled(self, query:List, top_k:int = 3):
+        with self.stage("embedder", query):
+            query_embeddings = self.scheduler.embed(query)
+        documents = self.retrieve_batch(query_embeddings, top_k=top_k)
+        prompts = [self.prompt_builder.run(question=q, documents=docs)["prompt"] for q, docs in zip(query, documents)]
+        return [{"generator": reply} for reply in self.llm_generator.run_batch(prompts)]
+
+
+# the script part only runs when called directly, server.py imports NLP_pipeline and keeps the models warm
+if __name__ == "__main__":
+    query = [
+        "21 guns",
+        "american idiot",
+    ]
+    pipeline = NLP_pipeline()
+    # BM25 of the hybrid pipeline from an inverted index, pipeline.report_bm25_parity(query) compares it with the haystack retriever
+    # pipeline = NLP_pipeline(bm25_index=True)
+    # passages of 4 verse lines overlapping by one instead of whole songs, results are aggregated per song
+    # pipeline = NLP_pipeline(split_length=4, split_overlap=1)
+    # contents, meta and embeddings in compact buffers (float16 halves the embeddings), for corpora of millions of passages
+    # pipeline = NLP_pipeline(split_length=4, compact_store=True, embedding_dtype="float16")
+    # --- data loading and embedding creation ---
+    pipeline.load_data("output/greenday_lyrics_preprocessed.jsonl")
+    # streams the songs from the file into the document store index_batch_size at a time, for corpora that do not fit in memory
+    # pipeline.load_data("output/greenday_lyrics_preprocessed.jsonl", stream=True)
+    pipeline.create_embeddings_with_retriever()
+    # embeds the corpus in 4 processes with one model replica each, for the initial indexing of large corpora
+    # pipeline.create_embeddings_with_retriever(embedding_workers=4)
+    pipeline.create_text_embedder()
+
+    # --- incremental update: only new or changed songs of the json are embedded, missing songs are deleted ---
+    # pipeline.update_from_json("output/greenday_lyrics_preprocessed.jsonl")
+
+    # --- snapshot of the document store, load_pipeline can then skip data loading and embedding ---
+    # pipeline.save_snapshot("snapshots/document_store")
+    # pipeline.load_pipeline("pipelines/extractive_qa_pipeline.yaml", snapshot_path="snapshots/document_store")
+
+    # per-component timings of the pipelines below, spans are written as JSONL ("otel" for OTLP/JSON)
+    # pipeline.enable_tracing("traces/spans.jsonl")
+
+    # --- qa pipeline ---
+    pipeline.create_extractive_pipeline()
+    pipeline.run_extractive_pipeline(query)
+
+    # --- hybrid qa pipeline ---
+    # re-rank only the 5 best fused documents and skip the cross-encoder when both retrievers agree on their top 3
+    # pipeline.configure_hybrid(join_mode="reciprocal_rank_fusion", head_size=5, skip_agreement=1.0)
+    # pipeline.report_hybrid_configs(query, [{}, {"head_size": 5}, {"head_size": 5, "skip_agreement": 1.0}])
+    # pipeline.create_hybrid_extractive_pipeline()
+    # pipeline.run_hybrid_extractive_pipeline(query)
+
+    # --- RAG pipeline ---
+    # create prompt list that contains song with the following text around it "create song lyrics similar to [song]"
+    # pipeline.create_prompt_builder()
+    # pipeline.create_llm_generator()
+    # cache deterministic replies, repeated and near-identical prompts skip the LLM call
+    # pipeline.create_llm_generator(generation_kwargs={"temperature": 0}, cache_path="cache/responses.sqlite")
+    # pipeline.create_rag_pipeline()
+    # pipeline.run_rag_pipeline(query)
+    # stream the replies token by token and report time to first token and tokens/sec per query
+    # pipeline.run_rag_pipeline(query, stream=True)
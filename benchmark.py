@@ -0,0 +1,147 @@
+import gc
+import sys
+import json
+import argparse
+
+from haystack import Document
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+
+from LLM_pipeline import NLP_pipeline
+from src.parallel_embedding import ParallelDocumentEmbedder
+from src.preprocess_helper import clean_up_lyrics_batch, remove_duplicate_songs
+from src.local_stubs import start_groq_stub
+from src.benchmark_helper import (make_synthetic_corpus, make_raw_lyrics, make_queries, timed, best_time, latency_metrics, metric,
+                                  memory_metrics, scraper_songs_per_sec, run_metadata, save_results, latest_results,
+                                  compare_results, print_comparison)
+
+# Benchmarks on synthetic lyric corpora, no data or api tokens needed: the scraper runs against the local genius stub
+# and the RAG pipeline against the local groq stub. Results are stored as json per run, the previous run with the same
+# parameters is the baseline and metrics that got worse by more than --tolerance are flagged.
+# The query stages need an index, so the corpus is always indexed.
+#
+#   python benchmark.py --sizes 1000 10000
+#   python benchmark.py --sizes 1000 --stages indexing query --baseline benchmarks/results/<run>.json
+#   python benchmark.py --sizes 10000 --stages embedding --embedding-workers 1 2 4 8
+
+
+def benchmark_preprocess(n_songs:int) -> dict:
+    raw = make_raw_lyrics(make_synthetic_corpus(n_songs, seed=1))
+    clean_seconds = best_time(clean_up_lyrics_batch, raw["lyrics"])
+    dedup_seconds = best_time(remove_duplicate_songs, raw)
+    return {
+        "preprocess_clean_up": metric(len(raw) / clean_seconds, "songs/s"),
+        "preprocess_dedup": metric(len(raw) / dedup_seconds, "songs/s"),
+    }
+
+
+def benchmark_embedding_scaling(size:int, workers:list) -> dict:
+    # corpus embedding throughput in one process and with 1..n worker processes, the speedup over one process is the
+    # scaling curve; starting the workers and loading the model replicas is not part of the measured time
+    corpus = make_synthetic_corpus(size)
+    documents = lambda: [Document(content=lyrics) for lyrics in corpus.values()]
+    embedder = SentenceTransformersDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2", progress_bar=False)
+    embedder.warm_up()
+    _, baseline_seconds = timed(embedder.run, documents())
+    metrics = {f"embedding_{size}_single_process": metric(size / baseline_seconds, "songs/s")}
+    for n_workers in workers:
+        embedder = ParallelDocumentEmbedder(model="sentence-transformers/all-MiniLM-L6-v2", n_workers=n_workers)
+        embedder.warm_up()
+        try:
+            _, seconds = timed(embedder.run, documents())
+        finally:
+            embedder.close()
+        metrics[f"embedding_{size}_workers_{n_workers}"] = metric(size / seconds, "songs/s")
+        metrics[f"embedding_{size}_speedup_{n_workers}"] = metric(baseline_seconds / seconds, "x")
+        print(f"{n_workers} workers: {size / seconds:.1f} songs/s, {baseline_seconds / seconds:.2f}x the single process")
+    return metrics
+
+
+def benchmark_corpus(size:int, stages:list, n_queries:int, ann_index:str = None, split_length:int = None, bm25_index:bool = False) -> dict:
+    metrics = {}
+    corpus = make_synthetic_corpus(size)
+    # without query caches, repeated queries would measure cache hits
+    pipeline = NLP_pipeline(ann_index=ann_index, split_length=split_length, bm25_index=bm25_index, query_cache_size=0)
+    pipeline.data = corpus
+    # no embedding cache, every run embeds the whole corpus
+    _, seconds = timed(pipeline.create_embeddings_with_retriever, cache_dir=None)
+    metrics[f"indexing_{size}_time"] = metric(seconds, "s", higher_is_better=False)
+    metrics[f"indexing_{size}_throughput"] = metric(size / seconds, "songs/s")
+    metrics.update(memory_metrics(f"indexing_{size}"))
+
+    if "query" in stages or "rag" in stages:
+        queries = make_queries(corpus, n_queries)
+        pipeline.create_text_embedder()
+        timed(pipeline.create_extractive_pipeline, output_pipeline=False)
+    if "query" in stages:
+        metrics.update(latency_metrics(f"extractive_{size}", lambda q: pipeline.run_extractive_batch([q]),
+                                       pipeline.run_extractive_batch, queries))
+        metrics.update(latency_metrics(f"hybrid_{size}", lambda q: pipeline.run_hybrid_extractive_batch([q]),
+                                       pipeline.run_hybrid_extractive_batch, queries))
+        metrics.update(memory_metrics(f"query_{size}"))
+    if "rag" in stages:
+        # the stub answers right away, this measures retrieval, prompt building and the client overhead
+        server, url = start_groq_stub()
+        try:
+            pipeline.create_prompt_builder()
+            pipeline.create_llm_generator(api_base_url=url)
+            metrics.update(latency_metrics(f"rag_{size}", lambda q: pipeline.run_rag_batch([q]), pipeline.run_rag_batch, queries))
+        finally:
+            server.shutdown()
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark indexing, queries, scraping and preprocessing on synthetic corpora.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="corpus sizes in songs, e.g. 1000 100000 1000000")
+    parser.add_argument("--stages", nargs="+", default=["indexing", "query", "rag", "scraper", "preprocess"],
+                        choices=["indexing", "query", "rag", "scraper", "preprocess", "embedding"])
+    parser.add_argument("--queries", type=int, default=50, help="queries per pipeline")
+    parser.add_argument("--scraper-songs", type=int, default=500, help="songs served by the genius stub")
+    parser.add_argument("--preprocess-songs", type=int, default=None, help="defaults to the largest corpus size")
+    parser.add_argument("--ann-index", default=None, help="ivf, hnsw or flat, see NLP_pipeline")
+    parser.add_argument("--bm25-index", action="store_true", help="BM25 from an inverted index, see NLP_pipeline")
+    parser.add_argument("--embedding-workers", type=int, nargs="+", default=[1, 2, 4], help="worker processes of the embedding stage")
+    parser.add_argument("--split-length", type=int, default=None, help="split songs into passages, see NLP_pipeline")
+    parser.add_argument("--results-dir", default="benchmarks/results")
+    parser.add_argument("--baseline", default=None, help="result file to compare with, defaults to the latest run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change that counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if a metric regressed")
+    args = parser.parse_args()
+
+    parameters = {key: value for key, value in vars(args).items() if key not in ("results_dir", "baseline", "tolerance", "fail_on_regression")}
+    results = {"meta": {**run_metadata(), "parameters": parameters}, "metrics": {}}
+
+    if "preprocess" in args.stages:
+        results["metrics"].update(benchmark_preprocess(args.preprocess_songs or max(args.sizes)))
+    if "scraper" in args.stages:
+        results["metrics"]["scraper"] = metric(scraper_songs_per_sec(args.scraper_songs), "songs/s")
+    if "embedding" in args.stages:
+        for size in args.sizes:
+            print(f"Benchmarking the embedding of {size} songs")
+            results["metrics"].update(benchmark_embedding_scaling(size, args.embedding_workers))
+    if {"indexing", "query", "rag"} & set(args.stages):
+        for size in args.sizes:
+            print(f"Benchmarking a corpus of {size} songs")
+            results["metrics"].update(benchmark_corpus(size, args.stages, args.queries, args.ann_index, args.split_length,
+                                                     args.bm25_index))
+            gc.collect()
+
+    baseline_path = args.baseline or latest_results(args.results_dir)
+    path = save_results(results, args.results_dir)
+    print(f"Results saved to {path}")
+    print(json.dumps(results["metrics"], indent=2))
+
+    if baseline_path is None:
+        sys.exit(0)
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["meta"].get("parameters") != parameters:
+        print(f"{baseline_path} was run with other parameters, only runs with the same parameters are compared")
+        sys.exit(0)
+    print(f"Compared with {baseline_path} (commit {baseline['meta']['commit']}):")
+    comparison = compare_results(baseline, results, args.tolerance)
+    print_comparison(comparison)
+    regressions = [row["metric"] for row in comparison if row["regression"]]
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {100 * args.tolerance:.0f}%: {', '.join(regressions)}")
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
@@ -1,66 +1,34 @@
 import json
-import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
+import asyncio
 
 from src.helper import get_api_token
 from src.webscrap_helper import get_artist_id
+from src.http_client import shared_client
+from src.async_scraper import AsyncGeniusScraper
+from src.fetch_cache import FetchCache
 
 
 # TODO: check for duplicates of songs and quantity
 
 access_token = get_api_token(filename='auth_tokens/genius.json')
 
-# Construct the API endpoint to get songs by the artist
+# Get the artist id to construct the API endpoint for the songs
 artist_name = 'Green Day'
 artist_id = get_artist_id(artist_name, access_token)
-artist_songs_endpoint = f'https://api.genius.com/artists/{artist_id}/songs'
 
-lyrics_store = {}
-missing_lyrics = {}
-page = 1  # Start with the first page
-
-while True:
-    # Make the GET request to get songs by the artist, 50 per page is max
-    response = requests.get(artist_songs_endpoint, headers={'Authorization': 'Bearer ' + access_token}, params={'page': page, 'per_page': 50})
-    
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Process the response to get song titles
-        data = response.json()
-        songs = data['response']['songs']
-        
-        if not songs:
-            break  # Exit the loop if no more songs are returned
-        
-        # Extract lyric 'path' from songs 
-        song_lyric_urls = [f"https://genius.com{song['path']}" for song in songs]
-        
-        for song_lyric_url in tqdm(song_lyric_urls, desc=f'Processing page {page}'):
-            # Make a GET request to the song URL to scrape the lyrics
-            lyrics_response = requests.get(song_lyric_url)
-            if lyrics_response.status_code == 200:
-                soup = BeautifulSoup(lyrics_response.text, 'html.parser')
-                # Check if lyrics exist on the page
-                lyrics_div = soup.find('div', attrs={'data-lyrics-container': 'true'})
-                if lyrics_div:
-                    # Extract and store lyrics
-                    lyrics_store[song_lyric_url] = lyrics_div.get_text(separator='\n')
-            else:
-                print(f'Error fetching lyrics for URL: {song_lyric_url}')
-                missing_lyrics[song_lyric_url] = lyrics_response.status_code
-        
-        # Check if there is a next page
-        next_page = data['response']['next_page']
-        if not next_page:
-            break  # Exit the loop if no next page is available
-        page += 1  # Move to the next page
-    else:
-        print('Error:', response.status_code)
-        break
+# Fetch all song pages and their lyrics concurrently, with a rate limit and retries on 429/5xx
+# Progress is journaled in the cache: a re-run skips stored songs and resumes after the last completed page
+cache = FetchCache('output/scrape_cache.sqlite')
+scraper = AsyncGeniusScraper(access_token, max_concurrency=8, requests_per_second=10, cache=cache)
+lyrics_store, missing_lyrics = asyncio.run(scraper.scrape_artist(artist_id))
+cache.close()
 
 # save lyrics to a file
 with open('output/lyrics.json', 'w') as f:
     json.dump(lyrics_store, f)
 
 print(f"Successfully fetched lyrics for {len(lyrics_store)} songs.")
+# requests, retries, errors, bytes and latency per host: the artist search runs on the shared client,
+# the song pages and lyrics on the session of the async scraper
+print(f"Genius API client: {shared_client(access_token).stats()}")
+print(f"Async scraper: {scraper.stats()}")
@@ -1,8 +1,6 @@
-import json
-import pandas as pd
 
-from src.preprocess_helper import clean_up_lyrics, remove_duplicate_songs
-from src.helper import load_json
+from src.preprocess_helper import clean_up_lyrics_batch, find_duplicates_in_file, iter_green_day_songs
+from src.corpus_stream import write_json_lines
 
 
 # TODO:
@@ -14,30 +12,32 @@ Some songtext are not correct
 '''
 
 
-# Load your JSON data
+# The raw {url: lyrics} json is streamed three times and never loaded as a whole: duplicate search, verification of the
+# duplicate candidates and cleaning; the cleaned songs are written as JSON Lines, one {"title", "lyrics"} per line
+# Memory grows with the number of songs only by their titles and MinHash signatures, not by their lyrics
 input_filename = "output/greenday_lyrics.json"
-output_filename = "output/greenday_lyrics_preprocessed.json"
-
-data = load_json(input_filename)
-
-# Load data as dataframe
-df = pd.DataFrame(data.items(), columns=['url', 'lyrics'])
-
-# Fix URLs by removing escape characters
-df['url'] = df['url'].str.replace(r'\\/', '/')
+output_filename = "output/greenday_lyrics_preprocessed.jsonl"
+batch_size = 5000
 
 # Remove duplicate songs
-df = remove_duplicate_songs(df, verbose=False)
-
-# Apply clean_up_lyrics function to the 'lyrics' column
-df['cleaned_lyrics'] = df['lyrics'].apply(clean_up_lyrics)
-
-print(f"Number of raw songs: {len(data)}")
-print(f"Number of cleaned songs: {df.shape[0]}")
-
-# Convert DataFrame to dictionary with 'url' as keys and 'cleaned_lyrics' as values
-lyrics_dict = df.set_index('song_names')['cleaned_lyrics'].to_dict()
-with open(output_filename, 'w') as f:
-    json.dump(lyrics_dict, f, indent=4)
-
+# Variants are clustered by normalized title and lyric similarity, the report lists which rows were merged and why
+report, titles = find_duplicates_in_file(input_filename, batch_size, verbose=False, report_path="output/duplicate_clusters.csv")
+merged = set(report['position'])
+# one song per title, the last one wins like in a {title: lyrics} json
+last_positions = {title: position for position, title in enumerate(titles) if position not in merged}
+keep = set(last_positions.values())
+del titles, last_positions
+
+def cleaned_songs(stats: dict):
+    # Apply the clean_up_lyrics rules batch_size songs at a time, each batch is written before the next is read
+    for df in iter_green_day_songs(input_filename, batch_size, stats=stats):
+        df = df[df.index.isin(keep)]
+        for title, lyrics in zip(df['song_names'], clean_up_lyrics_batch(df['lyrics'])):
+            yield {"title": title, "lyrics": lyrics}
+
+stats = {}
+n_songs = write_json_lines(cleaned_songs(stats), output_filename)
+
+print(f"Number of raw songs: {stats.get('raw_songs', 0)}")
+print(f"Number of cleaned songs: {n_songs}")
 print(f"Saved preprocessed lyrics to {output_filename}")
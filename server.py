@@ -0,0 +1,205 @@
+import os
+import json
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from LLM_pipeline import NLP_pipeline
+from src.inference_backend import BACKENDS
+
+# Long-running query server: the models are loaded and warmed up once, then queries are answered over HTTP.
+#
+#   python server.py --data output/greenday_lyrics_preprocessed.jsonl --port 8000
+#   curl localhost:8000/ready
+#   curl -X POST localhost:8000/extractive -d '{"query": "21 guns", "top_k": 3}'
+#
+# Endpoints: POST /extractive, /hybrid, /rag with {"query": str or list of str, "top_k": int},
+# GET /health (process is up), GET /ready (503 until the warm-up is finished),
+# GET /stats (queue depth and batch size histograms of the micro-batching scheduler per model).
+# The embedder, reader and ranker calls of concurrent requests are micro-batched into shared forward passes.
+
+
+def serialize_answer(answer) -> dict:
+    return {
+        "answer": answer.data,
+        "score": answer.score,
+        "title": answer.document.meta.get("title") if answer.document else None,
+    }
+
+
+def serialize_document(document) -> dict:
+    return {"title": document.meta.get("title"), "score": document.score, "content": document.content}
+
+
+class QueryService():
+    def __init__(self, data_path:str = None, snapshot_path:str = None, rag:bool = False, groq_base_url:str = None,
+                 max_batch_size:int = 16, max_wait_ms:float = 10.0, inference_backend:str = "fp32") -> None:
+        self.data_path = data_path
+        self.snapshot_path = snapshot_path
+        self.rag = rag
+        self.groq_base_url = groq_base_url
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.inference_backend = inference_backend
+
+        self.pipeline = NLP_pipeline()
+        self.endpoints = {}
+        self.ready = threading.Event()
+        self.error = None
+
+    def warm_up(self) -> None:
+        try:
+            if self.snapshot_path:
+                self.pipeline.load_snapshot(self.snapshot_path)
+            else:
+                # the songs are streamed from the file into the document store, one batch at a time
+                self.pipeline.load_data(self.data_path, stream=True)
+                self.pipeline.create_embeddings_with_retriever()
+            self.pipeline.create_text_embedder()
+            # creates and warms up the reader
+            self.pipeline.create_extractive_pipeline(output_pipeline=False)
+            if self.inference_backend != "fp32":
+                self.pipeline.set_inference_backend(self.inference_backend)
+            if self.rag:
+                self.pipeline.create_prompt_builder()
+                self.pipeline.create_llm_generator(api_base_url=self.groq_base_url)
+
+            # one query through every path loads all remaining models before the server reports ready
+            self.pipeline.run_extractive_batch(["warm up"])
+            self.pipeline.run_hybrid_extractive_batch(["warm up"])
+
+            # from here on every model call goes through the micro-batching scheduler
+            self.pipeline.create_scheduler(max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+            self.endpoints["extractive"] = (self.pipeline.run_extractive_scheduled,
+                                            lambda r: [serialize_answer(a) for a in r["reader"]["answers"]])
+            self.endpoints["hybrid"] = (self.pipeline.run_hybrid_extractive_scheduled,
+                                        lambda r: [serialize_document(d) for d in r["ranker"]["documents"]])
+            if self.rag:
+                self.endpoints["rag"] = (self.pipeline.run_rag_scheduled,
+                                         lambda r: {"reply": r["generator"]["replies"][0], "meta": r["generator"]["meta"][0]})
+            self.ready.set()
+            print("Models are warm, server is ready.")
+        except Exception:
+            self.error = traceback.format_exc()
+            print(self.error)
+
+    def answer(self, endpoint:str, queries:List[str], top_k:int) -> list:
+        # runs in the request worker, the model calls batch with the ones of other requests
+        run, serialize = self.endpoints[endpoint]
+        return [serialize(response) for response in run(queries, top_k=top_k)]
+
+    def stats(self) -> dict:
+        # queue depth and batch size histograms per model
+        return self.pipeline.scheduler.stats() if self.ready.is_set() else {}
+
+    def close(self) -> None:
+        # the generator keeps an event loop and a connection pool for the batches of the rag endpoint
+        if getattr(self.pipeline, "llm_generator", None) is not None:
+            self.pipeline.llm_generator.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service: QueryService = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status:int, payload:dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._send(200, {"status": "ok"})
+        if self.path == "/ready":
+            if self.service.ready.is_set():
+                return self._send(200, {"ready": True})
+            return self._send(503, {"ready": False, "error": self.service.error})
+        if self.path == "/stats":
+            return self._send(200, self.service.stats())
+        return self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        endpoint = self.path.strip("/")
+        if endpoint not in ("extractive", "hybrid", "rag"):
+            return self._send(404, {"error": f"unknown path {self.path}"})
+        if not self.service.ready.is_set():
+            return self._send(503, {"error": "models are still warming up"})
+        if endpoint not in self.service.endpoints:
+            return self._send(404, {"error": f"{endpoint} is not enabled, start the server with --rag"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            queries = request["query"]
+            queries = [queries] if isinstance(queries, str) else list(queries)
+            top_k = int(request.get("top_k", 3))
+        except (ValueError, KeyError, TypeError) as error:
+            return self._send(400, {"error": f"expected {{\"query\": str or list, \"top_k\": int}}: {error!r}"})
+
+        try:
+            results = self.service.answer(endpoint, queries, top_k)
+        except Exception as error:
+            return self._send(500, {"error": repr(error)})
+        return self._send(200, {"queries": queries, "results": results})
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    # requests are handled by a fixed pool of worker threads instead of one new thread per request
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers:int) -> None:
+        super().__init__(server_address, handler_class)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query-worker")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def start_server(service:QueryService, host:str = "127.0.0.1", port:int = 8000, workers:int = None) -> PooledHTTPServer:
+    # the server answers /health right away, the warm-up runs in the background until /ready reports 200
+    # a micro-batch can only grow as large as the number of workers waiting in it
+    handler_class = type("BoundQueryHandler", (QueryHandler,), {"service": service})
+    server = PooledHTTPServer((host, port), handler_class, workers=workers or os.cpu_count() or 1)
+    threading.Thread(target=service.warm_up, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the extractive, hybrid and RAG pipelines over HTTP.")
+    parser.add_argument("--data", default="output/greenday_lyrics_preprocessed.jsonl", help="preprocessed lyrics, .jsonl or a flat .json")
+    parser.add_argument("--snapshot", default=None, help="document store snapshot, skips loading and embedding the data")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="request worker threads, defaults to the number of CPU cores")
+    parser.add_argument("--max-batch-size", type=int, default=16, help="largest batch per model forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="longest wait for a batch to fill")
+    parser.add_argument("--inference-backend", default="fp32", choices=BACKENDS,
+                        help="int8 (dynamic quantization) or onnx (onnxruntime) for the embedder, reader and ranker")
+    parser.add_argument("--rag", action="store_true", help="enable the RAG endpoint (needs auth_tokens/groq.json)")
+    parser.add_argument("--groq-base-url", default=None, help="e.g. a local groq stub, see src/local_stubs.py")
+    args = parser.parse_args()
+
+    service = QueryService(args.data, args.snapshot, rag=args.rag, groq_base_url=args.groq_base_url,
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           inference_backend=args.inference_backend)
+    server = start_server(service, args.host, args.port, args.workers)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} with {server.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,378 @@
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component, default_from_dict, default_to_dict
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from src.query_cache import RetrievalCache, embedding_key, filters_key
+from src.batch_helper import retrieved_document
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def last_occurrences(ids:List[str], vectors) -> Tuple[List[str], np.ndarray]:
+    # an id that occurs more than once in one add keeps its last vector, like repeated writes to the store
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors.reshape(len(vectors), -1)
+    last = {doc_id: i for i, doc_id in enumerate(ids)}
+    if len(last) == len(ids):
+        return list(ids), vectors
+    rows = sorted(last.values())
+    return [ids[i] for i in rows], vectors[rows]
+
+
+class FlatIndex():
+    # exact brute force search, used as reference for the approximate indexes
+    def __init__(self, similarity:str = "dot_product") -> None:
+        self.similarity = similarity
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def _prepare(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors.reshape(len(vectors), -1)
+        if self.similarity == "cosine":
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def build(self, ids:List[str], vectors) -> None:
+        self.ids = []
+        self.rows = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.add(ids, vectors)
+
+    def add(self, ids:List[str], vectors) -> None:
+        if not len(ids):
+            return
+        ids, vectors = last_occurrences(ids, vectors)
+        self.remove([doc_id for doc_id in ids if doc_id in self.rows])
+        vectors = self._prepare(vectors)
+        self.vectors = vectors if not len(self.ids) else np.concatenate([self.vectors, vectors])
+        for doc_id in ids:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+
+    def remove(self, ids:List[str]) -> None:
+        # rows are only marked as deleted, build() compacts them
+        for doc_id in ids:
+            row = self.rows.pop(doc_id, None)
+            if row is not None:
+                self.alive[row] = False
+
+    def search(self, query_vectors, top_k:int) -> Tuple[List[List[str]], List[List[float]]]:
+        query_vectors = self._prepare(query_vectors)
+        candidates = np.flatnonzero(self.alive)
+        scores = query_vectors @ self.vectors[candidates].T if len(candidates) else np.zeros((len(query_vectors), 0))
+        return self._top_k(scores, candidates, top_k)
+
+    def _top_k(self, scores:np.ndarray, candidates:np.ndarray, top_k:int) -> Tuple[List[List[str]], List[List[float]]]:
+        result_ids, result_scores = [], []
+        for row in scores:
+            k = min(top_k, len(row))
+            best = np.argpartition(-row, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+            best = best[np.argsort(-row[best], kind="stable")]
+            result_ids.append([self.ids[candidates[i]] for i in best])
+            result_scores.append([float(row[i]) for i in best])
+        return result_ids, result_scores
+
+
+class IVFIndex(FlatIndex):
+    # inverted file index in pure numpy: vectors are clustered with k-means and a query
+    # only scans the n_probe clusters closest to it instead of the whole corpus
+    # n_lists: number of clusters, defaults to sqrt(number of documents)
+    # n_probe: clusters scanned per query, higher means better recall but slower queries
+    def __init__(self, similarity:str = "dot_product", n_lists:Optional[int] = None, n_probe:int = 8, n_iter:int = 10, seed:int = 0) -> None:
+        super().__init__(similarity)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.lists: List[np.ndarray] = []
+        self._trained_size = 0
+
+    def build(self, ids:List[str], vectors) -> None:
+        super().build(ids, vectors)
+        self._train()
+
+    def _train(self):
+        # k-means on the alive vectors, then every vector is assigned to its closest centroid
+        rows = np.flatnonzero(self.alive)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(rows)))), len(rows))
+        self._trained_size = len(rows)
+        if n_lists == 0:
+            self.centroids = np.zeros((0, self.vectors.shape[1] if self.vectors.ndim == 2 else 0), dtype=np.float32)
+            self.lists = []
+            return
+        data = self.vectors[rows]
+        rng = np.random.default_rng(self.seed)
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignment = self._assign(data, centroids)
+            for c in range(n_lists):
+                members = data[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        self.centroids = centroids
+        assignment = self._assign(data, centroids)
+        self.lists = [rows[assignment == c] for c in range(n_lists)]
+
+    def _assign(self, data:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        # closest centroid by euclidean distance, ||x||^2 is the same for all centroids and left out
+        distances = (centroids ** 2).sum(axis=1) - 2 * data @ centroids.T
+        return distances.argmin(axis=1)
+
+    def add(self, ids:List[str], vectors) -> None:
+        start = len(self.ids)
+        super().add(ids, vectors)
+        if not len(self.lists):
+            self._train()
+            return
+        new_rows = np.arange(start, len(self.ids))
+        assignment = self._assign(self.vectors[new_rows], self.centroids)
+        for c in np.unique(assignment):
+            self.lists[c] = np.concatenate([self.lists[c], new_rows[assignment == c]])
+        # the clusters get unbalanced if the index grows a lot, retrain after it doubled
+        if len(self) > 2 * self._trained_size:
+            self._train()
+
+    def search(self, query_vectors, top_k:int) -> Tuple[List[List[str]], List[List[float]]]:
+        query_vectors = self._prepare(query_vectors)
+        if not len(self.lists):
+            return [[] for _ in query_vectors], [[] for _ in query_vectors]
+        n_probe = min(self.n_probe, len(self.lists))
+        probes = np.argsort(self._assign_distances(query_vectors), axis=1)[:, :n_probe]
+
+        result_ids, result_scores = [], []
+        for query_vector, query_probes in zip(query_vectors, probes):
+            candidates = np.concatenate([self.lists[c] for c in query_probes])
+            candidates = candidates[self.alive[candidates]]
+            scores = (self.vectors[candidates] @ query_vector)[None, :]
+            ids, scores = self._top_k(scores, candidates, top_k)
+            result_ids.extend(ids)
+            result_scores.extend(scores)
+        return result_ids, result_scores
+
+    def _assign_distances(self, query_vectors:np.ndarray) -> np.ndarray:
+        return (self.centroids ** 2).sum(axis=1) - 2 * query_vectors @ self.centroids.T
+
+
+class HNSWIndex():
+    # graph index from the optional hnswlib package (pip install hnswlib)
+    # m and ef_construction set the graph quality, ef_search trades recall against latency per query
+    def __init__(self, similarity:str = "dot_product", m:int = 16, ef_construction:int = 200, ef_search:int = 64) -> None:
+        if hnswlib is None:
+            raise ImportError("HNSWIndex needs hnswlib, run 'pip install hnswlib' or use IVFIndex instead")
+        self.similarity = similarity
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = None
+        self.labels: Dict[str, int] = {}
+        self.ids: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def build(self, ids:List[str], vectors) -> None:
+        self.index = None
+        self.labels = {}
+        self.ids = {}
+        self.add(ids, vectors)
+
+    def add(self, ids:List[str], vectors) -> None:
+        if not len(ids):
+            return
+        ids, vectors = last_occurrences(ids, vectors)
+        if self.index is None:
+            self.index = hnswlib.Index(space="cosine" if self.similarity == "cosine" else "ip", dim=vectors.shape[1])
+            self.index.init_index(max_elements=max(len(ids), 1024), ef_construction=self.ef_construction, M=self.m, allow_replace_deleted=True)
+            self._next_label = 0
+        self.remove([doc_id for doc_id in ids if doc_id in self.labels])
+        if self.index.get_current_count() + len(ids) > self.index.get_max_elements():
+            self.index.resize_index(2 * (self.index.get_current_count() + len(ids)))
+        labels = np.arange(self._next_label, self._next_label + len(ids))
+        self._next_label += len(ids)
+        self.index.add_items(vectors, labels, replace_deleted=True)
+        for doc_id, label in zip(ids, labels):
+            self.labels[doc_id] = int(label)
+            self.ids[int(label)] = doc_id
+
+    def remove(self, ids:List[str]) -> None:
+        for doc_id in ids:
+            label = self.labels.pop(doc_id, None)
+            if label is not None:
+                self.index.mark_deleted(label)
+                del self.ids[label]
+
+    def search(self, query_vectors, top_k:int) -> Tuple[List[List[str]], List[List[float]]]:
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_vectors = query_vectors.reshape(len(query_vectors), -1)
+        k = min(top_k, len(self))
+        if k == 0:
+            return [[] for _ in query_vectors], [[] for _ in query_vectors]
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(query_vectors, k=k)
+        # hnswlib returns 1 - similarity as distance for "ip" and "cosine"
+        result_ids = [[self.ids[int(label)] for label in row] for row in labels]
+        result_scores = [[float(1.0 - distance) for distance in row] for row in distances]
+        return result_ids, result_scores
+
+
+ANN_INDEXES = {"flat": FlatIndex, "ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def create_ann_index(name:str, similarity:str = "dot_product", **kwargs):
+    if name not in ANN_INDEXES:
+        raise ValueError(f"Unknown ANN index '{name}', choose one of {list(ANN_INDEXES)}")
+    return ANN_INDEXES[name](similarity=similarity, **kwargs)
+
+
+def recall_at_k(index, exact_index:FlatIndex, query_vectors, k:int = 10) -> float:
+    # share of the exact top-k documents that the approximate index also returns
+    approximate_ids, _ = index.search(query_vectors, k)
+    exact_ids, _ = exact_index.search(query_vectors, k)
+    found = sum(len(set(a) & set(e)) for a, e in zip(approximate_ids, exact_ids))
+    total = sum(len(e) for e in exact_ids)
+    return found / total if total else 1.0
+
+
+@component
+class ANNEmbeddingRetriever:
+    """
+    Retrieves documents from an InMemoryDocumentStore with an approximate nearest neighbour index
+    instead of scanning every document embedding.
+
+    The index follows the document store: documents that are written or deleted are added to or removed
+    from the index before the next query, `sync()` can also be called directly after bulk writes.
+    """
+
+    def __init__(self, document_store:InMemoryDocumentStore, index_type:str = "ivf", index_parameters:Optional[Dict[str, Any]] = None, top_k:int = 10,
+                 cache_size:int = 0):
+        if not isinstance(document_store, InMemoryDocumentStore):
+            raise ValueError("document_store must be an instance of InMemoryDocumentStore")
+        if top_k <= 0:
+            raise ValueError(f"top_k must be greater than 0. Currently, top_k is {top_k}")
+        self.document_store = document_store
+        self.index_type = index_type
+        self.index_parameters = index_parameters or {}
+        self.top_k = top_k
+        self.index = create_ann_index(index_type, document_store.embedding_similarity_function, **self.index_parameters)
+        self._indexed: Dict[str, int] = {}
+        self._indexed_version = None
+        # the request threads of server.py share the index: syncs, updates and searches of the index take turns
+        self._lock = threading.RLock()
+        # optional LRU cache of top-k results, invalidated when the store changes (see src/query_cache.py)
+        self.cache_size = cache_size
+        self.cache = RetrievalCache(document_store, cache_size)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return default_to_dict(
+            self,
+            document_store=self.document_store.to_dict(),
+            index_type=self.index_type,
+            index_parameters=self.index_parameters,
+            top_k=self.top_k,
+            cache_size=self.cache_size,
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ANNEmbeddingRetriever":
+        data["init_parameters"]["document_store"] = InMemoryDocumentStore.from_dict(data["init_parameters"]["document_store"])
+        return default_from_dict(cls, data)
+
+    def _revision(self, doc_id:str) -> int:
+        # what tells a new or overwritten document apart: its object in the storage,
+        # a compact storage builds its documents on access and tells the revision of each row instead
+        storage = self.document_store.storage
+        return storage.revision(doc_id) if hasattr(storage, "revision") else id(storage[doc_id])
+
+    def _embeddings(self, ids:List[str]) -> list:
+        storage = self.document_store.storage
+        if hasattr(storage, "embedding"):
+            return [storage.embedding(doc_id) for doc_id in ids]
+        return [storage[doc_id].embedding for doc_id in ids]
+
+    def sync(self) -> None:
+        # diff the store against the index, new or overwritten documents are new objects in the storage
+        with self._lock:
+            storage = self.document_store.storage
+            if hasattr(storage, "revisions"):
+                current = storage.revisions()
+            else:
+                current = {doc.id: id(doc) for doc in storage.values() if doc.embedding is not None}
+            removed = [doc_id for doc_id, obj in self._indexed.items() if current.get(doc_id) != obj]
+            added = [doc_id for doc_id, obj in current.items() if self._indexed.get(doc_id) != obj]
+            if not self._indexed:
+                self.index.build(added, self._embeddings(added))
+            else:
+                self.index.remove(removed)
+                self.index.add(added, self._embeddings(added))
+            self._indexed = current
+            self._indexed_version = getattr(self.document_store, "version", None)
+
+    def update(self, added:List[str], removed:List[str], since_version:Optional[int] = None) -> None:
+        # incremental sync() for a caller that knows which documents it wrote and deleted since the store had
+        # since_version, the cost depends on the change and not on the corpus. Any other change means a full sync.
+        with self._lock:
+            if not self._indexed or since_version is None or since_version != self._indexed_version:
+                self.sync()
+                return
+            storage = self.document_store.storage
+            stale = [doc_id for doc_id in list(removed) + list(added) if self._indexed.pop(doc_id, None) is not None]
+            self.index.remove(stale)
+            added = [doc_id for doc_id in added if doc_id in storage]
+            embeddings = self._embeddings(added)
+            added, embeddings = [doc_id for doc_id, e in zip(added, embeddings) if e is not None], [e for e in embeddings if e is not None]
+            self.index.add(added, embeddings)
+            self._indexed.update({doc_id: self._revision(doc_id) for doc_id in added})
+            self._indexed_version = getattr(self.document_store, "version", None)
+
+    def _needs_sync(self) -> bool:
+        # a versioned store tells every change, otherwise only the document count is checked per query,
+        # a full diff would make every query linear again
+        version = getattr(self.document_store, "version", None)
+        if version is not None:
+            return version != self._indexed_version
+        return len(self._indexed) != self.document_store.count_documents()
+
+    def search_batch(self, query_embeddings, top_k:Optional[int] = None) -> List[List[Document]]:
+        with self._lock:
+            if self._needs_sync():
+                self.sync()
+            ids, scores = self.index.search(query_embeddings, top_k or self.top_k)
+        storage = self.document_store.storage
+        results = []
+        for query_ids, query_scores in zip(ids, scores):
+            documents = []
+            for doc_id, score in zip(query_ids, query_scores):
+                documents.append(retrieved_document(storage, doc_id, score))
+            results.append(documents)
+        return results
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding:List[float], filters:Optional[Dict[str, Any]] = None, top_k:Optional[int] = None):
+        self.cache.document_store = self.document_store
+        key = (embedding_key(query_embedding), filters_key(filters), top_k or self.top_k)
+        version = self.cache.current_version()
+        documents = self.cache.get(key)
+        if documents is not None:
+            return {"documents": documents}
+        if filters:
+            # the index knows nothing about meta, filtered queries use the exact scan of the store
+            documents = self.document_store.embedding_retrieval(query_embedding, filters=filters, top_k=top_k or self.top_k)
+        else:
+            documents = self.search_batch([query_embedding], top_k)[0]
+        self.cache.put(key, documents, version)
+        return {"documents": documents}
@@ -0,0 +1,194 @@
+import json
+import time
+import random
+import asyncio
+from typing import Dict, Mapping, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import aiohttp
+from tqdm.asyncio import tqdm_asyncio
+
+from src.rate_limit import TokenBucket
+from src.fetch_cache import FetchCache
+from src.http_client import RETRY_STATUS, new_host_stats, retry_after_seconds, summarize_stats
+from src.webscrap_helper import extract_lyrics_from_html
+
+
+class AsyncGeniusScraper():
+    def __init__(
+        self,
+        access_token:str,
+        max_concurrency:int = 8,
+        max_per_host:Optional[int] = None,
+        requests_per_second:Optional[float] = 10.0,
+        max_retries:int = 5,
+        backoff:float = 1.0,
+        timeout:float = 30.0,
+        api_base_url:str = "https://api.genius.com",
+        web_base_url:str = "https://genius.com",
+        cache:Optional[FetchCache] = None,
+        page_max_age:float = 24 * 3600,
+    ) -> None:
+        # base urls can point to a local stub server (see src/local_stubs.py)
+        # with a cache, stored songs are skipped, completed pages are only fetched again after page_max_age seconds
+        # at most max_concurrency requests are in flight, at most max_per_host (default: max_concurrency) per host
+        self.access_token = access_token
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host or max_concurrency
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.api_base_url = api_base_url.rstrip("/")
+        self.web_base_url = web_base_url.rstrip("/")
+        self.cache = cache
+        self.page_max_age = page_max_age
+
+        self.lyrics_store: Dict[str, str] = {}
+        self.missing_lyrics: Dict[str, int] = {}
+        # requests, retries, errors, bytes and latencies per host, like src/http_client.py
+        self._stats: Dict[str, dict] = {}
+
+    def _record(self, url:str, seconds:float, body:Optional[bytes] = None, content_length:Optional[str] = None) -> dict:
+        # body None: the request failed without a response
+        stats = self._stats.setdefault(urlsplit(url).netloc, new_host_stats())
+        stats["requests"] += 1
+        stats["latencies"].append(seconds)
+        if body is None:
+            stats["errors"] += 1
+        else:
+            stats["bytes"] += len(body)
+            # aiohttp decodes gzip on the fly, the Content-Length tells the bytes on the wire
+            stats["wire_bytes"] += int(content_length) if content_length and content_length.isdigit() else len(body)
+        return stats
+
+    def stats(self) -> dict:
+        return summarize_stats(self._stats)
+
+    async def fetch(self, session:aiohttp.ClientSession, url:str, headers:dict = None, params:dict = None) -> Tuple[int, str, Mapping]:
+        # GET with rate limit, bounded concurrency and exponential backoff on 429/5xx and network errors
+        status = 0
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+            retry_after = None
+            start = time.perf_counter()
+            async with self.semaphore:
+                try:
+                    async with session.get(url, headers=headers, params=params) as response:
+                        status = response.status
+                        body = await response.read()
+                        stats = self._record(url, time.perf_counter() - start, body, response.headers.get("Content-Length"))
+                        if status not in RETRY_STATUS:
+                            # the headers stay case-insensitive, aiohttp spells the ETag header "Etag"
+                            return status, await response.text(), response.headers
+                        retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status = 0
+                    stats = self._record(url, time.perf_counter() - start)
+
+            if attempt < self.max_retries:
+                stats["retries"] += 1
+                if retry_after is not None:
+                    delay = retry_after
+                else:
+                    delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                await asyncio.sleep(delay)
+        return status, "", {}
+
+    async def fetch_cached(self, session:aiohttp.ClientSession, url:str, headers:dict = None, params:dict = None) -> Tuple[int, str]:
+        # fresh cached responses are served from disk, stale ones are revalidated with a conditional request
+        if self.cache is None:
+            status, text, _ = await self.fetch(session, url, headers, params)
+            return status, text
+
+        key = f"{url}?{urlencode(sorted((params or {}).items()))}"
+        cached = self.cache.get_response(key)
+        if cached and time.time() - cached["fetched_at"] < self.page_max_age:
+            return cached["status"], cached["body"]
+
+        headers = dict(headers or {})
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        status, text, response_headers = await self.fetch(session, url, headers, params)
+        if status == 304 and cached:
+            self.cache.touch_response(key)
+            return cached["status"], cached["body"]
+        if status == 200:
+            self.cache.put_response(key, status, text, response_headers.get("ETag"), response_headers.get("Last-Modified"))
+        return status, text
+
+    async def fetch_songs_page(self, session:aiohttp.ClientSession, artist_id:int, page:int) -> Optional[dict]:
+        # 50 per page is max
+        status, text = await self.fetch_cached(
+            session,
+            f"{self.api_base_url}/artists/{artist_id}/songs",
+            headers={'Authorization': 'Bearer ' + self.access_token},
+            params={'page': page, 'per_page': 50},
+        )
+        if status != 200:
+            print('Error:', status)
+            return None
+        return json.loads(text)
+
+    async def fetch_lyrics(self, session:aiohttp.ClientSession, path:str) -> None:
+        # results are stored under the genius url, also when fetched from a stub server
+        song_lyric_url = f"https://genius.com{path}"
+        if self.cache and self.cache.has_lyrics(song_lyric_url):
+            return
+        status, text, _ = await self.fetch(session, f"{self.web_base_url}{path}")
+        if status == 200:
+            # parsing runs in a thread so the event loop keeps downloading
+            lyrics = await asyncio.to_thread(extract_lyrics_from_html, text)
+            if lyrics:
+                self.lyrics_store[song_lyric_url] = lyrics
+            # also pages without lyrics are stored, so they are not fetched again
+            self.cache.put_lyrics(song_lyric_url, lyrics) if self.cache else None
+        else:
+            print(f'Error fetching lyrics for URL: {song_lyric_url}')
+            self.missing_lyrics[song_lyric_url] = status
+            self.cache.put_lyrics(song_lyric_url, None, status) if self.cache else None
+
+    def first_page_to_fetch(self, artist_id:int) -> Optional[int]:
+        # follow the chain of completed pages that are still fresh, the scrape resumes after them
+        page = 1
+        while self.cache:
+            completed = self.cache.get_completed_page(artist_id, page)
+            if completed is None or time.time() - completed[1] >= self.page_max_age:
+                break
+            page = completed[0]
+            if page is None:
+                return None
+        return page
+
+    async def scrape_artist(self, artist_id:int) -> Tuple[Dict[str, str], Dict[str, int]]:
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_per_host)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            page = self.first_page_to_fetch(artist_id)
+            if page is None:
+                print("All pages are already scraped and up to date.")
+            page_task = asyncio.create_task(self.fetch_songs_page(session, artist_id, page)) if page else None
+            while page_task is not None:
+                data = await page_task
+                if data is None or not data['response']['songs']:
+                    break
+
+                # prefetch the next page while the lyrics of this page download
+                next_page = data['response']['next_page']
+                page_task = asyncio.create_task(self.fetch_songs_page(session, artist_id, next_page)) if next_page else None
+
+                paths = [song['path'] for song in data['response']['songs']]
+                await tqdm_asyncio.gather(*[self.fetch_lyrics(session, path) for path in paths], desc=f'Processing page {page}')
+                # a page only counts as completed if none of its lyrics failed
+                if self.cache and not any(f"https://genius.com{path}" in self.missing_lyrics for path in paths):
+                    self.cache.complete_page(artist_id, page, next_page)
+                page = next_page
+
+        # with a cache the result also contains the songs of earlier runs
+        if self.cache:
+            return self.cache.export_lyrics(), self.cache.export_missing()
+        return self.lyrics_store, self.missing_lyrics
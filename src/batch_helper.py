@@ -0,0 +1,257 @@
+import math
+import threading
+from dataclasses import replace
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from haystack import Document
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from src.compact_store import matrix_scores
+
+
+class DocumentMatrix():
+    # keeps all document embeddings of a store as one float32 matrix, rebuilt only if the store changed
+    def __init__(self, document_store:InMemoryDocumentStore) -> None:
+        self.document_store = document_store
+        self._signature = None
+        self._version = None
+        self.ids: List[str] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        # row of every id, and the matrix with spare rows for update()
+        self._rows = {}
+        self._buffer = self.matrix
+        # get() rebuilds and update() changes the matrix, the request threads of server.py take turns
+        self._lock = threading.Lock()
+
+    def get(self) -> Tuple[List[str], np.ndarray]:
+        # a versioned store tells directly if it changed (see src/versioned_store.py)
+        with self._lock:
+            version = getattr(self.document_store, "version", None)
+            if version is not None and version == self._version:
+                return self.ids, self.matrix
+            # a compact store keeps its embeddings as a matrix already (see src/compact_store.py), no copy needed
+            if hasattr(self.document_store.storage, "embedding_matrix"):
+                self.ids, self.matrix = self.document_store.storage.embedding_matrix()
+                self._version = version
+                return self.ids, self.matrix
+            # otherwise: written or overwritten documents are new objects, so their identities tell if the store changed
+            documents = [doc for doc in self.document_store.storage.values() if doc.embedding is not None]
+            signature = [id(doc) for doc in documents]
+            self._version = version
+            if signature != self._signature:
+                self.ids = [doc.id for doc in documents]
+                self.matrix = np.asarray([doc.embedding for doc in documents], dtype=np.float32).reshape(len(documents), -1)
+                if self.document_store.embedding_similarity_function == "cosine":
+                    self.matrix /= np.linalg.norm(self.matrix, axis=1, keepdims=True)
+                self._signature = signature
+                self._rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+                self._buffer = self.matrix
+            return self.ids, self.matrix
+
+    def update(self, added:List[str], removed:List[str], since_version:int = None) -> None:
+        # applies the documents a caller wrote and deleted since the store had since_version instead of rebuilding,
+        # a deleted row is filled with the last one. Any other change (or a compact store) is left to get().
+        with self._lock:
+            if hasattr(self.document_store.storage, "embedding_matrix") or since_version is None or since_version != self._version:
+                return
+            for doc_id in list(removed) + list(added):
+                row = self._rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                last = len(self.ids) - 1
+                if row != last:
+                    self._buffer[row] = self._buffer[last]
+                    self.ids[row] = self.ids[last]
+                    self._rows[self.ids[row]] = row
+                self.ids.pop()
+
+            storage = self.document_store.storage
+            documents = [storage[doc_id] for doc_id in added if doc_id in storage]
+            documents = [doc for doc in documents if doc.embedding is not None]
+            if documents:
+                vectors = np.asarray([doc.embedding for doc in documents], dtype=np.float32).reshape(len(documents), -1)
+                if self.document_store.embedding_similarity_function == "cosine":
+                    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                n_rows = len(self.ids)
+                if not n_rows:
+                    self._buffer = vectors
+                else:
+                    if n_rows + len(vectors) > len(self._buffer):
+                        # spare rows, so adding a few documents at a time does not copy the matrix every time
+                        buffer = np.zeros((max(n_rows + len(vectors), 2 * len(self._buffer)), self._buffer.shape[1]), dtype=np.float32)
+                        buffer[:n_rows] = self._buffer[:n_rows]
+                        self._buffer = buffer
+                    self._buffer[n_rows:n_rows + len(vectors)] = vectors
+                for doc in documents:
+                    self._rows[doc.id] = len(self.ids)
+                    self.ids.append(doc.id)
+            self.matrix = self._buffer[:len(self.ids)]
+            self._version = getattr(self.document_store, "version", None)
+            # the next unknown change rebuilds from scratch
+            self._signature = None
+
+def embed_queries(text_embedder, queries:List[str]) -> np.ndarray:
+    # one encode call for all queries instead of one per query
+    texts = [text_embedder.prefix + q + text_embedder.suffix for q in queries]
+    # an embedder with a query cache (src/query_cache.py) only encodes the queries it has not seen
+    cache = getattr(text_embedder, "cache", None)
+    if cache is None:
+        return _encode(text_embedder, texts)
+
+    text_embedder.warm_up()
+    keys = [text_embedder.cache_key(text) for text in texts]
+    embeddings = [cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        for i, embedding in zip(missing, _encode(text_embedder, [texts[i] for i in missing])):
+            embeddings[i] = embedding.tolist()
+            cache.put(keys[i], embeddings[i])
+    return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+
+def _encode(text_embedder, texts:List[str]) -> np.ndarray:
+    text_embedder.warm_up()
+    return text_embedder.embedding_backend.model.encode(
+        texts,
+        batch_size=text_embedder.batch_size,
+        show_progress_bar=False,
+        normalize_embeddings=text_embedder.normalize_embeddings,
+        convert_to_numpy=True,
+    ).astype(np.float32)
+
+
+def top_k_rows(scores:np.ndarray, top_k:int) -> np.ndarray:
+    # indices of the top_k highest scores per row, sorted descending
+    top_k = min(top_k, scores.shape[1])
+    if top_k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def retrieved_document(storage, doc_id:str, score:float) -> Document:
+    # copy of a stored document with score and without embedding, a compact storage builds it without the embedding
+    if hasattr(storage, "get_document"):
+        return replace(storage.get_document(doc_id, return_embedding=False), score=score)
+    doc_fields = storage[doc_id].to_dict()
+    doc_fields["score"] = score
+    doc_fields["embedding"] = None
+    return Document.from_dict(doc_fields)
+
+
+def batch_embedding_retrieval(document_matrix:DocumentMatrix, query_embeddings:np.ndarray, top_k:int = 10) -> List[List[Document]]:
+    ids, matrix = document_matrix.get()
+    query_embeddings = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+    if document_matrix.document_store.embedding_similarity_function == "cosine":
+        query_embeddings = query_embeddings / np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+
+    # one matrix multiply for the whole query block
+    scores = matrix_scores(query_embeddings, matrix) if len(ids) else np.zeros((len(query_embeddings), 0), dtype=np.float32)
+
+    storage = document_matrix.document_store.storage
+    results = []
+    for row, indices in zip(scores, top_k_rows(scores, top_k)):
+        documents = []
+        for i in indices:
+            # same output as InMemoryDocumentStore.embedding_retrieval: a copy with score and without embedding
+            documents.append(retrieved_document(storage, ids[i], float(row[i])))
+        results.append(documents)
+    return results
+
+
+def batch_rank(ranker, queries:List[str], documents_per_query:List[List[Document]], top_k:int = None, max_batch_size:int = 64) -> List[List[Document]]:
+    # score the query/document pairs of all queries in shared forward passes of the cross-encoder
+    ranker.warm_up()
+    top_k = top_k or ranker.top_k
+
+    pairs = []
+    for query, documents in zip(queries, documents_per_query):
+        for doc in documents:
+            meta_values_to_embed = [str(doc.meta[key]) for key in ranker.meta_fields_to_embed if key in doc.meta and doc.meta[key]]
+            text_to_embed = ranker.embedding_separator.join(meta_values_to_embed + [doc.content or ""])
+            pairs.append([ranker.query_prefix + query, ranker.document_prefix + text_to_embed])
+    if not pairs:
+        return [[] for _ in queries]
+
+    scores = []
+    for i in range(math.ceil(len(pairs) / max_batch_size)):
+        features = ranker.tokenizer(
+            pairs[i * max_batch_size:(i + 1) * max_batch_size], padding=True, truncation=True, return_tensors="pt"
+        ).to(ranker.device.first_device.to_torch())
+        with torch.inference_mode():
+            logits = ranker.model(**features).logits.squeeze(dim=1)
+        if ranker.scale_score:
+            logits = torch.sigmoid(logits * ranker.calibration_factor)
+        scores.extend(logits.cpu().tolist())
+
+    # split the flat scores back per query
+    results = []
+    offset = 0
+    for documents in documents_per_query:
+        for doc, score in zip(documents, scores[offset:offset + len(documents)]):
+            doc.score = score
+        offset += len(documents)
+        ranked_docs = sorted(documents, key=lambda doc: doc.score, reverse=True)
+        if ranker.score_threshold is not None:
+            ranked_docs = [doc for doc in ranked_docs if doc.score >= ranker.score_threshold]
+        results.append(ranked_docs[:top_k])
+    return results
+
+
+def batch_read(reader, queries:List[str], documents_per_query:List[List[Document]], top_k:int = None) -> List[list]:
+    # same steps as ExtractiveReader.run, but all queries are flattened into one batch axis
+    reader.warm_up()
+    top_k = top_k or reader.top_k
+    answers_per_seq = reader.answers_per_seq or 20
+
+    # queries without documents have no answers and are left out of the forward pass
+    active = [i for i, documents in enumerate(documents_per_query) if documents]
+    answers = [[] for _ in queries]
+    if not active:
+        return answers
+    active_queries = [queries[i] for i in active]
+
+    flattened_queries, flattened_documents, query_ids = reader._flatten_documents(
+        active_queries, [documents_per_query[i] for i in active]
+    )
+    input_ids, attention_mask, sequence_ids, encodings, query_ids, document_ids = reader._preprocess(
+        flattened_queries, flattened_documents, reader.max_seq_length, query_ids, reader.stride
+    )
+
+    batch_size = reader.max_batch_size or input_ids.shape[0]
+    start_logits_list = []
+    end_logits_list = []
+    for i in range(math.ceil(input_ids.shape[0] / batch_size)):
+        with torch.inference_mode():
+            output = reader.model(
+                input_ids=input_ids[i * batch_size:(i + 1) * batch_size],
+                attention_mask=attention_mask[i * batch_size:(i + 1) * batch_size],
+            )
+        start_logits_list.append(output.start_logits.cpu())
+        end_logits_list.append(output.end_logits.cpu())
+
+    start, end, probabilities = reader._postprocess(
+        torch.cat(start_logits_list), torch.cat(end_logits_list), sequence_ids.cpu(), attention_mask.cpu(), answers_per_seq, encodings
+    )
+    # _nest_answers assumes a fixed number of answers per sequence when it maps them back to queries,
+    # so the answers are nested per query on the sequences that belong to it
+    for position, i in enumerate(active):
+        sequences = [j for j, query_id in enumerate(query_ids) if query_id == position]
+        answers[i] = reader._nest_answers(
+            start=[start[j] for j in sequences],
+            end=[end[j] for j in sequences],
+            probabilities=probabilities[sequences],
+            flattened_documents=flattened_documents,
+            queries=[queries[i]],
+            answers_per_seq=answers_per_seq,
+            top_k=top_k,
+            score_threshold=reader.score_threshold,
+            query_ids=[0] * len(sequences),
+            document_ids=[document_ids[j] for j in sequences],
+            no_answer=reader.no_answer,
+            overlap_threshold=reader.overlap_threshold,
+        )[0]
+    return answers
@@ -0,0 +1,177 @@
+import os
+import io
+import json
+import time
+import asyncio
+import platform
+import subprocess
+import contextlib
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from src.inference_backend import current_rss_mb
+from src.tracing import peak_rss_mb
+
+# Building blocks of benchmark.py: synthetic corpora, timers and result files.
+# A result file is {"meta": {...}, "metrics": {name: {"value", "unit", "higher_is_better"}}},
+# compare_results flags the metrics that got worse than a baseline run by more than a tolerance.
+
+SYLLABLES = ["la", "na", "do", "re", "mi", "ka", "to", "ri", "an", "go", "be", "lo", "ve", "sun", "day", "night",
+             "run", "way", "fire", "heart", "ro", "ad", "ze", "ta", "kin", "gun", "bor", "ed", "ing", "er"]
+
+
+def make_vocabulary(size:int = 5000, seed:int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, size=rng.integers(1, 4))))
+    return np.array(sorted(words))
+
+
+def make_synthetic_corpus(n_songs:int, words_per_song:int = 200, words_per_line:int = 8, vocabulary_size:int = 5000,
+                          seed:int = 0) -> Dict[str, str]:
+    # {title: lyrics} like the preprocessed json, word frequencies follow a Zipf law as in real lyrics
+    # and lines are separated by '.' like the section markers of clean_up_lyrics
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size, seed)
+    corpus = {}
+    for start in range(0, n_songs, 10000):
+        count = min(10000, n_songs - start)
+        ids = np.minimum(rng.zipf(1.2, size=(count, words_per_song)) - 1, vocabulary_size - 1)
+        for i, row in enumerate(vocabulary[ids]):
+            lines = [" ".join(row[j:j + words_per_line]) for j in range(0, words_per_song, words_per_line)]
+            corpus[f"song {start + i}"] = ". ".join(lines)
+    return corpus
+
+
+def make_raw_lyrics(corpus:Dict[str, str], duplicate_share:float = 0.05, seed:int = 0) -> pd.DataFrame:
+    # scraped form of a corpus for preprocess: genius urls, [Verse] tags and newlines, plus some live/remaster duplicates
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i, (title, lyrics) in enumerate(corpus.items()):
+        url = f"https://genius.com/Green-day-{title.replace(' ', '-')}-lyrics"
+        raw = "[Verse 1]\n" + lyrics.replace(". ", "\n[Chorus]\n", 1).replace(". ", "\n")
+        rows.append((url, raw))
+        if rng.random() < duplicate_share:
+            rows.append((url.replace("-lyrics", "-live-lyrics"), raw))
+    return pd.DataFrame(rows, columns=["url", "lyrics"])
+
+
+def make_queries(corpus:Dict[str, str], n_queries:int = 50, seed:int = 0) -> List[str]:
+    # a few consecutive words of random songs, so every query has relevant documents
+    rng = np.random.default_rng(seed)
+    titles = list(corpus)
+    queries = []
+    for index in rng.integers(0, len(titles), size=n_queries):
+        words = corpus[titles[index]].replace(".", "").split()
+        start = rng.integers(0, max(len(words) - 4, 1))
+        queries.append(" ".join(words[start:start + 4]))
+    return queries
+
+
+def timed(function:Callable, *args, **kwargs):
+    # (result, seconds) of one call, prints of the call are swallowed
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def best_time(function:Callable, *args, repeat:int = 3, **kwargs) -> float:
+    # fastest of a few runs, short measurements are noisy
+    return min(timed(function, *args, **kwargs)[1] for _ in range(repeat))
+
+
+def latency_metrics(name:str, run_one:Callable[[str], object], run_batch:Callable[[List[str]], object],
+                    queries:List[str]) -> Dict[str, dict]:
+    # p50/p95 of single queries and queries/sec of one batch with all queries, after one warm-up query
+    timed(run_one, queries[0])
+    latencies = np.array([timed(run_one, q)[1] for q in queries])
+    _, batch_seconds = timed(run_batch, queries)
+    return {
+        f"{name}_latency_p50": metric(1000 * np.percentile(latencies, 50), "ms", higher_is_better=False),
+        f"{name}_latency_p95": metric(1000 * np.percentile(latencies, 95), "ms", higher_is_better=False),
+        f"{name}_throughput": metric(len(queries) / batch_seconds, "queries/s"),
+    }
+
+
+def scraper_songs_per_sec(n_songs:int = 500, latency:float = 0.01, max_concurrency:int = 8, repeat:int = 3) -> float:
+    # AsyncGeniusScraper against the local genius stub, every request waits latency seconds, best of repeat runs
+    from src.async_scraper import AsyncGeniusScraper
+    from src.local_stubs import start_genius_stub
+
+    server, url = start_genius_stub(n_songs=n_songs, latency=latency)
+    try:
+        songs_per_sec = 0.0
+        for _ in range(repeat):
+            scraper = AsyncGeniusScraper("stub", max_concurrency=max_concurrency, requests_per_second=None,
+                                         api_base_url=url, web_base_url=url)
+            (lyrics, _), seconds = timed(asyncio.run, scraper.scrape_artist(1))
+            songs_per_sec = max(songs_per_sec, len(lyrics) / seconds)
+    finally:
+        server.shutdown()
+    return songs_per_sec
+
+
+def metric(value:float, unit:str, higher_is_better:bool = True) -> dict:
+    return {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def memory_metrics(prefix:str) -> Dict[str, dict]:
+    return {
+        f"{prefix}_rss": metric(current_rss_mb(), "MB", higher_is_better=False),
+        f"{prefix}_peak_rss": metric(peak_rss_mb(), "MB", higher_is_better=False),
+    }
+
+
+def run_metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_results(results:dict, results_dir:str = "benchmarks/results") -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{results['meta']['time'].replace(':', '-')}_{results['meta']['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def latest_results(results_dir:str = "benchmarks/results") -> str:
+    # the newest result file, file names start with the time of the run
+    paths = sorted(os.path.join(results_dir, name) for name in os.listdir(results_dir) if name.endswith(".json")) \
+        if os.path.isdir(results_dir) else []
+    return paths[-1] if paths else None
+
+
+def compare_results(baseline:dict, current:dict, tolerance:float = 0.2) -> List[dict]:
+    # relative change of every metric in both runs, a regression is a change in the wrong direction above tolerance
+    # only runs with the same parameters (corpus sizes, queries) are comparable, the caller checks meta["parameters"]
+    comparison = []
+    for name, result in current["metrics"].items():
+        if name not in baseline["metrics"] or not baseline["metrics"][name]["value"]:
+            continue
+        before = baseline["metrics"][name]["value"]
+        change = (result["value"] - before) / abs(before)
+        worse = -change if result["higher_is_better"] else change
+        comparison.append({"metric": name, "baseline": before, "current": result["value"], "unit": result["unit"],
+                           "change": change, "regression": worse > tolerance})
+    return comparison
+
+
+def print_comparison(comparison:List[dict]) -> None:
+    for row in comparison:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['metric']:<36}{row['baseline']:>12.2f}{row['current']:>12.2f} {row['unit']:<10}{100 * row['change']:>+8.1f}%  {flag}")
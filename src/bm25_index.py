@@ -0,0 +1,327 @@
+import math
+import threading
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component
+from haystack.document_stores.in_memory.document_store import BM25_SCALING_FACTOR
+from haystack.utils import expit
+
+from src.query_cache import CachedBM25Retriever, add_counts, filters_key
+
+# Inverted index for the BM25L scoring of InMemoryDocumentStore. Instead of scoring every document in python per query:
+# - postings (row and term frequency of every document a token occurs in) are kept in CSR arrays per block of documents,
+#   written documents get a new block, the blocks are merged once there are too many or half of the rows are deleted
+# - a query gathers the term frequencies of its candidates from the postings and scores them with numpy
+# - candidates are pruned MaxScore style: the documents of one query term give a threshold, tokens whose upper bound
+#   cannot lift a document above it (frequent words with a low idf, the long postings) are not scanned
+# idf, document count and average length come from the store at query time, every step does the float operations of
+# InMemoryDocumentStore._score_bm25l in the same order, so scores and ranking (ties in storage order) are the same.
+
+
+class PostingsBlock():
+    # postings of the rows one build or write added, term_id indexes indptr
+    def __init__(self, term_ids:array, rows:array, tfs:array, doc_len:np.ndarray, n_terms:int) -> None:
+        term_ids = np.frombuffer(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        self.rows = np.frombuffer(rows, dtype=np.int64)[order]
+        self.tfs = np.frombuffer(tfs, dtype=np.int64)[order].astype(np.float64)
+        counts = np.bincount(term_ids, minlength=n_terms)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)])
+        # per term the highest frequency and the shortest document, for the upper bound of its score
+        starts = self.indptr[:-1][counts > 0]
+        self.max_tf = np.zeros(n_terms)
+        self.min_len = np.full(n_terms, np.inf)
+        if len(starts):
+            self.max_tf[counts > 0] = np.maximum.reduceat(self.tfs, starts)
+            self.min_len[counts > 0] = np.minimum.reduceat(doc_len[self.rows], starts)
+
+    def postings(self, term_id:int) -> Tuple[np.ndarray, np.ndarray]:
+        if term_id + 1 >= len(self.indptr):
+            return self.rows[:0], self.tfs[:0]
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+    def term_bounds(self, term_id:int) -> Tuple[float, float]:
+        if term_id >= len(self.max_tf):
+            return 0.0, np.inf
+        return self.max_tf[term_id], self.min_len[term_id]
+
+
+class BM25Index():
+    def __init__(self, max_blocks:int = 8) -> None:
+        self.max_blocks = max_blocks
+        self.vocabulary: Dict[str, int] = {}
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.doc_len = np.zeros(0)
+        self.alive = np.zeros(0, dtype=bool)
+        # documents BM25 retrieval considers at all: with content (or a dataframe)
+        self.has_content = np.zeros(0, dtype=bool)
+        self.blocks: List[PostingsBlock] = []
+        self._dead = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _reset(self) -> None:
+        self.vocabulary = {}
+        self.ids = []
+        self.rows = {}
+        self.doc_len = np.zeros(0)
+        self.alive = np.zeros(0, dtype=bool)
+        self.has_content = np.zeros(0, dtype=bool)
+        self.blocks = []
+        self._dead = 0
+
+    def build(self, document_store) -> None:
+        # rows follow the order of the storage, the order InMemoryDocumentStore breaks ties in
+        self._reset()
+        self._add_block(document_store, list(document_store.storage.keys()))
+
+    def merge(self, document_store) -> None:
+        # one block for all live rows, deleted rows are dropped
+        live = [doc_id for doc_id in self.ids if doc_id is not None]
+        self._reset()
+        self._add_block(document_store, live)
+
+    def add(self, document_store, ids:List[str]) -> None:
+        # appends the documents as a new block, ids that are indexed already are replaced
+        # an id given twice gets one row, a second one would survive the removal of the document
+        ids = list(dict.fromkeys(ids))
+        self.remove([doc_id for doc_id in ids if doc_id in self.rows])
+        self._add_block(document_store, ids)
+        if len(self.blocks) > self.max_blocks or self.needs_merge():
+            self.merge(document_store)
+
+    def remove(self, ids:List[str]) -> None:
+        # rows are only marked as deleted, merge() drops them
+        for doc_id in ids:
+            row = self.rows.pop(doc_id, None)
+            if row is not None:
+                self.ids[row] = None
+                self.alive[row] = False
+                self._dead += 1
+
+    def needs_merge(self) -> bool:
+        return self._dead > 1024 and self._dead > len(self.ids) / 2
+
+    def _add_block(self, document_store, ids:List[str]) -> None:
+        if not ids:
+            return
+        start = len(self.ids)
+        self._reserve(start + len(ids))
+        with_content = _with_content(document_store, ids)
+        term_ids, rows, tfs = array("q"), array("q"), array("q")
+        for row, doc_id in enumerate(ids, start):
+            stats = document_store._bm25_attr[doc_id]
+            for token, tf in stats.freq_token.items():
+                term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                rows.append(row)
+                tfs.append(tf)
+            self.doc_len[row] = stats.doc_len
+            self.alive[row] = True
+            self.has_content[row] = doc_id in with_content
+            self.rows[doc_id] = row
+            self.ids.append(doc_id)
+        self.blocks.append(PostingsBlock(term_ids, rows, tfs, self.doc_len, len(self.vocabulary)))
+
+    def _reserve(self, rows:int) -> None:
+        if rows <= len(self.doc_len):
+            return
+        capacity = max(rows, 2 * len(self.doc_len), 1024)
+        grow = capacity - len(self.doc_len)
+        self.doc_len = np.concatenate([self.doc_len, np.zeros(grow)])
+        self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+        self.has_content = np.concatenate([self.has_content, np.zeros(grow, dtype=bool)])
+
+    def _term_frequencies(self, term_id:int, candidates:np.ndarray) -> np.ndarray:
+        # frequency of the term in each candidate row (sorted), 0 if it does not occur
+        tf = np.zeros(len(candidates))
+        for block in self.blocks:
+            rows, tfs = block.postings(term_id)
+            if not len(rows):
+                continue
+            positions = np.minimum(np.searchsorted(rows, candidates), len(rows) - 1)
+            match = rows[positions] == candidates
+            tf[match] = tfs[positions[match]]
+        return tf
+
+    def _score(self, candidates:np.ndarray, terms:List[Tuple[Optional[int], float]], k:float, b:float, delta:float,
+               avg_doc_len:float) -> np.ndarray:
+        # the loop of _score_bm25l, vectorized over the candidates
+        scores = np.zeros(len(candidates))
+        norm = 1 - b + b * self.doc_len[candidates] / avg_doc_len
+        for term_id, idf in terms:
+            tf = self._term_frequencies(term_id, candidates) if term_id is not None else np.zeros(len(candidates))
+            ctd = tf / norm
+            scores += idf * ((1.0 + k) * (ctd + delta) / (k + ctd + delta))
+        return scores
+
+    def _live_postings(self, term_id:int) -> np.ndarray:
+        rows = [block.postings(term_id)[0] for block in self.blocks]
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        return rows[self.alive[rows] & self.has_content[rows]]
+
+    def search(self, query_tokens:List[str], idf:Dict[str, float], top_k:int, k:float = 1.5, b:float = 0.75,
+               delta:float = 0.5, avg_doc_len:float = 1.0, stats:dict = None) -> List[Tuple[str, float]]:
+        # (id, score) of the top_k documents, sorted by score, ties in row order
+        # idf: {token: idf} in the order of the query tokens, as _score_bm25l computes it
+        terms = [(self.vocabulary.get(token), idf[token]) for token in idf]
+        # every document gets the score of a term frequency of 0 for all query tokens, matches add to it
+        zero_tf = (1.0 + k) * (0.0 + delta) / (k + 0.0 + delta)
+        base = 0.0
+        for _, term_idf in terms:
+            base += term_idf * zero_tf
+
+        matching = [(term_id, term_idf) for term_id, term_idf in terms if term_id is not None and term_idf > 0]
+        bounds = []
+        for term_id, term_idf in matching:
+            max_tf = max([block.term_bounds(term_id)[0] for block in self.blocks] or [0.0])
+            min_len = min([block.term_bounds(term_id)[1] for block in self.blocks] or [np.inf])
+            ctd = max_tf / (1 - b + b * min_len / avg_doc_len) if np.isfinite(min_len) else 0.0
+            bounds.append(term_idf * ((1.0 + k) * (ctd + delta) / (k + ctd + delta) - zero_tf))
+
+        # threshold: the top_k-th score among the documents of the term with the highest upper bound
+        threshold = -np.inf
+        pivot = np.zeros(0, dtype=np.int64)
+        if matching:
+            pivot = np.unique(self._live_postings(matching[int(np.argmax(bounds))][0]))
+            if len(pivot) >= top_k:
+                threshold = np.partition(self._score(pivot, terms, k, b, delta, avg_doc_len), len(pivot) - top_k)[len(pivot) - top_k]
+
+        # tokens are scanned from the highest upper bound down, the rest can only add less than the threshold
+        scanned = []
+        remaining = sum(bounds)
+        for i in np.argsort(bounds)[::-1]:
+            # a small margin against rounding, a tie at the threshold is never pruned
+            if base + remaining < threshold - 1e-9 * abs(threshold):
+                break
+            scanned.append(matching[i][0])
+            remaining -= bounds[i]
+        candidates = [pivot] + [self._live_postings(term_id) for term_id in scanned]
+        candidates = np.unique(np.concatenate(candidates))
+        if stats is not None:
+            add_counts(stats, queries=1, scored_documents=len(candidates), skipped_tokens=len(matching) - len(scanned))
+
+        scores = self._score(candidates, terms, k, b, delta, avg_doc_len)
+        order = np.lexsort((candidates, -scores))[:top_k]
+        results = [(self.ids[candidates[i]], float(scores[i])) for i in order]
+        if len(results) < top_k:
+            # documents without any query token all have the base score, in storage order behind the matches
+            others = np.flatnonzero(self.alive[:len(self.ids)] & self.has_content[:len(self.ids)])
+            others = others[~np.isin(others, candidates)][:top_k - len(results)]
+            results += [(self.ids[row], base) for row in others]
+        return results
+
+
+def _with_content(document_store, ids:List[str]) -> set:
+    storage = document_store.storage
+    if hasattr(storage, "content_ids") and len(ids) > 1000:
+        # a compact storage knows it without building the documents (see src/compact_store.py)
+        return set(storage.content_ids())
+    documents = (storage[doc_id] for doc_id in ids)
+    return {doc.id for doc in documents if doc.content is not None or doc.dataframe is not None}
+
+
+@component
+class IndexedBM25Retriever(CachedBM25Retriever):
+    """
+    CachedBM25Retriever that scores queries with an inverted index instead of scoring every document in python.
+
+    Returns the same documents in the same order as InMemoryBM25Retriever for the default BM25L algorithm,
+    filtered queries and the other algorithms use the document store. The index follows the store like
+    ANNEmbeddingRetriever: it is rebuilt when the store changed, `update()` applies a known change incrementally.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        CachedBM25Retriever.__init__(self, *args, **kwargs)
+        self.index = BM25Index()
+        self._indexed_version = None
+        # queries, documents scored and query tokens skipped by the pruning
+        self.stats = {}
+        # the request threads of server.py share the index: syncs, updates and searches of the index take turns
+        self._lock = threading.RLock()
+
+    def sync(self) -> None:
+        with self._lock:
+            self.index.build(self.document_store)
+            self._indexed_version = getattr(self.document_store, "version", None)
+
+    def update(self, added:List[str], removed:List[str], since_version:Optional[int] = None) -> None:
+        # cost proportional to the change, any other change since since_version means a rebuild
+        with self._lock:
+            if self._indexed_version is None or since_version is None or since_version != self._indexed_version:
+                self.sync()
+                return
+            self.index.remove(list(removed) + list(added))
+            self.index.add(self.document_store, [doc_id for doc_id in added if doc_id in self.document_store.storage])
+            self._indexed_version = getattr(self.document_store, "version", None)
+
+    def _needs_sync(self) -> bool:
+        version = getattr(self.document_store, "version", None)
+        if version is not None:
+            return version != self._indexed_version
+        return len(self.index) != len(self.document_store.storage)
+
+    def search(self, query:str, top_k:int, scale_score:bool = False) -> List[Document]:
+        store = self.document_store
+        if not query:
+            raise ValueError("Query should be a non-empty string")
+        if not store._bm25_attr or not store._avg_doc_len:
+            return []
+        with self._lock:
+            if self._needs_sync():
+                self.sync()
+            # idf per query token exactly as _score_bm25l computes it
+            n_corpus = len(store._bm25_attr)
+            idf = {}
+            for token in store._tokenize_bm25(query):
+                n = store._freq_vocab_for_idf.get(token, 0)
+                idf[token] = math.log((n_corpus + 1.0) / (n + 0.5)) * int(n != 0)
+            parameters = store.bm25_parameters
+            results = self.index.search(list(idf), idf, top_k, k=parameters.get("k1", 1.5), b=parameters.get("b", 0.75),
+                                        delta=parameters.get("delta", 0.5), avg_doc_len=store._avg_doc_len, stats=self.stats)
+
+        documents = []
+        for doc_id, score in results:
+            if scale_score:
+                score = expit(score / BM25_SCALING_FACTOR)
+            if score <= 0.0:
+                continue
+            doc_fields = store.storage[doc_id].to_dict()
+            doc_fields["score"] = score
+            documents.append(Document.from_dict(doc_fields))
+        return documents
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query:str,
+        filters:Optional[Dict[str, Any]] = None,
+        top_k:Optional[int] = None,
+        scale_score:Optional[bool] = None,
+    ):
+        """
+        Retrieves the Documents with the highest BM25 score.
+
+        :param query: The query string.
+        :param filters: Filters to narrow down the search space, filtered queries are scored by the document store.
+        :param top_k: The maximum number of Documents to return.
+        :param scale_score: Scales the BM25 score to the range of 0 to 1.
+        :returns: A dictionary with the retrieved `documents`.
+        """
+        filters = filters if filters is not None else self.filters
+        if filters or self.document_store.bm25_algorithm != "BM25L":
+            return CachedBM25Retriever.run(self, query, filters, top_k, scale_score)
+        self.cache.document_store = self.document_store
+        top_k = top_k or self.top_k
+        scale_score = scale_score if scale_score is not None else self.scale_score
+        key = (tuple(self.document_store._tokenize_bm25(query)), filters_key(filters), top_k, scale_score)
+        version = self.cache.current_version()
+        documents = self.cache.get(key)
+        if documents is None:
+            documents = self.search(query, top_k, scale_score)
+            self.cache.put(key, documents, version)
+        return {"documents": documents}
@@ -0,0 +1,52 @@
+from typing import List
+
+from haystack import Document
+from haystack.components.preprocessors import DocumentSplitter
+
+# Songs are split into passages of a few sentences before embedding. clean_up_lyrics replaces tags like [Chorus]
+# with '.', so the sentence split of DocumentSplitter also cuts at verse and chorus boundaries.
+# Every passage keeps the meta of its song (title) plus source_id (id of the whole song) and split_id,
+# at query time the passages are aggregated back to one result per song.
+
+
+def split_songs(documents:List[Document], split_length:int = 4, split_overlap:int = 1, split_threshold:int = 2) -> List[Document]:
+    # sliding window of split_length sentences that overlaps by split_overlap sentences,
+    # a rest shorter than split_threshold sentences is added to the previous passage
+    splitter = DocumentSplitter(split_by="sentence", split_length=split_length, split_overlap=split_overlap,
+                                split_threshold=split_threshold)
+    passages = []
+    for document in documents:
+        for split_id, passage in enumerate(splitter.run([document])["documents"]):
+            meta = {key: value for key, value in passage.meta.items() if key != "page_number"}
+            # a chorus repeats, the split_id keeps the ids of passages with the same text unique
+            meta["split_id"] = split_id
+            passages.append(Document(content=passage.content.strip(), meta=meta))
+    return passages
+
+
+def documents_per_song(documents:List[Document], top_k:int = None) -> List[Document]:
+    # the best passage of every song in the order of the input (retrievers and the ranker sort by score),
+    # the passage keeps its content, so the caller sees which part of the song matched
+    best = {}
+    for position, document in enumerate(documents):
+        title = document.meta.get("title", document.id)
+        if title not in best or (document.score or 0) > (best[title][1].score or 0):
+            best[title] = (position, document)
+    songs = [document for _, document in sorted(best.values(), key=lambda entry: entry[0])]
+    return songs[:top_k] if top_k else songs
+
+
+def answers_per_song(answers:list, top_k:int = None) -> list:
+    # overlapping passages find the same answer more than once, only the best one per song and text is kept,
+    # the answer without a document (no answer in any passage) stays last
+    seen = set()
+    unique_answers = []
+    for answer in answers:
+        if answer.document is None:
+            continue
+        key = (answer.document.meta.get("title"), answer.data)
+        if key not in seen:
+            seen.add(key)
+            unique_answers.append(answer)
+    unique_answers = unique_answers[:top_k] if top_k else unique_answers
+    return unique_answers + [answer for answer in answers if answer.document is None]
@@ -0,0 +1,526 @@
+import sys
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Mapping, MutableMapping
+from dataclasses import replace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document
+from haystack.document_stores.errors import DocumentStoreError
+from haystack.document_stores.in_memory.document_store import BM25_SCALING_FACTOR, DOT_PRODUCT_SCALING_FACTOR, BM25DocumentStats
+from haystack.utils import expit
+
+from src.versioned_store import VersionedInMemoryDocumentStore
+
+# Compact corpus layer for millions of passages in one process. Instead of one Document per passage with a list
+# of floats as embedding, the storage keeps
+# - all contents in one utf-8 buffer, a row is an offset and a length into it
+# - meta as a shared tuple of keys plus a tuple of interned values, identical titles exist only once
+# - all embeddings in one float32 (or float16) matrix, for cosine stores the rows are normalized and the norms kept
+# Documents are only created for the hits a retrieval returns. Deleted rows are marked and compacted later.
+# Documents with a dataframe, blob, sparse embedding or score are kept as they are, they are rare in this repo.
+# The BM25 statistics (_bm25_attr of the store) are flat too: the term frequencies of all documents in two int32
+# arrays, a document is a slice of them sorted by term id, instead of one Counter per document.
+
+EMBEDDING_DTYPES = {"float32": np.float32, "float16": np.float16}
+META_SCALARS = (str, int, float, bool, type(None))
+
+# BM25 only needs the id of a document, so candidates do not have to be materialized
+DocumentRef = namedtuple("DocumentRef", "id")
+
+
+def matrix_scores(query_embeddings:np.ndarray, matrix:np.ndarray, chunk_rows:int = 65536) -> np.ndarray:
+    # query_embeddings @ matrix.T in float32, a float16 matrix is converted chunk by chunk instead of all at once
+    if matrix.dtype == np.float32:
+        return query_embeddings @ matrix.T
+    scores = np.empty((len(query_embeddings), len(matrix)), dtype=np.float32)
+    for start in range(0, len(matrix), chunk_rows):
+        scores[:, start:start + chunk_rows] = query_embeddings @ matrix[start:start + chunk_rows].astype(np.float32).T
+    return scores
+
+
+class TermFrequencies(Mapping):
+    # read-only {token: frequency} of one document of CompactBM25Stats, the freq_token of BM25DocumentStats.
+    # A view of the arrays: it is only valid until the next compaction, pop() returns a copy instead.
+    def __init__(self, stats:"CompactBM25Stats", row:int) -> None:
+        self._stats = stats
+        self._start = stats._starts[row]
+        self._end = self._start + stats._counts[row]
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def __iter__(self) -> Iterator[str]:
+        tokens, term_ids = self._stats.tokens, self._stats._term_ids
+        return (tokens[term_ids[i]] for i in range(self._start, self._end))
+
+    def __getitem__(self, token:str) -> int:
+        term_id = self._stats.vocabulary.get(token)
+        if term_id is not None:
+            i = bisect_left(self._stats._term_ids, term_id, self._start, self._end)
+            if i < self._end and self._stats._term_ids[i] == term_id:
+                return self._stats._tfs[i]
+        raise KeyError(token)
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        tokens, term_ids, tfs = self._stats.tokens, self._stats._term_ids, self._stats._tfs
+        return ((tokens[term_ids[i]], tfs[i]) for i in range(self._start, self._end))
+
+
+class CompactBM25Stats(MutableMapping):
+    # drop-in for the _bm25_attr dict of InMemoryDocumentStore: {id: BM25DocumentStats}, the stats are views on access
+    def __init__(self) -> None:
+        self.vocabulary: Dict[str, int] = {}
+        self.tokens: List[str] = []
+        self._row: Dict[str, int] = {}
+        # id per row, None for deleted rows
+        self._ids: List[Optional[str]] = []
+        self._starts = array("q")
+        self._counts = array("i")
+        self._doc_lens = array("q")
+        self._term_ids = array("i")
+        self._tfs = array("i")
+        self._dead = 0
+
+    def __len__(self) -> int:
+        return len(self._row)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._row
+
+    def __iter__(self) -> Iterator[str]:
+        return (doc_id for doc_id in self._ids if doc_id is not None)
+
+    def __getitem__(self, doc_id:str) -> BM25DocumentStats:
+        row = self._row[doc_id]
+        return BM25DocumentStats(TermFrequencies(self, row), self._doc_lens[row])
+
+    def __setitem__(self, doc_id:str, stats:BM25DocumentStats) -> None:
+        if doc_id in self._row:
+            del self[doc_id]
+        entries = []
+        for token, tf in stats.freq_token.items():
+            term_id = self.vocabulary.get(token)
+            if term_id is None:
+                token = sys.intern(token)
+                term_id = self.vocabulary[token] = len(self.tokens)
+                self.tokens.append(token)
+            entries.append((term_id, tf))
+        entries.sort()
+        self._row[doc_id] = len(self._ids)
+        self._ids.append(doc_id)
+        self._starts.append(len(self._term_ids))
+        self._counts.append(len(entries))
+        self._doc_lens.append(stats.doc_len)
+        self._term_ids.extend(term_id for term_id, _ in entries)
+        self._tfs.extend(tf for _, tf in entries)
+
+    def __delitem__(self, doc_id:str) -> None:
+        row = self._row.pop(doc_id)
+        self._ids[row] = None
+        self._dead += 1
+        if self._dead > 1024 and self._dead > len(self._ids) / 2:
+            self.compact()
+
+    def pop(self, doc_id:str, *default) -> BM25DocumentStats:
+        # a copy, the view of a deleted row would not survive the compaction the deletion may trigger
+        if doc_id not in self._row:
+            if default:
+                return default[0]
+            raise KeyError(doc_id)
+        stats = self[doc_id]
+        stats = BM25DocumentStats(dict(stats.freq_token.items()), stats.doc_len)
+        del self[doc_id]
+        return stats
+
+    def compact(self) -> None:
+        live = [row for row, doc_id in enumerate(self._ids) if doc_id is not None]
+        term_ids, tfs, starts = array("i"), array("i"), array("q")
+        for row in live:
+            start, end = self._starts[row], self._starts[row] + self._counts[row]
+            starts.append(len(term_ids))
+            term_ids.extend(self._term_ids[start:end])
+            tfs.extend(self._tfs[start:end])
+        self._term_ids, self._tfs, self._starts = term_ids, tfs, starts
+        self._counts = array("i", (self._counts[row] for row in live))
+        self._doc_lens = array("q", (self._doc_lens[row] for row in live))
+        self._ids = [self._ids[row] for row in live]
+        self._row = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        self._dead = 0
+
+    def to_snapshot(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        arrays = {
+            "bm25_starts": np.frombuffer(self._starts, dtype=np.int64),
+            "bm25_counts": np.frombuffer(self._counts, dtype=np.int32),
+            "bm25_doc_lens": np.frombuffer(self._doc_lens, dtype=np.int64),
+            "bm25_term_ids": np.frombuffer(self._term_ids, dtype=np.int32),
+            "bm25_tfs": np.frombuffer(self._tfs, dtype=np.int32),
+        }
+        return arrays, {"ids": self._ids, "tokens": self.tokens}
+
+    @classmethod
+    def from_snapshot(cls, arrays:Dict[str, np.ndarray], state:Dict[str, Any]) -> "CompactBM25Stats":
+        stats = cls()
+        stats.tokens = [sys.intern(token) for token in state["tokens"]]
+        stats.vocabulary = {token: i for i, token in enumerate(stats.tokens)}
+        stats._ids = state["ids"]
+        stats._row = {doc_id: row for row, doc_id in enumerate(stats._ids) if doc_id is not None}
+        stats._dead = len(stats._ids) - len(stats._row)
+        for name in ("starts", "counts", "doc_lens", "term_ids", "tfs"):
+            setattr(stats, f"_{name}", array(getattr(stats, f"_{name}").typecode, arrays[f"bm25_{name}"].tobytes()))
+        return stats
+
+    def memory_usage(self) -> int:
+        # bytes of the arrays, the vocabulary and the ids come on top
+        return sum(len(a) * a.itemsize for a in (self._starts, self._counts, self._doc_lens, self._term_ids, self._tfs))
+
+
+class CompactStorage(MutableMapping):
+    # drop-in for the storage dict of InMemoryDocumentStore: {id: Document}, but the Documents are built on access
+    def __init__(self, normalize:bool = False, embedding_dtype:str = "float32") -> None:
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{embedding_dtype}', choose one of {list(EMBEDDING_DTYPES)}")
+        self.normalize = normalize
+        self.embedding_dtype = embedding_dtype
+        self._row: Dict[str, int] = {}
+        # id per row, None for deleted rows
+        self._ids: List[Optional[str]] = []
+        self._text = bytearray()
+        self._offsets = array("q")
+        # -1 for a document without content
+        self._lengths = array("q")
+        self._meta_keys: Dict[Tuple[str, ...], int] = {}
+        self._meta_key_list: List[Tuple[str, ...]] = []
+        self._meta_key_rows = array("l")
+        self._meta_values: List[tuple] = []
+        # a revision per row that survives compaction, indexes on top of the store diff against it
+        self._revisions = array("q")
+        self._next_revision = 0
+        self._matrix = None
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._has_embedding = np.zeros(0, dtype=bool)
+        self._dead = 0
+        self.extra: Dict[str, Document] = {}
+
+    def __len__(self) -> int:
+        return len(self._row) + len(self.extra)
+
+    def __contains__(self, doc_id) -> bool:
+        # the default of Mapping would build the Document
+        return doc_id in self._row or doc_id in self.extra
+
+    def __iter__(self) -> Iterator[str]:
+        for doc_id in self._ids:
+            if doc_id is not None:
+                yield doc_id
+        yield from list(self.extra)
+
+    def __getitem__(self, doc_id:str) -> Document:
+        return self.get_document(doc_id)
+
+    def get_document(self, doc_id:str, return_embedding:bool = True) -> Document:
+        if doc_id in self.extra:
+            return self.extra[doc_id] if return_embedding else replace(self.extra[doc_id], embedding=None)
+        row = self._row[doc_id]
+        embedding = self._embedding(row).tolist() if return_embedding and self._row_has_embedding(row) else None
+        return Document(id=doc_id, content=self._content(row), meta=self._meta(row), embedding=embedding)
+
+    def _content(self, row:int) -> Optional[str]:
+        if self._lengths[row] < 0:
+            return None
+        offset = self._offsets[row]
+        return self._text[offset:offset + self._lengths[row]].decode("utf-8")
+
+    def _meta(self, row:int) -> Dict[str, Any]:
+        # a new dict per Document, callers may change it
+        return dict(zip(self._meta_key_list[self._meta_key_rows[row]], self._meta_values[row]))
+
+    def _embedding(self, row:int) -> np.ndarray:
+        embedding = self._matrix[row].astype(np.float32)
+        return embedding * self._norms[row] if self.normalize else embedding
+
+    def embedding(self, doc_id:str) -> Optional[np.ndarray]:
+        if doc_id in self.extra:
+            embedding = self.extra[doc_id].embedding
+            return None if embedding is None else np.asarray(embedding, dtype=np.float32)
+        row = self._row[doc_id]
+        return self._embedding(row) if self._row_has_embedding(row) else None
+
+    def _is_compact(self, document:Document) -> bool:
+        if document.dataframe is not None or document.blob is not None or document.sparse_embedding is not None:
+            return False
+        if document.score is not None:
+            return False
+        return all(isinstance(value, META_SCALARS) for value in document.meta.values())
+
+    def __setitem__(self, doc_id:str, document:Document) -> None:
+        if doc_id in self:
+            del self[doc_id]
+        if not self._is_compact(document):
+            self.extra[doc_id] = document
+            return
+        row = len(self._ids)
+        if document.embedding is not None:
+            self._set_embedding(row, document.embedding)
+        self._ids.append(doc_id)
+        self._row[doc_id] = row
+
+        content = document.content.encode("utf-8") if document.content is not None else None
+        self._offsets.append(len(self._text))
+        self._lengths.append(len(content) if content is not None else -1)
+        self._text += content or b""
+
+        keys = tuple(sys.intern(key) for key in document.meta)
+        if keys not in self._meta_keys:
+            self._meta_keys[keys] = len(self._meta_key_list)
+            self._meta_key_list.append(keys)
+        self._meta_key_rows.append(self._meta_keys[keys])
+        self._meta_values.append(tuple(sys.intern(v) if isinstance(v, str) else v for v in document.meta.values()))
+
+        self._revisions.append(self._next_revision)
+        self._next_revision += 1
+
+    def _set_embedding(self, row:int, embedding) -> None:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self._matrix is None:
+            self._matrix = np.zeros((0, len(vector)), dtype=EMBEDDING_DTYPES[self.embedding_dtype])
+        if len(vector) != self._matrix.shape[1]:
+            raise DocumentStoreError(
+                f"The embedding size of all Documents should be the same, got {len(vector)} instead of {self._matrix.shape[1]}. "
+                "Please make sure that the Documents have been embedded with the same model."
+            )
+        self._reserve(row + 1)
+        norm = np.linalg.norm(vector)
+        self._matrix[row] = vector / norm if self.normalize and norm > 0 else vector
+        self._norms[row] = norm
+        self._has_embedding[row] = True
+
+    def _reserve(self, rows:int) -> None:
+        # matrix, norms and mask grow together by doubling, so appending a row is amortized O(1)
+        if rows <= len(self._matrix):
+            return
+        capacity = max(rows, 2 * len(self._matrix), 1024)
+        matrix = np.zeros((capacity, self._matrix.shape[1]), dtype=self._matrix.dtype)
+        matrix[:len(self._matrix)] = self._matrix
+        self._matrix = matrix
+        self._norms = np.concatenate([self._norms, np.zeros(capacity - len(self._norms), dtype=np.float32)])
+        self._has_embedding = np.concatenate([self._has_embedding, np.zeros(capacity - len(self._has_embedding), dtype=bool)])
+
+    def _row_has_embedding(self, row:int) -> bool:
+        # rows behind the capacity of the matrix were written without embedding
+        return row < len(self._has_embedding) and bool(self._has_embedding[row])
+
+    def __delitem__(self, doc_id:str) -> None:
+        if doc_id in self.extra:
+            del self.extra[doc_id]
+            return
+        row = self._row.pop(doc_id)
+        self._ids[row] = None
+        if self._row_has_embedding(row):
+            self._has_embedding[row] = False
+        self._meta_values[row] = ()
+        self._dead += 1
+        # the space of deleted rows is given back once they are the majority
+        if self._dead > 1024 and self._dead > len(self._ids) / 2:
+            self.compact()
+
+    def compact(self) -> None:
+        # rewrites buffer, matrix and row arrays without the deleted rows, revisions stay the same
+        live = [row for row, doc_id in enumerate(self._ids) if doc_id is not None]
+        text = bytearray()
+        offsets = array("q")
+        for row in live:
+            offsets.append(len(text))
+            if self._lengths[row] > 0:
+                text += self._text[self._offsets[row]:self._offsets[row] + self._lengths[row]]
+        self._text = text
+        self._offsets = offsets
+        self._lengths = array("q", (self._lengths[row] for row in live))
+        self._meta_key_rows = array("l", (self._meta_key_rows[row] for row in live))
+        self._meta_values = [self._meta_values[row] for row in live]
+        self._revisions = array("q", (self._revisions[row] for row in live))
+        self._ids = [self._ids[row] for row in live]
+        self._row = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        if self._matrix is not None:
+            rows = np.asarray(live, dtype=np.int64)
+            rows = rows[rows < len(self._matrix)]
+            self._matrix = self._matrix[rows]
+            self._norms = self._norms[rows]
+            self._has_embedding = self._has_embedding[rows]
+        self._dead = 0
+
+    def embedding_matrix(self) -> Tuple[List[str], np.ndarray]:
+        # ids and embeddings of all documents with an embedding, ready for a dot product (normalized for cosine).
+        # Without deleted rows or rows without embedding the matrix is a view, not a copy.
+        if self._matrix is None and not self.extra:
+            return [], np.zeros((0, 0), dtype=np.float32)
+        n_rows = len(self._ids)
+        has_embedding = self._has_embedding[:n_rows]
+        if self._matrix is not None and has_embedding.all() and len(has_embedding) == n_rows:
+            ids, matrix = list(self._ids), self._matrix[:n_rows]
+        elif self._matrix is not None:
+            rows = np.flatnonzero(has_embedding)
+            ids, matrix = [self._ids[row] for row in rows], self._matrix[rows]
+        else:
+            ids, matrix = [], None
+        extra = [(doc_id, doc.embedding) for doc_id, doc in self.extra.items() if doc.embedding is not None]
+        if extra:
+            vectors = np.asarray([embedding for _, embedding in extra], dtype=np.float32)
+            if self.normalize:
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            matrix = vectors if matrix is None else np.concatenate([matrix.astype(np.float32), vectors])
+            ids = ids + [doc_id for doc_id, _ in extra]
+        return ids, matrix
+
+    def meta_items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # (id, meta) of every document without decoding contents or embeddings
+        for row, doc_id in enumerate(self._ids):
+            if doc_id is not None:
+                yield doc_id, self._meta(row)
+        for doc_id, doc in list(self.extra.items()):
+            yield doc_id, doc.meta
+
+    def revision(self, doc_id:str) -> int:
+        return -id(self.extra[doc_id]) if doc_id in self.extra else self._revisions[self._row[doc_id]]
+
+    def revisions(self) -> Dict[str, int]:
+        # {id: revision} of the documents with an embedding, an overwritten document gets a new revision
+        revisions = {self._ids[row]: self._revisions[row] for row in np.flatnonzero(self._has_embedding[:len(self._ids)])}
+        revisions.update({doc_id: -id(doc) for doc_id, doc in self.extra.items() if doc.embedding is not None})
+        return revisions
+
+    def content_ids(self) -> List[str]:
+        # documents BM25 can score, the ones with content (or a dataframe)
+        ids = [doc_id for doc_id, length in zip(self._ids, self._lengths) if doc_id is not None and length >= 0]
+        return ids + [doc_id for doc_id, doc in self.extra.items() if doc.content is not None or doc.dataframe is not None]
+
+    def to_snapshot(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        # the buffers as arrays plus a json part for ids, meta and the documents in extra, see store_snapshot.py
+        n_rows = len(self._ids)
+        arrays = {
+            "text": np.frombuffer(self._text, dtype=np.uint8),
+            "offsets": np.frombuffer(self._offsets, dtype=np.int64),
+            "lengths": np.frombuffer(self._lengths, dtype=np.int64),
+            "meta_key_rows": np.asarray(self._meta_key_rows, dtype=np.int64),
+            "norms": self._norms[:n_rows],
+            "has_embedding": self._has_embedding[:n_rows],
+        }
+        if self._matrix is not None:
+            arrays["embeddings"] = self._matrix[:n_rows]
+        state = {
+            "embedding_dtype": self.embedding_dtype,
+            "ids": self._ids,
+            "meta_keys": self._meta_key_list,
+            "meta_values": self._meta_values,
+            "extra": [doc.to_dict(flatten=False) for doc in self.extra.values()],
+        }
+        return arrays, state
+
+    @classmethod
+    def from_snapshot(cls, arrays:Dict[str, np.ndarray], state:Dict[str, Any], normalize:bool = False,
+                      embedding_dtype:str = None) -> "CompactStorage":
+        # the embeddings array is used as the matrix as it is, e.g. a memory map of the snapshot file,
+        # only a different embedding_dtype makes a converted copy; new rows copy the matrix once it has to grow
+        storage = cls(normalize=normalize, embedding_dtype=embedding_dtype or state["embedding_dtype"])
+        storage._ids = state["ids"]
+        storage._row = {doc_id: row for row, doc_id in enumerate(storage._ids) if doc_id is not None}
+        storage._dead = len(storage._ids) - len(storage._row)
+        storage._text = bytearray(arrays["text"])
+        storage._offsets = array("q", arrays["offsets"].tobytes())
+        storage._lengths = array("q", arrays["lengths"].tobytes())
+        storage._meta_key_list = [tuple(sys.intern(key) for key in keys) for keys in state["meta_keys"]]
+        storage._meta_keys = {keys: i for i, keys in enumerate(storage._meta_key_list)}
+        storage._meta_key_rows = array("l", arrays["meta_key_rows"].tolist())
+        storage._meta_values = [tuple(sys.intern(v) if isinstance(v, str) else v for v in values) for values in state["meta_values"]]
+        storage._revisions = array("q", range(len(storage._ids)))
+        storage._next_revision = len(storage._ids)
+        if "embeddings" in arrays:
+            matrix = arrays["embeddings"]
+            dtype = EMBEDDING_DTYPES[storage.embedding_dtype]
+            storage._matrix = matrix if matrix.dtype == dtype else matrix.astype(dtype)
+            storage._norms = np.array(arrays["norms"], dtype=np.float32)
+            storage._has_embedding = np.array(arrays["has_embedding"], dtype=bool)
+        storage.extra = {data["id"]: Document.from_dict(data) for data in state["extra"]}
+        return storage
+
+    def memory_usage(self) -> Dict[str, int]:
+        # bytes of the main buffers, the id strings and meta tuples come on top
+        n_rows = len(self._ids)
+        return {
+            "documents": len(self),
+            "deleted_rows": self._dead,
+            "text_bytes": len(self._text),
+            "embedding_bytes": 0 if self._matrix is None else self._matrix[:n_rows].nbytes,
+            "row_bytes": (self._offsets.itemsize + self._lengths.itemsize + self._revisions.itemsize + self._meta_key_rows.itemsize) * n_rows,
+        }
+
+
+class CompactDocumentStore(VersionedInMemoryDocumentStore):
+    """
+    VersionedInMemoryDocumentStore that keeps its documents in a CompactStorage and its BM25 statistics in CompactBM25Stats.
+
+    Retrieval without filters scores the embedding matrix (or the BM25 statistics) directly and only builds Documents
+    for the top_k hits. Filtered retrieval uses the InMemoryDocumentStore implementation, which builds every Document.
+    The embedding dtype is not part of `to_dict()`, a deserialized store is a plain InMemoryDocumentStore.
+    """
+
+    def __init__(self, *args, embedding_dtype:str = "float32", **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.embedding_dtype = embedding_dtype
+        self.storage = CompactStorage(normalize=self.embedding_similarity_function == "cosine", embedding_dtype=embedding_dtype)
+        self._bm25_attr = CompactBM25Stats()
+
+    def memory_usage(self) -> Dict[str, int]:
+        return {**self.storage.memory_usage(), "bm25_bytes": self._bm25_attr.memory_usage()}
+
+    def bm25_retrieval(self, query:str, filters:Optional[Dict[str, Any]] = None, top_k:int = 10, scale_score:bool = False) -> List[Document]:
+        if filters:
+            return super().bm25_retrieval(query, filters=filters, top_k=top_k, scale_score=scale_score)
+        if not query:
+            raise ValueError("Query should be a non-empty string")
+        candidates = [DocumentRef(doc_id) for doc_id in self.storage.content_ids()]
+        if not candidates:
+            return []
+        results = sorted(self.bm25_algorithm_inst(query, candidates), key=lambda x: x[1], reverse=True)[:top_k]
+        negatives_are_valid = self.bm25_algorithm == "BM25Okapi" and not scale_score
+        documents = []
+        for ref, score in results:
+            if scale_score:
+                score = expit(score / BM25_SCALING_FACTOR)
+            if not negatives_are_valid and score <= 0.0:
+                continue
+            documents.append(replace(self.storage[ref.id], score=score))
+        return documents
+
+    def embedding_retrieval(self, query_embedding:List[float], filters:Optional[Dict[str, Any]] = None, top_k:int = 10,
+                            scale_score:bool = False, return_embedding:bool = False) -> List[Document]:
+        if filters:
+            return super().embedding_retrieval(query_embedding, filters=filters, top_k=top_k, scale_score=scale_score,
+                                               return_embedding=return_embedding)
+        if len(query_embedding) == 0 or not isinstance(query_embedding[0], float):
+            raise ValueError("query_embedding should be a non-empty list of floats.")
+        ids, matrix = self.storage.embedding_matrix()
+        if not ids:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        if query.shape[1] != matrix.shape[1]:
+            raise DocumentStoreError(
+                "The embedding size of the query should be the same as the embedding size of the Documents. "
+                "Please make sure that the query has been embedded with the same model as the Documents."
+            )
+        if self.embedding_similarity_function == "cosine":
+            query /= np.linalg.norm(query)
+        scores = matrix_scores(query, matrix)[0]
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        documents = []
+        for i in best:
+            score = float(scores[i])
+            if scale_score:
+                score = (score + 1) / 2 if self.embedding_similarity_function == "cosine" else expit(score / DOT_PRODUCT_SCALING_FACTOR)
+            documents.append(replace(self.storage.get_document(ids[i], return_embedding), score=score))
+        return documents
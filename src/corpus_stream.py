@@ -0,0 +1,96 @@
+import os
+import json
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+# Streaming reads and writes of song corpora, so preprocessing and indexing only hold one batch of songs at a time.
+# Two formats:
+#   .jsonl  one {"title": ..., "lyrics": ...} record per line, written by preprocess.py
+#   .json   the flat {title: lyrics} (or {url: lyrics}) object of the scraper and older preprocessed files,
+#           decoded incrementally from fixed-size chunks of the file instead of json.load
+
+
+def batched(iterable:Iterable, batch_size:int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_json_lines(path:str) -> Iterator[dict]:
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_json_lines(records:Iterable[dict], path:str) -> int:
+    # writes to a temporary file first, a crash never leaves a half-written corpus behind; returns the number of records
+    tmp_path = f"{path}.tmp"
+    n_records = 0
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            n_records += 1
+    os.replace(tmp_path, path)
+    return n_records
+
+
+def iter_json_object(path:str, chunk_size:int = 1 << 20) -> Iterator[Tuple[str, object]]:
+    # (key, value) pairs of a top-level json object, only about one chunk of the file is in memory
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer, pos, eof = "", 0, False
+        expect, key = "{", None
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"{path}: unexpected end of the json object")
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+                continue
+            char = buffer[pos]
+            if char == "}" and expect in ("key", ","):
+                return
+            if expect in ("key", "value"):
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    value, end = None, None
+                # a value cut off at the end of the chunk (or a number that might go on) needs the next chunk
+                if end is None or (end == len(buffer) and not eof):
+                    if eof:
+                        raise ValueError(f"{path}: invalid json value")
+                    chunk = f.read(chunk_size)
+                    eof = not chunk
+                    buffer, pos = buffer[pos:] + chunk, 0
+                    continue
+                pos = end
+                if expect == "key":
+                    if not isinstance(value, str):
+                        raise ValueError(f"{path}: object keys must be strings, got {value!r}")
+                    key, expect = value, ":"
+                else:
+                    yield key, value
+                    expect = ","
+            elif char == expect:
+                pos += 1
+                expect = "value" if expect == ":" else "key"
+            else:
+                raise ValueError(f"{path}: expected '{expect}' but found '{char}'")
+            # drop the consumed part of the buffer
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def iter_songs(path:str) -> Iterator[Tuple[str, str]]:
+    # (title, lyrics) of a .jsonl corpus or a flat .json object
+    if path.endswith(".jsonl"):
+        for record in iter_json_lines(path):
+            yield record["title"], record["lyrics"]
+    else:
+        yield from iter_json_object(path)
@@ -0,0 +1,206 @@
+import re
+import zlib
+from array import array
+from collections import Counter, defaultdict
+from itertools import combinations
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Near-duplicate detection for songs: a normalized title index catches renamed variants,
+# MinHash/LSH over word shingles of the lyrics catches re-uploads under a different title.
+# Candidate pairs are verified with the exact Jaccard similarity and merged with union-find.
+
+# words that mark a variant of a song, the title is cut from the first marker on ("basket case live at woodstock")
+VARIANT_MARKERS = {
+    "live", "demo", "acoustic", "remaster", "remastered", "version", "edit", "mix", "remix", "mono", "stereo",
+    "instrumental", "session", "sessions", "explicit", "alternate", "unplugged", "rehearsal",
+}
+WORD_PATTERN = re.compile(r'\w+')
+
+# Mersenne prime for the universal hash family, (a * x + b) stays below 2^63 for 32-bit x and a < 2^31
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_title(title: str) -> str:
+    words = WORD_PATTERN.findall(title.lower())
+    for i, word in enumerate(words):
+        # a marker as first word is part of the title itself
+        if i > 0 and word in VARIANT_MARKERS:
+            words = words[:i]
+            break
+    return " ".join(words)
+
+
+def shingles(text: str, size: int = 3) -> Set[int]:
+    # word shingles hashed with crc32, stable across runs unlike hash()
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {zlib.crc32(" ".join(words).encode())} if words else set()
+    return {zlib.crc32(" ".join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    # for sorted unique arrays of shingles, 4 bytes per shingle instead of a python int in a set
+    if not len(a) and not len(b):
+        return 1.0
+    intersection = len(np.intersect1d(a, b, assume_unique=True))
+    return intersection / (len(a) + len(b) - intersection)
+
+
+class MinHashLSH():
+    def __init__(self, num_perm: int = 128, bands: int = 32, seed: int = 0, max_bucket_size: int = 50) -> None:
+        # bands * rows = num_perm; pairs with Jaccard s become candidates with probability 1 - (1 - s^rows)^bands
+        # a bucket with more than max_bucket_size songs gives no candidates: its pairs grow quadratically and so
+        # many songs with the same band are boilerplate (e.g. a placeholder instead of lyrics), not re-uploads
+        assert num_perm % bands == 0, "num_perm must be divisible by bands"
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_bucket_size = max_bucket_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.skipped_buckets = 0
+
+    def signature(self, hashed_shingles: Set[int]) -> np.ndarray:
+        values = np.fromiter(hashed_shingles, dtype=np.uint64, count=len(hashed_shingles))
+        return ((np.outer(values, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def candidate_pairs(self, signatures: np.ndarray, keys: np.ndarray) -> Set[Tuple[int, int]]:
+        # signatures: one row of num_perm values per key, keys with equal rows in a band share a bucket
+        pairs = set()
+        for band in range(self.bands):
+            rows = signatures[:, band * self.rows:(band + 1) * self.rows]
+            _, bucket, counts = np.unique(rows, axis=0, return_inverse=True, return_counts=True)
+            bucket = bucket.reshape(-1)
+            shared = (counts[bucket] > 1) & (counts[bucket] <= self.max_bucket_size)
+            self.skipped_buckets += int((counts > self.max_bucket_size).sum())
+            order = np.argsort(bucket[shared], kind="stable")
+            members = keys[shared][order]
+            starts = np.flatnonzero(np.diff(bucket[shared][order])) + 1
+            for bucket_keys in np.split(members, starts):
+                pairs.update((int(i), int(j)) for i, j in combinations(sorted(bucket_keys), 2))
+        return pairs
+
+
+class DuplicateFinder():
+    # find_duplicate_clusters in passes over a stream of songs, without holding all lyrics:
+    # 1) add() every song: only the title and its MinHash signature (num_perm uint32 in one buffer) are kept,
+    #    songs with equal rows in a band are LSH candidates, see MinHashLSH.candidate_pairs
+    # 2) verify() the songs of needs_lyrics() again: the shingles of LSH candidates for the exact Jaccard similarity and
+    #    the lyrics of songs that share their title with another song, the last tie-break for the kept song
+    # 3) report()
+    def __init__(self, threshold: float = 0.7, num_perm: int = 128, bands: int = 32, max_bucket_size: int = 50) -> None:
+        self.threshold = threshold
+        self.lsh = MinHashLSH(num_perm=num_perm, bands=bands, max_bucket_size=max_bucket_size)
+        self.titles: List[str] = []
+        # the hash values stay below 2^31, uint32 holds them exactly
+        self.signatures = array("I")
+        self.signed_positions = array("q")
+        self.candidates: List[Tuple[int, int]] = None
+        self.shingles: Dict[int, np.ndarray] = {}
+        self.lyrics: Dict[int, str] = {}
+        self._shingle_positions: Set[int] = set()
+        self._lyric_positions: Set[int] = set()
+
+    def add(self, title: str, lyrics: str) -> None:
+        position = len(self.titles)
+        self.titles.append(title)
+        hashed = shingles(lyrics)
+        if hashed:
+            self.signatures.frombytes(self.lsh.signature(hashed).astype(np.uint32).tobytes())
+            self.signed_positions.append(position)
+
+    def candidate_pairs(self) -> Set[Tuple[int, int]]:
+        signatures = np.frombuffer(self.signatures, dtype=np.uint32).reshape(-1, self.lsh.num_perm)
+        return self.lsh.candidate_pairs(signatures, np.frombuffer(self.signed_positions, dtype=np.int64))
+
+    def needs_lyrics(self) -> Set[int]:
+        if self.candidates is None:
+            self.candidates = sorted(self.candidate_pairs())
+            # the signatures are not needed anymore
+            self.signatures, self.signed_positions = array("I"), array("q")
+        title_counts = Counter(self.titles)
+        self._shingle_positions = {i for pair in self.candidates for i in pair}
+        self._lyric_positions = {i for i, title in enumerate(self.titles) if title_counts[title] > 1}
+        return self._shingle_positions | self._lyric_positions
+
+    def verify(self, songs: Iterable[Tuple[int, str]]) -> None:
+        # songs: (position, lyrics), positions that are not needed are skipped
+        needed = self.needs_lyrics() if self.candidates is None else self._shingle_positions | self._lyric_positions
+        for position, lyrics in songs:
+            if position not in needed:
+                continue
+            if position in self._shingle_positions:
+                hashed = shingles(lyrics)
+                self.shingles[position] = np.sort(np.fromiter(hashed, dtype=np.uint32, count=len(hashed)))
+            if position in self._lyric_positions:
+                self.lyrics[position] = lyrics
+
+    def report(self) -> pd.DataFrame:
+        # Returns one row per merged song: kept, merged, reason, cluster_size and the position of the merged row
+        if self.candidates is None:
+            raise ValueError("verify() the songs of needs_lyrics() before the report")
+        titles = self.titles
+        positions = list(range(len(titles)))
+        parent = positions[:]
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        reasons = {}
+
+        def union(i, j, reason):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+            reasons.setdefault((min(i, j), max(i, j)), reason)
+
+        # 1) normalized title index
+        by_title = defaultdict(list)
+        for i, title in enumerate(titles):
+            by_title[normalize_title(title)].append(i)
+        for members in by_title.values():
+            for i in members[1:]:
+                union(members[0], i, "same normalized title")
+
+        # 2) the LSH candidates are verified with the exact Jaccard similarity
+        for i, j in self.candidates:
+            similarity = jaccard(self.shingles[i], self.shingles[j])
+            if similarity >= self.threshold:
+                union(i, j, f"lyrics jaccard {similarity:.2f}")
+
+        clusters = defaultdict(list)
+        for i in positions:
+            clusters[find(i)].append(i)
+
+        report = []
+        merged_clusters = [members for members in clusters.values() if len(members) > 1]
+        for members in merged_clusters:
+            # keep the plain title if there is one, otherwise the shortest name; ties are broken by name and lyrics
+            kept = min(members, key=lambda i: (titles[i] != normalize_title(titles[i]), len(titles[i]), titles[i],
+                                               self.lyrics.get(i, "")))
+            for i in members:
+                if i == kept:
+                    continue
+                reason = reasons.get((min(i, kept), max(i, kept)), "transitively merged")
+                report.append({"kept": titles[kept], "merged": titles[i], "reason": reason,
+                               "cluster_size": len(members), "position": i})
+        report = pd.DataFrame(report, columns=["kept", "merged", "reason", "cluster_size", "position"])
+        return report.sort_values(["kept", "merged"]).reset_index(drop=True)
+
+
+def find_duplicate_clusters(titles: pd.Series, lyrics: pd.Series, threshold: float = 0.7,
+                            num_perm: int = 128, bands: int = 32, max_bucket_size: int = 50) -> pd.DataFrame:
+    # Returns one row per merged song: kept, merged, reason, cluster_size and the position of the merged row
+    # Clusters and kept songs do not depend on the row order
+    finder = DuplicateFinder(threshold=threshold, num_perm=num_perm, bands=bands, max_bucket_size=max_bucket_size)
+    for title, text in zip(titles, lyrics):
+        finder.add(title, text)
+    finder.verify((i, lyrics.iloc[i]) for i in sorted(finder.needs_lyrics()))
+    return finder.report()
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from typing import Dict, List, Optional
+
+import numpy as np
+from haystack import Document
+
+from src.helper import load_json
+
+# a sha256 hex digest plus the newline in keys.txt
+KEY_LINE_BYTES = 65
+
+
+def hash_text(text:str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def model_to_dirname(model:str) -> str:
+    # "sentence-transformers/all-MiniLM-L6-v2" -> "sentence-transformers__all-MiniLM-L6-v2"
+    return model.replace("/", "__")
+
+
+class EmbeddingCache():
+    # Files per model: vectors.f32 (all vectors as raw float32 rows), keys.txt (the text hash of every row, one per
+    # line) and manifest.json (model, dim and the number of valid rows). flush only appends the new rows to both files
+    # and then replaces the small manifest, so it costs the new vectors instead of a rewrite of the whole cache.
+    # Rows behind the count of the manifest are left overs of an interrupted flush, they are cut off before the next append.
+    def __init__(self, cache_dir:str, model:str) -> None:
+        # every model gets its own folder, vectors of different models are never mixed
+        self.cache_dir = cache_dir
+        self.model = model
+        self.model_dir = os.path.join(cache_dir, model_to_dirname(model))
+        self.manifest_path = os.path.join(self.model_dir, "manifest.json")
+        self.vectors_path = os.path.join(self.model_dir, "vectors.f32")
+        self.keys_path = os.path.join(self.model_dir, "keys.txt")
+
+        self.hits = 0
+        self.misses = 0
+
+        self._load()
+
+    def _load(self):
+        # rows maps the hash of a text to its row in vectors.f32
+        self.rows: Dict[str, int] = {}
+        self.vectors = None
+        self.count = 0
+        self.dim = None
+        if os.path.exists(os.path.join(self.model_dir, "vectors.npy")):
+            self._migrate()
+        if os.path.exists(self.manifest_path):
+            manifest = load_json(self.manifest_path)
+            self.count, self.dim = manifest["count"], manifest["dim"]
+            with open(self.keys_path) as f:
+                keys = f.read(self.count * KEY_LINE_BYTES).splitlines()
+            self.rows = {key: i for i, key in enumerate(keys)}
+            if self.count:
+                self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+        # vectors computed in this session that are not yet written to disk
+        self.pending: Dict[str, np.ndarray] = {}
+
+    def _migrate(self):
+        # caches of the former layout (vectors.npy and the rows in the manifest) are converted once
+        legacy_vectors_path = os.path.join(self.model_dir, "vectors.npy")
+        rows = load_json(self.manifest_path)["rows"] if os.path.exists(self.manifest_path) else {}
+        vectors = np.load(legacy_vectors_path)
+        keys = sorted(rows, key=rows.get)
+        self._write(keys, vectors[[rows[key] for key in keys]])
+        os.remove(legacy_vectors_path)
+
+    def __len__(self) -> int:
+        return len(self.rows) + len(self.pending)
+
+    def get(self, text:str) -> Optional[np.ndarray]:
+        key = hash_text(text)
+        if key in self.pending:
+            return self.pending[key]
+        if key in self.rows:
+            return self.vectors[self.rows[key]]
+        return None
+
+    def put(self, text:str, embedding:List[float]) -> None:
+        key = hash_text(text)
+        if key not in self.rows:
+            self.pending[key] = np.asarray(embedding, dtype=np.float32)
+
+    def embed_documents(self, documents:List[Document], doc_embedder, flush:bool = True) -> List[Document]:
+        # take cached vectors where possible and only send the remaining documents to the embedder
+        # flush=False keeps new vectors pending, for callers that embed in many batches and flush once at the end
+        missing = []
+        for doc in documents:
+            embedding = self.get(doc.content)
+            if embedding is None:
+                missing.append(doc)
+            else:
+                doc.embedding = embedding.tolist()
+        self.hits += len(documents) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # the model is only loaded if there is something to embed
+            doc_embedder.warm_up()
+            for doc in doc_embedder.run(missing)["documents"]:
+                self.put(doc.content, doc.embedding)
+            self.flush() if flush else None
+        elif os.path.exists(self.manifest_path):
+            # mark the cache as used, the modification time drives the eviction of stale models
+            os.utime(self.manifest_path)
+
+        return documents
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        if self.count == 0:
+            self._write(list(self.pending), np.stack(list(self.pending.values())))
+            self._load()
+            return
+
+        # append the pending vectors behind the valid rows, then count them in the manifest
+        keys = list(self.pending)
+        vectors = np.ascontiguousarray(np.stack([self.pending[key] for key in keys]), dtype=np.float32)
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(self.count * self.dim * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(vectors.tobytes())
+        with open(self.keys_path, "r+") as f:
+            f.truncate(self.count * KEY_LINE_BYTES)
+            f.seek(0, os.SEEK_END)
+            f.write("".join(key + "\n" for key in keys))
+        self._write_manifest(self.count + len(keys))
+        self._load()
+
+    def prune(self, keep_texts:List[str]) -> None:
+        # drop vectors of songs that no longer exist or whose lyrics changed, the only rewrite of the files
+        self.flush()
+        keep = [hash_text(text) for text in keep_texts]
+        keep = [key for key in dict.fromkeys(keep) if key in self.rows]
+        if len(keep) == len(self.rows):
+            return
+        vectors = np.asarray(self.vectors[[self.rows[key] for key in keep]], dtype=np.float32) if keep else np.zeros((0, self.dim), dtype=np.float32)
+        self._write(keep, vectors)
+        self._load()
+
+    def _write(self, keys:List[str], vectors:np.ndarray) -> None:
+        # all files from scratch: the data files first, the manifest that makes them valid last
+        os.makedirs(self.model_dir, exist_ok=True)
+        self.dim = int(vectors.shape[1])
+        np.ascontiguousarray(vectors, dtype=np.float32).tofile(self.vectors_path + ".tmp")
+        with open(self.keys_path + ".tmp", "w") as f:
+            f.write("".join(key + "\n" for key in keys))
+        # an interrupted rewrite leaves a manifest with 0 rows behind, never one that counts rows of other files
+        self._write_manifest(0) if os.path.exists(self.manifest_path) else None
+        os.replace(self.vectors_path + ".tmp", self.vectors_path)
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+        self._write_manifest(len(keys))
+
+    def _write_manifest(self, count:int) -> None:
+        tmp_manifest_path = self.manifest_path + ".tmp"
+        with open(tmp_manifest_path, "w") as f:
+            json.dump({"model": self.model, "dim": self.dim, "count": count}, f)
+        os.replace(tmp_manifest_path, self.manifest_path)
+
+    def evict_stale_models(self, max_age_days:Optional[float] = 30) -> List[str]:
+        # remove caches of other models unused for max_age_days, None removes all of them
+        evicted = []
+        if not os.path.isdir(self.cache_dir):
+            return evicted
+        for dirname in os.listdir(self.cache_dir):
+            model_dir = os.path.join(self.cache_dir, dirname)
+            if model_dir == self.model_dir or not os.path.isdir(model_dir):
+                continue
+            if max_age_days is not None:
+                manifest_path = os.path.join(model_dir, "manifest.json")
+                last_used = os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else 0
+                if time.time() - last_used < max_age_days * 24 * 3600:
+                    continue
+            shutil.rmtree(model_dir)
+            evicted.append(dirname)
+        return evicted
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "cached_vectors": len(self),
+        }
@@ -0,0 +1,81 @@
+import os
+import time
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+# On-disk state of the scraper, every write is committed right away so a crash loses nothing:
+# - responses: cached api responses with their ETag/Last-Modified headers for conditional requests
+# - lyrics: one row per song url, lyrics is NULL for pages without lyrics, status != 200 marks failed fetches
+# - pages: song list pages whose lyrics are all fetched, used to resume a scrape
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY, status INTEGER, body TEXT, etag TEXT, last_modified TEXT, fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS lyrics (
+    url TEXT PRIMARY KEY, lyrics TEXT, status INTEGER, fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    artist_id INTEGER, page INTEGER, next_page INTEGER, completed_at REAL, PRIMARY KEY (artist_id, page)
+);
+"""
+
+
+class FetchCache():
+    def __init__(self, path:str = "output/scrape_cache.sqlite") -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    # --- api responses ---
+    def get_response(self, url:str) -> Optional[dict]:
+        row = self.connection.execute(
+            "SELECT status, body, etag, last_modified, fetched_at FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["status", "body", "etag", "last_modified", "fetched_at"], row))
+
+    def put_response(self, url:str, status:int, body:str, etag:Optional[str], last_modified:Optional[str]) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (url, status, body, etag, last_modified, time.time()),
+        )
+        self.connection.commit()
+
+    def touch_response(self, url:str) -> None:
+        # a 304 answer confirms the cached body, it counts as fresh again
+        self.connection.execute("UPDATE responses SET fetched_at = ? WHERE url = ?", (time.time(), url))
+        self.connection.commit()
+
+    # --- lyrics ---
+    def has_lyrics(self, url:str) -> bool:
+        row = self.connection.execute("SELECT status FROM lyrics WHERE url = ?", (url,)).fetchone()
+        return row is not None and row[0] == 200
+
+    def put_lyrics(self, url:str, lyrics:Optional[str], status:int = 200) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?, ?)", (url, lyrics, status, time.time()))
+        self.connection.commit()
+
+    def export_lyrics(self) -> Dict[str, str]:
+        rows = self.connection.execute("SELECT url, lyrics FROM lyrics WHERE status = 200 AND lyrics IS NOT NULL")
+        return dict(rows.fetchall())
+
+    def export_missing(self) -> Dict[str, int]:
+        return dict(self.connection.execute("SELECT url, status FROM lyrics WHERE status != 200").fetchall())
+
+    # --- pages ---
+    def complete_page(self, artist_id:int, page:int, next_page:Optional[int]) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (artist_id, page, next_page, time.time()))
+        self.connection.commit()
+
+    def get_completed_page(self, artist_id:int, page:int) -> Optional[Tuple[Optional[int], float]]:
+        # (next_page, completed_at) of a completed page, None if the page was never completed
+        return self.connection.execute(
+            "SELECT next_page, completed_at FROM pages WHERE artist_id = ? AND page = ?", (artist_id, page)
+        ).fetchone()
@@ -3,15 +3,24 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-from typing import Any, Callable, Dict, List, Optional, Union
-
-from groq import Groq, Stream
+import copy
+import time
+import asyncio
+import weakref
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from groq import AsyncGroq, Groq, Stream
 from groq.types.chat import ChatCompletion, ChatCompletionChunk
 
 from haystack import component, default_from_dict, default_to_dict, logging
 from haystack.dataclasses import ChatMessage, StreamingChunk
 from haystack.utils import Secret, deserialize_callable, deserialize_secrets_inplace, serialize_callable
 
+from src.rate_limit import TokenBucket
+from src.response_cache import ResponseCache
+from src.tracing import maybe_span, token_usage
+
 logger = logging.getLogger(__name__)
 
 
@@ -63,6 +72,10 @@ class GroqGenerator:
         generation_kwargs: Optional[Dict[str, Any]] = None,
         timeout: Optional[float] = None,
         max_retries: Optional[int] = None,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        response_cache: Optional[ResponseCache] = None,
     ):
         """
         Creates an instance of OpenAIGenerator. Unless specified otherwise in the `model`, this is for OpenAI's GPT-3.5 model.
@@ -102,7 +115,21 @@ class GroqGenerator:
             Timeout for OpenAI Client calls, if not set it is inferred from the `OPENAI_TIMEOUT` environment variable or set to 30.
         :param max_retries:
             Maximum retries to establish contact with OpenAI if it returns an internal error, if not set it is inferred from the `OPENAI_MAX_RETRIES` environment variable or set to 5.
-
+        :param max_concurrency:
+            Maximum number of requests in flight in `run_async` and `run_batch`. `run_batch` keeps one event loop
+            with one connection pool for the lifetime of the generator, `close()` stops it.
+        :param requests_per_minute:
+            Optional request budget of `run_async` and `run_batch`, requests wait until the budget allows them.
+        :param tokens_per_minute:
+            Optional token budget of `run_async` and `run_batch`. A request is charged with an estimate of its
+            prompt tokens plus `max_tokens` and corrected with the reported usage once it is done.
+        :param response_cache:
+            Optional exact and semantic cache for the replies of `run` and `run_async`, see `src/response_cache.py`.
+            Only deterministic requests (temperature 0) are cached unless the cache is created with `cache_sampled=True`.
+            The cache is not serialized with `to_dict`.
+
+        The `tracer` attribute (a `src.tracing.Tracer`, not serialized) adds a span per `run_batch` and per
+        request of `run_async`, `NLP_pipeline.enable_tracing` sets it.
         """
         self.api_key = api_key
         self.model = model
@@ -124,7 +151,23 @@ class GroqGenerator:
             timeout=timeout,
             max_retries=max_retries,
         )
-        
+
+        # the async client and the concurrency limit belong to an event loop, they are created on first use in a loop
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_budget = TokenBucket(requests_per_minute / 60, capacity=requests_per_minute) if requests_per_minute else None
+        self.token_budget = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute) if tokens_per_minute else None
+        # one (client, semaphore) per event loop, run_batch uses the one of its background loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        # the event loop of run_batch runs in its own thread, created on first use
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self.response_cache = response_cache
+        self.tracer = None
 
     def _get_telemetry_data(self) -> Dict[str, Any]:
         """
@@ -148,6 +191,9 @@ class GroqGenerator:
             generation_kwargs=self.generation_kwargs,
             system_prompt=self.system_prompt,
             api_key=self.api_key, # should be used: .to_dict() to serialize the Secret object
+            max_concurrency=self.max_concurrency,
+            requests_per_minute=self.requests_per_minute,
+            tokens_per_minute=self.tokens_per_minute,
         )
 
     @classmethod
@@ -182,18 +228,13 @@ class GroqGenerator:
             A list of strings containing the generated responses and a list of dictionaries containing the metadata
         for each response.
         """
-        message = ChatMessage.from_user(prompt)
-
-        if self.system_prompt:
-            messages = [ChatMessage.from_system(self.system_prompt), message]
-        else:
-            messages = [message]
-
-        # update generation kwargs by merging with the generation kwargs passed to the run method
-        generation_kwargs = {**self.generation_kwargs, **(generation_kwargs or {})}
+        openai_formatted_messages, generation_kwargs = self._prepare_request(prompt, generation_kwargs)
 
-        # adapt ChatMessage(s) to the format expected by the OpenAI API
-        openai_formatted_messages = [message.to_openai_format() for message in messages]
+        use_cache = self.response_cache is not None and self.streaming_callback is None
+        if use_cache:
+            cached = self.response_cache.lookup(self.model, self.system_prompt, generation_kwargs, prompt)
+            if cached is not None:
+                return cached
 
         completion: Union[Stream[ChatCompletionChunk], ChatCompletion] = self.client.chat.completions.create(
             model=self.model,
@@ -224,10 +265,249 @@ class GroqGenerator:
         for response in completions:
             self._check_finish_reason(response)
 
-        return {
+        result = {
+            "replies": [message.content for message in completions],
+            "meta": [message.meta for message in completions],
+        }
+        if use_cache:
+            self.response_cache.store(self.model, self.system_prompt, generation_kwargs, prompt, result)
+        return result
+
+    async def run_async(self, prompt: str, generation_kwargs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Asynchronous version of `run` without streaming, built on `AsyncGroq`.
+
+        All calls in the same event loop share one connection pool and the `max_concurrency` limit. The
+        request and token budgets are shared by all calls of this generator.
+
+        :param prompt:
+            The string prompt to use for text generation.
+        :param generation_kwargs:
+            Additional keyword arguments for text generation, see `run`.
+        :returns:
+            The same dictionary as `run`.
+        """
+        with maybe_span(self.tracer, "generator.request", {"component": type(self).__name__, "batch_size": 1}) as attributes:
+            result = await self._request_async(prompt, generation_kwargs, attributes)
+            attributes.update({f"tokens.{key}": value for key, value in token_usage(result).items()})
+            return result
+
+    async def _request_async(self, prompt: str, generation_kwargs: Optional[Dict[str, Any]], attributes: Dict[str, Any]) -> Dict[str, Any]:
+        openai_formatted_messages, generation_kwargs = self._prepare_request(prompt, generation_kwargs)
+        if self.response_cache is not None:
+            cached = self.response_cache.lookup(self.model, self.system_prompt, generation_kwargs, prompt)
+            attributes["cache_hit"] = cached is not None
+            if cached is not None:
+                return cached
+        client, semaphore = self._get_async_client()
+
+        # rough estimate of the request size: 4 characters per prompt token plus the maximal reply length
+        estimated_tokens = sum(len(message["content"]) for message in openai_formatted_messages) / 4
+        estimated_tokens += generation_kwargs.get("max_tokens", 0)
+        if self.request_budget:
+            await self.request_budget.acquire()
+        if self.token_budget:
+            await self.token_budget.acquire(estimated_tokens)
+
+        async with semaphore:
+            completion: ChatCompletion = await client.chat.completions.create(
+                model=self.model,
+                messages=openai_formatted_messages,  # type: ignore
+                stream=False,
+                **generation_kwargs,
+            )
+
+        if self.token_budget and completion.usage is not None:
+            self.token_budget.credit(estimated_tokens - completion.usage.total_tokens)
+
+        completions = [self._build_message(completion, choice) for choice in completion.choices]
+        for response in completions:
+            self._check_finish_reason(response)
+
+        result = {
             "replies": [message.content for message in completions],
             "meta": [message.meta for message in completions],
         }
+        if self.response_cache is not None:
+            self.response_cache.store(self.model, self.system_prompt, generation_kwargs, prompt, result)
+        return result
+
+    def run_batch(self, prompts: List[str], generation_kwargs: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Send all prompts concurrently and wait for all replies.
+
+        With enough concurrency and budget the batch takes about as long as the slowest request. Identical prompts
+        of a deterministic batch (one the response cache would cache, or temperature 0 without a cache) are sent once
+        and share the reply.
+
+        :param prompts:
+            The string prompts to use for text generation.
+        :param generation_kwargs:
+            Additional keyword arguments for text generation, see `run`.
+        :returns:
+            One dictionary like the output of `run` per prompt, in the order of the prompts.
+        """
+
+        # the span of the batch is a child of the span of the caller, e.g. run_rag_batch, although it runs in the loop thread
+        parent = self.tracer.current_span() if self.tracer is not None else None
+
+        # identical in-flight misses would all go upstream, the cache only knows the reply once the first one is back
+        _, merged_kwargs = self._prepare_request("", generation_kwargs)
+        unique_prompts = list(dict.fromkeys(prompts)) if self._deterministic(merged_kwargs) else prompts
+
+        async def gather():
+            with maybe_span(self.tracer, "generator.batch", {"component": type(self).__name__, "batch_size": len(prompts)}, parent) as attributes:
+                replies = await asyncio.gather(*[self.run_async(prompt, generation_kwargs) for prompt in unique_prompts])
+                attributes["coalesced"] = len(prompts) - len(unique_prompts)
+            if unique_prompts is prompts:
+                return replies
+            # every further occurrence of a prompt gets its own copy of the reply
+            replies, seen, results = dict(zip(unique_prompts, replies)), set(), []
+            for prompt in prompts:
+                results.append(copy.deepcopy(replies[prompt]) if prompt in seen else replies[prompt])
+                seen.add(prompt)
+            return results
+
+        # the batch runs in the background loop, so its connections are reused by the next batch and run_batch
+        # also works from a thread that already runs an event loop
+        return asyncio.run_coroutine_threadsafe(gather(), self._get_loop()).result()
+
+    def _deterministic(self, generation_kwargs: Dict[str, Any]) -> bool:
+        """
+        Whether requests with the same prompt and `generation_kwargs` may share one reply.
+        """
+        if self.response_cache is not None:
+            return self.response_cache.cacheable(generation_kwargs)
+        return generation_kwargs.get("temperature") == 0
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Returns the background event loop of `run_batch`, starts it on first use.
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="groq-event-loop", daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    def close(self) -> None:
+        """
+        Closes the connection pool of `run_batch` and stops its event loop, a later `run_batch` starts a new one.
+        """
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop, self._loop_thread = None, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close_async_client(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def _get_async_client(self):
+        """
+        Returns the async client and the concurrency semaphore of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            client = AsyncGroq(
+                api_key=self.client.api_key,
+                base_url=self.api_base_url,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+            )
+            self._async_clients[loop] = (client, asyncio.Semaphore(self.max_concurrency))
+        return self._async_clients[loop]
+
+    async def _close_async_client(self) -> None:
+        """
+        Closes the connection pool of the async client of the running event loop.
+        """
+        client_and_semaphore = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client_and_semaphore is not None:
+            await client_and_semaphore[0].close()
+
+    def stream(
+        self, prompt: str, generation_kwargs: Optional[Dict[str, Any]] = None, stats: Optional[Dict[str, Any]] = None
+    ) -> Iterator[str]:
+        """
+        Stream the reply to a prompt token by token, independent of `streaming_callback`.
+
+        The request is only sent when the iterator is consumed. Once it is exhausted, `stats` is filled with
+        the time to first token, the number of generated tokens and the tokens per second.
+
+        :param prompt:
+            The string prompt to use for text generation.
+        :param generation_kwargs:
+            Additional keyword arguments for text generation, see `run`.
+        :param stats:
+            An optional dictionary that receives `ttft`, `total_time`, `tokens`, `tokens_per_sec`,
+            `finish_reason` and `model`.
+        :returns:
+            An iterator over the text deltas of the reply.
+        """
+        openai_formatted_messages, generation_kwargs = self._prepare_request(prompt, generation_kwargs)
+        if generation_kwargs.get("n", 1) > 1:
+            raise ValueError("Cannot stream multiple responses, please set n=1.")
+
+        stats = stats if stats is not None else {}
+        start = time.perf_counter()
+        completion: Stream[ChatCompletionChunk] = self.client.chat.completions.create(
+            model=self.model,
+            messages=openai_formatted_messages,  # type: ignore
+            stream=True,
+            **generation_kwargs,
+        )
+
+        ttft = None
+        tokens = 0
+        usage_tokens = None
+        chunk = None
+        for chunk in completion:
+            # groq reports the token usage with the last chunk
+            if getattr(chunk, "x_groq", None) is not None and chunk.x_groq.usage is not None:
+                usage_tokens = chunk.x_groq.usage.completion_tokens
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                tokens += 1
+                yield content
+        total_time = time.perf_counter() - start
+
+        tokens = usage_tokens if usage_tokens is not None else tokens
+        generation_time = total_time - (ttft or 0.0)
+        stats.update(
+            {
+                "ttft": ttft,
+                "total_time": total_time,
+                "tokens": tokens,
+                "tokens_per_sec": tokens / generation_time if generation_time > 0 else float("inf"),
+                "finish_reason": chunk.choices[0].finish_reason if chunk is not None and chunk.choices else None,
+                "model": chunk.model if chunk is not None else self.model,
+            }
+        )
+
+    def _prepare_request(self, prompt: str, generation_kwargs: Optional[Dict[str, Any]]):
+        """
+        Builds the messages in the OpenAI format and merges the generation kwargs with the ones from `__init__`.
+        """
+        message = ChatMessage.from_user(prompt)
+
+        if self.system_prompt:
+            messages = [ChatMessage.from_system(self.system_prompt), message]
+        else:
+            messages = [message]
+
+        # update generation kwargs by merging with the generation kwargs passed to the run method
+        generation_kwargs = {**self.generation_kwargs, **(generation_kwargs or {})}
+
+        # adapt ChatMessage(s) to the format expected by the OpenAI API
+        openai_formatted_messages = [message.to_openai_format() for message in messages]
+        return openai_formatted_messages, generation_kwargs
 
     def _connect_chunks(self, chunk: Any, chunks: List[StreamingChunk]) -> ChatMessage:
         """
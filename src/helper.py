@@ -32,6 +32,7 @@ def output_pipeline_as_yaml(pipeline:Pipeline, filename:str) -> None:
         f.write(pipeline.dumps())
 
 def load_pipeline_from_yaml(filename:str) -> Pipeline:
-    pipeline_yaml = yaml.safe_load(open("pipelines/extractive_qa_pipeline.yaml"))
+    with open(filename, "r") as f:
+        pipeline_yaml = yaml.safe_load(f)
     return Pipeline.from_dict(pipeline_yaml)
 
@@ -0,0 +1,144 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.rate_limit import TokenBucket
+
+# status codes that are worth another try
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(value:Optional[str]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def new_host_stats() -> dict:
+    return {"requests": 0, "retries": 0, "errors": 0, "bytes": 0, "wire_bytes": 0, "latencies": []}
+
+
+def summarize_stats(stats_per_host:Dict[str, dict]) -> dict:
+    # counters per host plus the mean and p95 latency instead of the single latencies
+    report = {}
+    for host, stats in stats_per_host.items():
+        latencies = sorted(stats["latencies"])
+        report[host] = {key: value for key, value in stats.items() if key != "latencies"}
+        report[host]["latency_ms_mean"] = 1000 * sum(latencies) / len(latencies) if latencies else 0.0
+        report[host]["latency_ms_p95"] = 1000 * latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+    return report
+
+
+class HTTPClient():
+    def __init__(
+        self,
+        headers:dict = None,
+        max_per_host:int = 4,
+        requests_per_second:Optional[float] = None,
+        max_retries:int = 5,
+        backoff:float = 1.0,
+        max_backoff:float = 60.0,
+        connect_timeout:float = 5.0,
+        read_timeout:float = 30.0,
+    ) -> None:
+        # one requests session for all calls: connections are kept alive and reused per host, responses are gzip
+        # compressed on the wire, headers (e.g. the Authorization of the Genius API) are set once for every request
+        # at most max_per_host requests run at the same time per host, the connection pool of a host has as many connections
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max_per_host, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_per_host = max_per_host
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._lock = threading.Lock()
+        self._host_limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._stats: Dict[str, dict] = {}
+
+    def _host(self, url:str) -> str:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+                self._stats[host] = new_host_stats()
+        return host
+
+    def _record(self, host:str, response:Optional[requests.Response], seconds:float) -> None:
+        with self._lock:
+            stats = self._stats[host]
+            stats["requests"] += 1
+            stats["latencies"].append(seconds)
+            if response is None:
+                stats["errors"] += 1
+                return
+            stats["bytes"] += len(response.content)
+            # bytes as received, before the gzip decoding
+            stats["wire_bytes"] += response.raw.tell() if hasattr(response.raw, "tell") else len(response.content)
+
+    def get(self, url:str, params:dict = None, headers:dict = None) -> requests.Response:
+        # GET with keep-alive, per-host concurrency limit and backoff on 429/5xx and network errors,
+        # a Retry-After of the server is used as the delay; the last response is returned once the retries are used up
+        host = self._host(url)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire_sync()
+            start = time.perf_counter()
+            response, retry_after = None, None
+            with self._host_limits[host]:
+                try:
+                    response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                    # the body is read while the host slot is held
+                    response.content
+                except (requests.ConnectionError, requests.Timeout):
+                    self._record(host, None, time.perf_counter() - start)
+                    if attempt == self.max_retries:
+                        raise
+            if response is not None:
+                self._record(host, response, time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    return response
+                retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+
+            with self._lock:
+                self._stats[host]["retries"] += 1
+            delay = retry_after if retry_after is not None else self.backoff * 2 ** attempt * (0.5 + random.random())
+            time.sleep(min(delay, self.max_backoff))
+
+    def stats(self) -> dict:
+        # request counts, bytes and latency per host
+        with self._lock:
+            return summarize_stats(self._stats)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+# shared clients: one per access token, so all Genius API calls with a token reuse its connections and Authorization header
+_clients: Dict[Optional[str], HTTPClient] = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(access_token:str = None) -> HTTPClient:
+    with _clients_lock:
+        if access_token not in _clients:
+            headers = {'Authorization': 'Bearer ' + access_token} if access_token else None
+            _clients[access_token] = HTTPClient(headers=headers)
+        return _clients[access_token]
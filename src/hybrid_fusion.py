@@ -0,0 +1,161 @@
+from dataclasses import replace
+from math import inf, nextafter
+from typing import Any, Callable, Dict, List, Optional
+
+from haystack import Document, component, default_to_dict
+from haystack.components.joiners import DocumentJoiner
+from haystack.components.rankers import TransformersSimilarityRanker
+
+from src.query_cache import add_counts
+
+# Hybrid retrieval: BM25 and embedding results are fused into one list, the cross-encoder re-ranks only the head
+# of the fused list and is skipped when both retrievers agree on their top results.
+# The @component decorator recreates the class, so the components call their parent class explicitly instead of super().
+
+JOIN_MODES = ("concatenate", "reciprocal_rank_fusion", "weighted_score")
+
+
+def retriever_agreement(bm25_documents:List[Document], embedding_documents:List[Document], top_n:int = 3) -> float:
+    # share of the top_n documents both retrievers have in common
+    bm25_ids = {doc.id for doc in bm25_documents[:top_n]}
+    embedding_ids = {doc.id for doc in embedding_documents[:top_n]}
+    if not bm25_ids or not embedding_ids:
+        return 0.0
+    return len(bm25_ids & embedding_ids) / min(top_n, len(bm25_ids), len(embedding_ids))
+
+
+def rank_fused(rank:Callable, queries:List[str], fused_documents:List[List[Document]], agreements:List[float],
+               top_k:int = None, head_size:int = None, skip_agreement:float = None, stats:dict = None) -> List[List[Document]]:
+    # rank(queries, documents_per_query, top_k) is the cross-encoder, e.g. batch_rank or the scheduler.
+    # Only the first head_size fused documents are re-ranked, the rest keeps the fused order behind them.
+    # Queries with an agreement of at least skip_agreement keep the fused order without the cross-encoder.
+    results = [documents[:top_k] if top_k else documents for documents in fused_documents]
+    to_rank = [i for i, agreement in enumerate(agreements) if skip_agreement is None or agreement < skip_agreement]
+    heads = [fused_documents[i][:head_size] if head_size else fused_documents[i] for i in to_rank]
+    if to_rank:
+        # the whole head is ranked, a top_k of the ranker (e.g. its default of 10) must not cut it
+        head_top_k = max(len(head) for head in heads) or None
+        for i, head, ranked in zip(to_rank, heads, rank([queries[i] for i in to_rank], heads, head_top_k)):
+            documents = ranked + tail_below(ranked, fused_documents[i][len(head):])
+            results[i] = documents[:top_k] if top_k else documents
+    if stats is not None:
+        add_counts(stats, queries=len(queries), skipped=len(queries) - len(to_rank), ranked_pairs=sum(len(head) for head in heads))
+    return results
+
+
+def tail_below(ranked:List[Document], tail:List[Document]) -> List[Document]:
+    # cross-encoder and fusion scores are on different scales: the tail gets scores just below the lowest
+    # cross-encoder score, in its fused order, so sorting by score (e.g. documents_per_song) keeps the head first.
+    # The fusion score stays in the meta.
+    if not ranked or not tail:
+        return tail
+    score = min(doc.score for doc in ranked)
+    documents = []
+    for doc in tail:
+        score = nextafter(score, -inf)
+        documents.append(replace(doc, score=score, meta={**doc.meta, "fusion_score": doc.score}))
+    return documents
+
+
+@component
+class FusionJoiner(DocumentJoiner):
+    """
+    Joins BM25 and embedding results with reciprocal rank fusion, a weighted sum of min-max normalized scores
+    ("weighted_score") or by concatenation. Also outputs the share of the top results both retrievers agree on.
+    """
+
+    def __init__(self, join_mode:str = "reciprocal_rank_fusion", weights:Optional[List[float]] = None,
+                 top_k:Optional[int] = None, agreement_top_n:int = 3) -> None:
+        """
+        :param join_mode: One of "concatenate", "reciprocal_rank_fusion" or "weighted_score".
+        :param weights: Weights of the BM25 and the embedding results, in this order.
+        :param top_k: The maximum number of fused Documents.
+        :param agreement_top_n: Number of top Documents of each retriever compared for the agreement.
+        """
+        if join_mode not in JOIN_MODES:
+            raise ValueError(f"FusionJoiner does not support join_mode '{join_mode}', choose one of {JOIN_MODES}")
+        DocumentJoiner.__init__(self, join_mode="concatenate", weights=weights, top_k=top_k)
+        self.join_mode = join_mode
+        self.agreement_top_n = agreement_top_n
+
+    def to_dict(self) -> Dict[str, Any]:
+        return default_to_dict(self, join_mode=self.join_mode, weights=self.weights, top_k=self.top_k,
+                               agreement_top_n=self.agreement_top_n)
+
+    def _weighted_score(self, document_lists:List[List[Document]]) -> List[Document]:
+        # BM25 scores are unbounded and cosine scores are not, both are scaled to [0, 1] per query first
+        weights = self.weights if self.weights else [1 / len(document_lists)] * len(document_lists)
+        scores_map = {}
+        documents_map = {}
+        for documents, weight in zip(document_lists, weights):
+            scores = [doc.score or 0.0 for doc in documents]
+            low, high = (min(scores), max(scores)) if scores else (0.0, 0.0)
+            for doc, score in zip(documents, scores):
+                normalized = (score - low) / (high - low) if high > low else 1.0
+                scores_map[doc.id] = scores_map.get(doc.id, 0.0) + weight * normalized
+                documents_map[doc.id] = doc
+        return [replace(doc, score=scores_map[doc_id]) for doc_id, doc in documents_map.items()]
+
+    @component.output_types(documents=List[Document], agreement=float)
+    def run(self, bm25_documents:List[Document], embedding_documents:List[Document], top_k:Optional[int] = None):
+        """
+        Fuses the results of both retrievers.
+
+        :param bm25_documents: Documents from the BM25 retriever.
+        :param embedding_documents: Documents from the embedding retriever.
+        :param top_k: The maximum number of Documents to return. Overrides the instance's `top_k` if provided.
+        :returns: A dictionary with the fused `documents`, sorted by score, and the `agreement` of the retrievers.
+        """
+        document_lists = [bm25_documents, embedding_documents]
+        if self.join_mode == "weighted_score":
+            documents = self._weighted_score(document_lists)
+        elif self.join_mode == "reciprocal_rank_fusion":
+            # fuses copies, the parent class writes the fused scores into the documents
+            documents = self._reciprocal_rank_fusion([[replace(doc) for doc in docs] for docs in document_lists])
+        else:
+            documents = self._concatenate(document_lists)
+        documents = sorted(documents, key=lambda doc: doc.score if doc.score is not None else -inf, reverse=True)
+        top_k = top_k or self.top_k
+        return {
+            "documents": documents[:top_k] if top_k else documents,
+            "agreement": retriever_agreement(bm25_documents, embedding_documents, self.agreement_top_n),
+        }
+
+
+@component
+class HeadRanker(TransformersSimilarityRanker):
+    """
+    TransformersSimilarityRanker that re-ranks only the first `head_size` fused Documents
+    and keeps the fused order when the retrievers agree at least `skip_agreement`.
+    """
+
+    def __init__(self, *args, head_size:Optional[int] = None, skip_agreement:Optional[float] = None, **kwargs) -> None:
+        TransformersSimilarityRanker.__init__(self, *args, **kwargs)
+        self.head_size = head_size
+        self.skip_agreement = skip_agreement
+        # queries, skipped queries and query/document pairs scored by the cross-encoder
+        self.stats = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = TransformersSimilarityRanker.to_dict(self)
+        data["init_parameters"]["head_size"] = self.head_size
+        data["init_parameters"]["skip_agreement"] = self.skip_agreement
+        return data
+
+    @component.output_types(documents=List[Document])
+    def run(self, query:str, documents:List[Document], top_k:Optional[int] = None, agreement:Optional[float] = None):
+        """
+        Re-ranks the head of the fused Documents.
+
+        :param query: Query string.
+        :param documents: Fused Documents, sorted by their fused score.
+        :param top_k: The maximum number of Documents to return.
+        :param agreement: Agreement of the retrievers from the FusionJoiner, None always re-ranks.
+        :returns: A dictionary with the re-ranked `documents`.
+        """
+        rank = lambda queries, heads, k: [TransformersSimilarityRanker.run(self, q, head, top_k=k)["documents"]
+                                          for q, head in zip(queries, heads)]
+        skip_agreement = self.skip_agreement if agreement is not None else None
+        documents = rank_fused(rank, [query], [documents], [agreement], top_k or self.top_k, self.head_size,
+                               skip_agreement, self.stats)[0]
+        return {"documents": documents}
@@ -0,0 +1,139 @@
+import os
+import copy
+from types import SimpleNamespace
+from typing import Dict, List
+
+import torch
+
+from src.embedding_cache import model_to_dirname
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# CPU inference backends for the query-side models (text embedder, ExtractiveReader, TransformersSimilarityRanker):
+# - fp32: the torch models as loaded by haystack
+# - int8: torch dynamic quantization of all Linear layers, weights are stored as int8
+# - onnx: the model graph exported once to ONNX and run with onnxruntime (optional dependency)
+# The document embeddings stay fp32, so the embedding cache is not mixed with quantized vectors.
+# Exports are keyed by the model name only, delete the cache directory after updating a model.
+BACKENDS = ("fp32", "int8", "onnx")
+
+
+class ONNXModel(torch.nn.Module):
+    # stands in for a transformers model: same call signature and outputs, runs the exported graph with onnxruntime
+    def __init__(self, path:str, config, output_names:List[str]) -> None:
+        super().__init__()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.output_names = output_names
+        self.config = config
+
+    def forward(self, return_dict:bool = True, **inputs):
+        feeds = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        outputs = [torch.from_numpy(output) for output in self.session.run(self.output_names, feeds)]
+        if not return_dict:
+            return tuple(outputs)
+        return SimpleNamespace(**dict(zip(self.output_names, outputs)))
+
+
+class _NamedOutputs(torch.nn.Module):
+    # the exporter needs positional inputs and a tuple of tensors as output
+    def __init__(self, model, input_names:List[str], output_names:List[str]) -> None:
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+        self.output_names = output_names
+
+    def forward(self, *inputs):
+        outputs = self.model(**dict(zip(self.input_names, inputs)), return_dict=True)
+        return tuple(getattr(outputs, name) for name in self.output_names)
+
+
+def export_onnx(model, sample_inputs:Dict[str, torch.Tensor], output_names:List[str], path:str) -> None:
+    input_names = list(sample_inputs)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    for name in output_names:
+        # logits of a classifier only have a batch axis, token level outputs also have the sequence axis
+        dynamic_axes[name] = {0: "batch"} if name == "logits" else {0: "batch", 1: "sequence"}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with torch.inference_mode():
+        torch.onnx.export(
+            _NamedOutputs(model.eval(), input_names, output_names),
+            tuple(sample_inputs.values()),
+            tmp_path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+            dynamo=False,
+        )
+    os.replace(tmp_path, path)
+
+
+def convert_model(model, backend:str, model_name:str, kind:str, sample_inputs:Dict[str, torch.Tensor],
+                  output_names:List[str], cache_dir:str = "cache/models"):
+    # returns the model to use for the backend, ONNX exports are cached per model name and kind
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', choose one of {BACKENDS}")
+    if backend == "fp32":
+        return model
+    if backend == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if onnxruntime is None:
+        raise ImportError("The onnx backend needs onnxruntime, install it with 'pip install onnxruntime onnx'")
+    path = os.path.join(cache_dir, model_to_dirname(model_name), f"{kind}.onnx")
+    if not os.path.exists(path):
+        print(f"Exporting {model_name} ({kind}) to {path}")
+        export_onnx(model, sample_inputs, output_names, path)
+    return ONNXModel(path, model.config, output_names)
+
+
+def apply_to_text_embedder(text_embedder, backend:str, cache_dir:str = "cache/models") -> None:
+    # haystack shares one embedding backend between embedders of the same model, the query embedder gets its own copy
+    # so the document embedder keeps computing fp32 embeddings
+    text_embedder.warm_up()
+    embedding_backend = copy.copy(text_embedder.embedding_backend)
+    embedding_backend.model = copy.deepcopy(embedding_backend.model)
+    transformer = embedding_backend.model[0]
+    sample_inputs = dict(transformer.tokenize(["warm up query"]))
+    transformer.auto_model = convert_model(transformer.auto_model, backend, text_embedder.model, "embedder",
+                                           sample_inputs, ["last_hidden_state"], cache_dir)
+    text_embedder.embedding_backend = embedding_backend
+
+
+def apply_to_reader(reader, backend:str, cache_dir:str = "cache/models") -> None:
+    # the reader only passes input_ids and attention_mask to the model
+    reader.warm_up()
+    features = reader.tokenizer(["warm up query"], ["warm up context"], return_tensors="pt")
+    sample_inputs = {"input_ids": features["input_ids"], "attention_mask": features["attention_mask"]}
+    reader.model = convert_model(reader.model, backend, str(reader.model_name_or_path), "reader",
+                                 sample_inputs, ["start_logits", "end_logits"], cache_dir)
+
+
+def apply_to_ranker(ranker, backend:str, cache_dir:str = "cache/models") -> None:
+    ranker.warm_up()
+    sample_inputs = dict(ranker.tokenizer([["warm up query", "warm up document"]], padding=True, truncation=True, return_tensors="pt"))
+    ranker.model = convert_model(ranker.model, backend, str(ranker.model_name_or_path), "ranker",
+                                 sample_inputs, ["logits"], cache_dir)
+
+
+def overlap_at_k(reference:List[list], candidate:List[list], k:int) -> float:
+    # mean share of the reference top-k that is also in the candidate top-k
+    overlaps = [len(set(r[:k]) & set(c[:k])) / max(len(r[:k]), 1) for r, c in zip(reference, candidate)]
+    return sum(overlaps) / len(overlaps) if overlaps else 1.0
+
+
+def current_rss_mb() -> float:
+    # resident memory of this process, linux only; falls back to the peak from getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
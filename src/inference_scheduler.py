@@ -0,0 +1,75 @@
+from collections import defaultdict
+from typing import Dict, List
+
+from haystack import Document
+
+from src.batch_helper import embed_queries, batch_rank, batch_read
+from src.micro_batching import MicroBatcher
+from src.tracing import maybe_span
+
+
+def _group_by_top_k(items:List[tuple], run) -> list:
+    # items are (query, documents, top_k), queries with the same top_k share one batch call
+    positions = defaultdict(list)
+    for i, (_, _, top_k) in enumerate(items):
+        positions[top_k].append(i)
+    results = [None] * len(items)
+    for top_k, indices in positions.items():
+        for i, result in zip(indices, run([items[i][0] for i in indices], [items[i][1] for i in indices], top_k)):
+            results[i] = result
+    return results
+
+
+class InferenceScheduler():
+    # One micro-batcher per model of an NLP_pipeline: the query embedder, the ExtractiveReader and the ranker.
+    # Requests from many threads for the same model are collected into one forward pass, a batch is closed after
+    # max_batch_size items or max_wait_ms. Larger values trade latency for throughput, stats() shows the queue
+    # depth and batch size histograms to tune them. The ranker and reader are optional, as in NLP_pipeline.
+    # With tracing on (the tracer of the pipeline) every micro-batch is a span "scheduler.<model>"; it serves several
+    # requests, so it has no parent, the requests have their own stage spans.
+    def __init__(self, pipeline, max_batch_size:int = 16, max_wait_ms:float = 10.0,
+                 model_settings:Dict[str, dict] = None) -> None:
+        # model_settings overrides max_batch_size/max_wait_ms per model, e.g. {"ranker": {"max_wait_ms": 25}}
+        self.pipeline = pipeline
+        model_settings = model_settings or {}
+        settings = lambda name: {"max_batch_size": max_batch_size, "max_wait_ms": max_wait_ms, **model_settings.get(name, {})}
+
+        self.batchers = {
+            "embedder": MicroBatcher(self._traced("embedder", lambda texts: list(embed_queries(pipeline.text_embedder, texts))),
+                                     name="embedder", **settings("embedder")),
+        }
+        if getattr(pipeline, "reader", None) is not None:
+            self.batchers["reader"] = MicroBatcher(
+                self._traced("reader", lambda items: _group_by_top_k(items, lambda queries, documents, top_k: batch_read(pipeline.reader, queries, documents, top_k=top_k))),
+                name="reader", **settings("reader"))
+        if getattr(pipeline, "ranker", None) is not None:
+            self.batchers["ranker"] = MicroBatcher(
+                self._traced("ranker", lambda items: _group_by_top_k(items, lambda queries, documents, top_k: batch_rank(pipeline.ranker, queries, documents, top_k=top_k))),
+                name="ranker", **settings("ranker"))
+
+    def _traced(self, name:str, run):
+        # the tracer is looked up per batch, enable_tracing can be called after the scheduler is created
+        def traced_run(items:list) -> list:
+            with maybe_span(getattr(self.pipeline, "tracer", None), f"scheduler.{name}", {"component": "MicroBatcher", "batch_size": len(items)}):
+                return run(items)
+        return traced_run
+
+    # every method takes the queries of one request, they are submitted together and batch with other requests
+    def embed(self, queries:List[str]) -> list:
+        futures = [self.batchers["embedder"].submit(query) for query in queries]
+        return [future.result() for future in futures]
+
+    def read(self, queries:List[str], documents_per_query:List[List[Document]], top_k:int = None) -> List[list]:
+        futures = [self.batchers["reader"].submit((q, documents, top_k)) for q, documents in zip(queries, documents_per_query)]
+        return [future.result() for future in futures]
+
+    def rank(self, queries:List[str], documents_per_query:List[List[Document]], top_k:int = None) -> List[List[Document]]:
+        futures = [self.batchers["ranker"].submit((q, documents, top_k)) for q, documents in zip(queries, documents_per_query)]
+        return [future.result() for future in futures]
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: batcher.stats() for name, batcher in self.batchers.items()}
+
+    def close(self) -> None:
+        for batcher in self.batchers.values():
+            batcher.close()
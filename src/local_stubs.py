@@ -0,0 +1,164 @@
+import json
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-ins for the remote services, so the scraper and the generator can be exercised without network access
+
+
+def make_stub_songs(n_songs:int) -> List[dict]:
+    return [{"id": i, "title": f"Song {i}", "path": f"/Green-day-song-{i}-lyrics"} for i in range(n_songs)]
+
+
+class GeniusStubHandler(BaseHTTPRequestHandler):
+    # serves the api endpoints (search, artists/{id}/songs) and the lyrics pages from one server
+    songs: List[dict] = []
+    latency: float = 0.0
+    fail_every: int = 0
+    requests_seen: int = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status:int, body:str, content_type:str = "application/json", headers:dict = None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        with self.lock:
+            type(self).requests_seen += 1
+            requests_seen = type(self).requests_seen
+        time.sleep(self.latency)
+
+        # every fail_every-th request is rate limited to exercise retries
+        if self.fail_every and requests_seen % self.fail_every == 0:
+            return self._send(429, "{}", headers={"Retry-After": "0"})
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/search":
+            hits = [{"result": {"primary_artist": {"id": 1}}}]
+            return self._send(200, json.dumps({"response": {"hits": hits}}))
+        if url.path.startswith("/artists/") and url.path.endswith("/songs"):
+            page = int(query.get("page", ["1"])[0])
+            per_page = int(query.get("per_page", ["20"])[0])
+            songs = self.songs[(page - 1) * per_page:page * per_page]
+            next_page = page + 1 if page * per_page < len(self.songs) else None
+            body = json.dumps({"response": {"songs": songs, "next_page": next_page}})
+            # ETag support to exercise conditional requests
+            etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            return self._send(200, body, headers={"ETag": etag})
+        for song in self.songs:
+            if url.path == song["path"]:
+                html = (f"<html><body><div data-lyrics-container=\"true\">[Verse 1]<br/>{song['title']} line one"
+                        f"<br/>{song['title']} line two</div></body></html>")
+                return self._send(200, html, content_type="text/html")
+        return self._send(404, "{}")
+
+
+class GroqStubHandler(BaseHTTPRequestHandler):
+    # OpenAI compatible chat completions endpoint of groq, answers with a fixed reply, streamed as server-sent events
+    reply: str = "Stub lyrics line one. Stub lyrics line two."
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+    requests_seen: int = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _chunk(self, request_id:str, model:str, delta:dict, finish_reason:str = None, usage:dict = None) -> bytes:
+        chunk = {
+            "id": request_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage:
+            chunk["x_groq"] = {"id": request_id, "usage": usage}
+        return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+    def do_POST(self):
+        with self.lock:
+            type(self).requests_seen += 1
+        if urlparse(self.path).path != "/openai/v1/chat/completions":
+            self.send_response(404)
+            self.end_headers()
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model", "stub-model")
+        request_id = f"chatcmpl-stub-{self.requests_seen}"
+        # every word is one token, the spaces stay attached so the joined tokens give the reply back
+        tokens = [word + " " for word in self.reply.split(" ")]
+        tokens[-1] = tokens[-1][:-1]
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in request.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+
+        if not request.get("stream"):
+            time.sleep(self.first_token_latency + self.token_latency * len(tokens))
+            body = json.dumps({
+                "id": request_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # without Content-Length the client reads the events until the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(self.first_token_latency)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.token_latency)
+            self.wfile.write(self._chunk(request_id, model, {"role": "assistant", "content": token}))
+        self.wfile.write(self._chunk(request_id, model, {}, finish_reason="stop", usage=usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class StubServer(ThreadingHTTPServer):
+    # the default backlog of 5 connections would stall concurrent clients
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_stub_server(handler_class, port:int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    # port 0 picks a free port, the server runs in a daemon thread until server.shutdown()
+    server = StubServer(("127.0.0.1", port), handler_class)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_genius_stub(n_songs:int = 120, latency:float = 0.0, fail_every:int = 0, port:int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    handler_class = type("GeniusStub", (GeniusStubHandler,), {
+        "songs": make_stub_songs(n_songs), "latency": latency, "fail_every": fail_every, "requests_seen": 0,
+    })
+    return start_stub_server(handler_class, port)
+
+
+def start_groq_stub(reply:str = None, first_token_latency:float = 0.0, token_latency:float = 0.0, port:int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    # pass the returned url as api_base_url of GroqGenerator
+    attributes = {"first_token_latency": first_token_latency, "token_latency": token_latency, "requests_seen": 0}
+    if reply is not None:
+        attributes["reply"] = reply
+    handler_class = type("GroqStub", (GroqStubHandler,), attributes)
+    return start_stub_server(handler_class, port)
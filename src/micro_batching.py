@@ -0,0 +1,119 @@
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+def power_of_two_bucket(value:int) -> str:
+    # 1, 2-3, 4-7, 8-15, ... keeps queue depth histograms short
+    if value <= 1:
+        return str(value)
+    low = 1 << (value.bit_length() - 1)
+    return f"{low}-{2 * low - 1}"
+
+
+class MicroBatcher():
+    # Collects items submitted from many threads and processes them together with one call of process_batch.
+    # A batch is closed when it has max_batch_size items or max_wait_ms after its first item arrived.
+    # process_batch gets a list of items and returns one result per item in the same order.
+    def __init__(self, process_batch:Callable[[List[Any]], List[Any]], max_batch_size:int = 16, max_wait_ms:float = 10.0,
+                 name:str = "micro-batcher") -> None:
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self.queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        # metrics: batch sizes, queue depth when a batch starts (including its first item), time items wait
+        self.lock = threading.Lock()
+        self.batch_sizes: Counter = Counter()
+        self.queue_depths: Counter = Counter()
+        self.batches = 0
+        self.items = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item:Any) -> Future:
+        if self._closed:
+            raise RuntimeError(f"{self.name} is closed")
+        future = Future()
+        self.queue.put((item, future, time.monotonic()))
+        return future
+
+    def __call__(self, item:Any) -> Any:
+        return self.submit(item).result()
+
+    def close(self) -> None:
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
+
+    def _collect(self) -> list:
+        first = self.queue.get()
+        if first is None:
+            return []
+        with self.lock:
+            self.queue_depths[power_of_two_bucket(self.queue.qsize() + 1)] += 1
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self.queue.get(timeout=max(remaining, 0)) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # finish the current batch, the loop stops afterwards
+                self.queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            items = [item for item, _, _ in batch]
+            start = time.monotonic()
+            waits = [start - submitted for _, _, submitted in batch]
+            try:
+                results = self.process_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name}: process_batch returned {len(results)} results for {len(items)} items")
+            except Exception as error:
+                results = None
+                for _, future, _ in batch:
+                    future.set_exception(error)
+            with self.lock:
+                self.batches += 1
+                self.items += len(items)
+                self.batch_sizes[len(items)] += 1
+                self.total_wait += sum(waits)
+                self.max_wait = max(self.max_wait, max(waits))
+                self.busy_time += time.monotonic() - start
+            if results is not None:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        # histograms as {size or depth bucket: number of batches}, waits are the time from submit to batch start
+        with self.lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                "queue_depth": self.queue.qsize(),
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "queue_depth_histogram": dict(sorted(self.queue_depths.items(), key=lambda bucket: int(bucket[0].split("-")[0]))),
+                "mean_wait_ms": 1000 * self.total_wait / self.items if self.items else 0.0,
+                "max_wait_ms_seen": 1000 * self.max_wait,
+                "busy_seconds": self.busy_time,
+            }
@@ -0,0 +1,92 @@
+import os
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import List
+
+import numpy as np
+import torch
+from haystack import Document
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+
+# Corpus embedding in a pool of processes, for the initial indexing of large corpora on CPU.
+# Every worker loads its own replica of the model and runs torch with threads_per_worker intra-op threads, so the
+# workers do not fight over one thread pool. The documents of a run are sent to the workers in shards, the workers
+# write the float32 embeddings into one shared memory matrix (one row per document, in document order) and only
+# return the number of rows, the vectors themselves are never pickled.
+# Same interface as SentenceTransformersDocumentEmbedder (warm_up, run), so it also works with the EmbeddingCache.
+
+# the model replica of a worker process
+_embedder = None
+
+
+def _init_worker(model:str, threads:int, embedder_kwargs:dict) -> None:
+    global _embedder
+    torch.set_num_threads(threads)
+    _embedder = SentenceTransformersDocumentEmbedder(model=model, progress_bar=False, **embedder_kwargs)
+    _embedder.warm_up()
+
+
+def _dimension() -> int:
+    return _embedder.embedding_backend.model.get_sentence_embedding_dimension()
+
+
+def _embed_shard(shm_name:str, shape:tuple, start:int, documents:List[Document]) -> int:
+    shm = SharedMemory(name=shm_name)
+    try:
+        embedded = _embedder.run(documents)["documents"]
+        matrix = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        matrix[start:start + len(embedded)] = np.asarray([doc.embedding for doc in embedded], dtype=np.float32)
+        del matrix
+    finally:
+        shm.close()
+    return len(embedded)
+
+
+class ParallelDocumentEmbedder():
+    def __init__(self, model:str, n_workers:int = None, threads_per_worker:int = None, shard_size:int = 256, **embedder_kwargs) -> None:
+        # n_workers defaults to one per core and threads_per_worker to the cores per worker
+        # embedder_kwargs go to the SentenceTransformersDocumentEmbedder of every worker (e.g. batch_size)
+        self.model = model
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.n_workers)
+        self.shard_size = shard_size
+        self.embedder_kwargs = embedder_kwargs
+        self.pool = None
+        self.dimension = None
+
+    def warm_up(self) -> None:
+        # starts the workers and loads the model replicas, the pool is reused by every run until close
+        if self.pool is not None:
+            return
+        # spawned workers do not inherit the torch threads and locks of the parent process
+        self.pool = get_context("spawn").Pool(self.n_workers, initializer=_init_worker,
+                                              initargs=(self.model, self.threads_per_worker, self.embedder_kwargs))
+        self.dimension = self.pool.apply(_dimension)
+
+    def run(self, documents:List[Document]) -> dict:
+        # sets the embedding of every document like SentenceTransformersDocumentEmbedder
+        if not documents:
+            return {"documents": []}
+        self.warm_up()
+        shape = (len(documents), self.dimension)
+        # small shards balance the load, but every worker gets at least one
+        shard_size = max(1, min(self.shard_size, -(-len(documents) // self.n_workers)))
+        shm = SharedMemory(create=True, size=len(documents) * self.dimension * np.dtype(np.float32).itemsize)
+        try:
+            shards = [(shm.name, shape, start, documents[start:start + shard_size]) for start in range(0, len(documents), shard_size)]
+            self.pool.starmap(_embed_shard, shards, chunksize=1)
+            matrix = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            for doc, embedding in zip(documents, matrix):
+                doc.embedding = embedding.tolist()
+            del matrix
+        finally:
+            shm.close()
+            shm.unlink()
+        return {"documents": documents}
+
+    def close(self) -> None:
+        # stops the workers, a later run starts a new pool
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -1,6 +1,13 @@
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
 import pandas as pd
 
+from src.dedup import DuplicateFinder, find_duplicate_clusters
+from src.corpus_stream import iter_json_object, batched
+
 def clean_up_lyrics(lyrics: str) -> str:
     # Replace all newline characters with a space
     lyrics = lyrics.replace('\n', ' ')
@@ -22,39 +29,79 @@ def clean_up_lyrics(lyrics: str) -> str:
     return lyrics
 
 
+# The rules of clean_up_lyrics prepared once. They run over all songs joined by '\n', which cannot occur
+# in a song after the newline replacement: '.' does not match it, so '\[.*?\]' never spans two songs,
+# and the whitespace rule excludes it, so the songs stay separated.
+BRACKETS_PATTERN = re.compile(r'\[.*?\]')
+NON_ASCII_PATTERN = re.compile(r'[^\x00-\x7F]+')
+# after removing non-ASCII the special characters are a fixed set, deleting them with translate is much faster
+SPECIAL_CHARS_TABLE = str.maketrans('', '', ''.join(c for c in map(chr, range(128)) if re.match(r'[^\w\s\.,]', c)))
+# only ASCII whitespace is left at that point: it is turned into spaces and runs of spaces are collapsed
+WHITESPACE_TABLE = str.maketrans({c: ' ' for c in map(chr, range(128)) if c != '\n' and re.match(r'\s', c)})
+
+def _clean_up_chunk(lyrics: pd.Series) -> pd.Series:
+    corpus = '\n'.join(song.replace('\n', ' ') for song in lyrics)
+    corpus = BRACKETS_PATTERN.sub('.', corpus)
+    if not corpus.isascii():
+        corpus = NON_ASCII_PATTERN.sub(' ', corpus)
+    corpus = corpus.translate(SPECIAL_CHARS_TABLE)
+    corpus = corpus.translate(WHITESPACE_TABLE)
+    while '  ' in corpus:
+        corpus = corpus.replace('  ', ' ')
+    # stripping and the final replacement depend on the song boundaries, so they run per song
+    cleaned = [song.strip('.').strip().replace(' . ', '. ') for song in corpus.split('\n')] if len(lyrics) else []
+    return pd.Series(cleaned, index=lyrics.index, dtype=object)
+
+def clean_up_lyrics_batch(lyrics: pd.Series, n_jobs: int = 1, chunk_size: int = 5000) -> pd.Series:
+    # Same output as lyrics.apply(clean_up_lyrics), but every regex runs once over the whole Series
+    # With n_jobs > 1 chunks of the Series are cleaned in a process pool, worth it for very large corpora
+    if n_jobs <= 1 or len(lyrics) <= chunk_size:
+        return _clean_up_chunk(lyrics)
+    chunks = [lyrics.iloc[i:i + chunk_size] for i in range(0, len(lyrics), chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return pd.concat(list(executor.map(_clean_up_chunk, chunks)))
+
+def benchmark_clean_up(lyrics: pd.Series, n_jobs: int = 1) -> dict:
+    # Compare row-wise and batch cleaning: outputs must be identical, reports songs/sec of both
+    start = time.perf_counter()
+    expected = lyrics.apply(clean_up_lyrics)
+    rowwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = clean_up_lyrics_batch(lyrics, n_jobs=n_jobs)
+    batch_time = time.perf_counter() - start
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, result)) if a != b]
+    if mismatches:
+        raise ValueError(f"Batch cleaning differs from clean_up_lyrics for {len(mismatches)} songs, first at position {mismatches[0]}")
+
+    results = {
+        "songs": len(lyrics),
+        "rowwise_songs_per_sec": len(lyrics) / rowwise_time if rowwise_time else float("inf"),
+        "batch_songs_per_sec": len(lyrics) / batch_time if batch_time else float("inf"),
+    }
+    print(f"Cleaned {results['songs']} songs: row-wise {results['rowwise_songs_per_sec']:.0f} songs/sec, "
+          f"batch {results['batch_songs_per_sec']:.0f} songs/sec")
+    return results
+
 
-def remove_duplicate_songs(df: pd.DataFrame, verbose: bool = False) -> pd.DataFrame:
+
+def remove_duplicate_songs(df: pd.DataFrame, verbose: bool = False, threshold: float = 0.7, report_path: str = None) -> pd.DataFrame:
     # remove all rows where url does not start with https://genius.com/Green-day to exclude cover versions
     df = df[df['url'].str.contains('https://genius.com/Green-day')]
 
     # create new empty column 'song_names'
-    df.loc[:, 'song_names'] = df['url'].str.replace('https://genius.com/Green-day-', '', regex=False)
-
-    # Removing specific substrings from 'song_names' column
-    df.loc[:, 'song_names'] = df['song_names'].str.replace('-lyrics', '', regex=False)
-    df.loc[:, 'song_names'] = df['song_names'].str.replace('-annotated', '', regex=False)
-    df.loc[:, 'song_names'] = df['song_names'].str.replace('-demo', '', regex=False)
-    df.loc[:, 'song_names'] = df['song_names'].str.replace('-', ' ', regex=False)
-
-    # create list of indexes to remove
-    to_remove = []
+    df.loc[:, 'song_names'] = song_names(df['url'])
 
     # reset index
     df = df.reset_index(drop=True)
 
-    # go through all rows and compare the current with the next row, if they are the same, remove the current row 
-    row_to_keep = df['song_names'].iloc[0]
-    for i in range(len(df)-1):
-        # if the substring is part of the next row, remove i row
-        print(f'Compare {row_to_keep} with {df["song_names"].iloc[i+1]}') if verbose else None
-        if row_to_keep in df['song_names'].iloc[i+1]:
-            to_remove.append(i+1)
-            print(f"Will remove row {i+1} with url {df['song_names'].iloc[i+1]}") if verbose else None
-        else:
-            row_to_keep = df['song_names'].iloc[i+1]
-
-    # remove all rows where to_remove is True
-    df = df[~df.index.isin(to_remove)]
+    # cluster variants by normalized title and near-identical lyrics over the whole corpus, keep one song per cluster
+    report = find_duplicate_clusters(df['song_names'], df['lyrics'], threshold=threshold)
+    _print_report(report, verbose, report_path)
+
+    # remove all merged rows
+    df = df[~df.index.isin(report['position'])]
     # reset index
     df = df.reset_index(drop=True)
 
@@ -62,4 +109,52 @@ def remove_duplicate_songs(df: pd.DataFrame, verbose: bool = False) -> pd.DataFr
 
     print("Finished removing duplicates. Added column 'song_names' with cleaned song names.")
 
-    return df
\ No newline at end of file
+    return df
+
+
+def song_names(urls: pd.Series) -> pd.Series:
+    names = urls.str.replace('https://genius.com/Green-day-', '', regex=False)
+    # Removing specific substrings from the song names
+    names = names.str.replace('-lyrics', '', regex=False)
+    names = names.str.replace('-annotated', '', regex=False)
+    names = names.str.replace('-demo', '', regex=False)
+    return names.str.replace('-', ' ', regex=False)
+
+def _print_report(report: pd.DataFrame, verbose: bool, report_path: str) -> None:
+    for _, row in report.iterrows():
+        print(f"Will remove {row['merged']} as duplicate of {row['kept']} ({row['reason']})") if verbose else None
+    if report_path:
+        report.drop(columns='position').to_csv(report_path, index=False)
+        print(f"Saved duplicate cluster report to {report_path}")
+
+def iter_green_day_songs(json_path: str, batch_size: int = 5000, stats: dict = None) -> Iterator[pd.DataFrame]:
+    # Batches of url, lyrics and song_names of the Green Day songs of a raw {url: lyrics} json, streamed from the file
+    # The index is the position among the Green Day songs, it goes on over the batches
+    position = 0
+    for batch in batched(iter_json_object(json_path), batch_size):
+        df = pd.DataFrame(batch, columns=['url', 'lyrics'])
+        # Fix URLs by removing escape characters
+        df['url'] = df['url'].str.replace(r'\\/', '/')
+        df = df[df['url'].str.contains('https://genius.com/Green-day')]
+        df = df.assign(song_names=song_names(df['url'])).set_axis(range(position, position + len(df)))
+        position += len(df)
+        if stats is not None:
+            stats["raw_songs"] = stats.get("raw_songs", 0) + len(batch)
+        yield df
+
+def find_duplicates_in_file(json_path: str, batch_size: int = 5000, verbose: bool = False, threshold: float = 0.7,
+                            report_path: str = None) -> Tuple[pd.DataFrame, List[str]]:
+    # remove_duplicate_songs for a raw json that is streamed twice instead of loaded: the first pass keeps the titles and
+    # MinHash signatures, the second one only the lyrics of LSH candidates and of songs that share their title
+    # Returns the report (positions as in iter_green_day_songs) and the song names of all Green Day songs
+    finder = DuplicateFinder(threshold=threshold)
+    for df in iter_green_day_songs(json_path, batch_size):
+        for title, lyrics in zip(df['song_names'], df['lyrics']):
+            finder.add(title, lyrics)
+    needed = finder.needs_lyrics()
+    for df in iter_green_day_songs(json_path, batch_size):
+        finder.verify((position, lyrics) for position, lyrics in df['lyrics'].items() if position in needed)
+    report = finder.report()
+    _print_report(report, verbose, report_path)
+    print("Finished searching duplicates.")
+    return report, finder.titles
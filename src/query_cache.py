@@ -0,0 +1,227 @@
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+from haystack import Document, component
+from haystack.components.embedders import SentenceTransformersTextEmbedder
+from haystack.components.retrievers.in_memory import InMemoryBM25Retriever, InMemoryEmbeddingRetriever
+
+# LRU caches for the query side of the pipelines:
+# - query embeddings, keyed by the query text (lowercased for models that lowercase their input), they do not depend on the corpus
+# - top-k retrieval results, dropped as soon as the version of the document store changes
+#   (see src/versioned_store.py), stores without a version are not cached
+# The caches are shared by the request threads of server.py, every access holds the lock of the cache.
+# The @component decorator recreates the class, so the components call their parent class explicitly instead of super().
+
+
+def lowercases_input(model) -> bool:
+    # a sentence-transformers model whose tokenizer lowercases (e.g. the uncased MiniLM) embeds "Basket Case" and
+    # "basket case" alike, a cased model does not
+    tokenizer = getattr(model, "tokenizer", None)
+    return bool(getattr(model[0], "do_lower_case", False) or getattr(tokenizer, "do_lower_case", False))
+
+
+_counts_lock = threading.Lock()
+
+
+def add_counts(stats:dict, **counts) -> None:
+    # the stats dicts of the components are updated by several request threads, += on a dict entry is not atomic
+    with _counts_lock:
+        for key, count in counts.items():
+            stats[key] = stats.get(key, 0) + count
+
+
+class LRUCache():
+    def __init__(self, max_size:int = 1024) -> None:
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # reentrant, RetrievalCache holds it around the calls of the LRUCache methods
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key:Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key:Hashable, value:Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class RetrievalCache(LRUCache):
+    # retrieval results of one document store, valid for one version of the store
+    def __init__(self, document_store, max_size:int = 1024) -> None:
+        super().__init__(max_size)
+        self.document_store = document_store
+        self.version = None
+
+    def _check_version(self) -> Optional[int]:
+        version = getattr(self.document_store, "version", None)
+        if version != self.version:
+            self.clear()
+            self.version = version
+        return version
+
+    def current_version(self) -> Optional[int]:
+        return getattr(self.document_store, "version", None)
+
+    def get(self, key:Hashable) -> Optional[List[Document]]:
+        with self._lock:
+            if self._check_version() is None:
+                return None
+            documents = super().get(key)
+        # downstream components (e.g. the ranker) set scores on the documents, every caller gets its own copies
+        return [replace(doc) for doc in documents] if documents is not None else None
+
+    def put(self, key:Hashable, documents:List[Document], version:Optional[int] = None) -> None:
+        # version: the store version the documents were retrieved at (current_version() before the retrieval),
+        # results of a store that changed in the meantime are not cached
+        documents = [replace(doc) for doc in documents]
+        with self._lock:
+            current = self._check_version()
+            if current is not None and (version is None or version == current):
+                super().put(key, documents)
+
+
+def filters_key(filters:Optional[Dict[str, Any]]) -> Optional[str]:
+    return json.dumps(filters, sort_keys=True, default=str) if filters else None
+
+
+def embedding_key(query_embedding) -> bytes:
+    return np.asarray(query_embedding, dtype=np.float32).tobytes()
+
+
+@component
+class CachedTextEmbedder(SentenceTransformersTextEmbedder):
+    """
+    SentenceTransformersTextEmbedder with an LRU cache of query embeddings, repeated queries skip the model.
+    """
+
+    def __init__(self, *args, cache_size:int = 1024, **kwargs) -> None:
+        SentenceTransformersTextEmbedder.__init__(self, *args, **kwargs)
+        self.cache_size = cache_size
+        self.cache = LRUCache(cache_size)
+        self._lowercase = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = SentenceTransformersTextEmbedder.to_dict(self)
+        data["init_parameters"]["cache_size"] = self.cache_size
+        return data
+
+    def cache_key(self, text:str) -> str:
+        # text with prefix and suffix, the exact text unless the model lowercases it anyway
+        if self._lowercase is None:
+            if not hasattr(self, "embedding_backend"):
+                # run() needs warm_up() before it embeds anything, so no key of a cold embedder is ever stored
+                return text
+            self._lowercase = lowercases_input(self.embedding_backend.model)
+        return text.lower() if self._lowercase else text
+
+    @component.output_types(embedding=List[float])
+    def run(self, text:str):
+        key = self.cache_key(self.prefix + text + self.suffix)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            embedding = SentenceTransformersTextEmbedder.run(self, text=text)["embedding"]
+            self.cache.put(key, embedding)
+        return {"embedding": list(embedding)}
+
+
+@component
+class CachedEmbeddingRetriever(InMemoryEmbeddingRetriever):
+    """
+    InMemoryEmbeddingRetriever with an LRU cache of the top-k results, invalidated when the store changes.
+    """
+
+    def __init__(self, *args, cache_size:int = 1024, **kwargs) -> None:
+        InMemoryEmbeddingRetriever.__init__(self, *args, **kwargs)
+        self.cache_size = cache_size
+        self.cache = RetrievalCache(self.document_store, cache_size)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = InMemoryEmbeddingRetriever.to_dict(self)
+        data["init_parameters"]["cache_size"] = self.cache_size
+        return data
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query_embedding:List[float],
+        filters:Optional[Dict[str, Any]] = None,
+        top_k:Optional[int] = None,
+        scale_score:Optional[bool] = None,
+        return_embedding:Optional[bool] = None,
+    ):
+        # the store can be swapped after creation (see NLP_pipeline.load_pipeline)
+        self.cache.document_store = self.document_store
+        key = (embedding_key(query_embedding), filters_key(filters if filters is not None else self.filters),
+               top_k or self.top_k, scale_score, return_embedding)
+        version = self.cache.current_version()
+        documents = self.cache.get(key)
+        if documents is None:
+            documents = InMemoryEmbeddingRetriever.run(self, query_embedding, filters, top_k, scale_score, return_embedding)["documents"]
+            self.cache.put(key, documents, version)
+        return {"documents": documents}
+
+
+@component
+class CachedBM25Retriever(InMemoryBM25Retriever):
+    """
+    InMemoryBM25Retriever with an LRU cache of the top-k results, invalidated when the store changes.
+    """
+
+    def __init__(self, *args, cache_size:int = 1024, **kwargs) -> None:
+        InMemoryBM25Retriever.__init__(self, *args, **kwargs)
+        self.cache_size = cache_size
+        self.cache = RetrievalCache(self.document_store, cache_size)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = InMemoryBM25Retriever.to_dict(self)
+        data["init_parameters"]["cache_size"] = self.cache_size
+        return data
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query:str,
+        filters:Optional[Dict[str, Any]] = None,
+        top_k:Optional[int] = None,
+        scale_score:Optional[bool] = None,
+    ):
+        self.cache.document_store = self.document_store
+        # queries with the same BM25 tokens have the same scores
+        key = (tuple(self.document_store._tokenize_bm25(query)), filters_key(filters if filters is not None else self.filters), top_k or self.top_k, scale_score)
+        version = self.cache.current_version()
+        documents = self.cache.get(key)
+        if documents is None:
+            documents = InMemoryBM25Retriever.run(self, query, filters, top_k, scale_score)["documents"]
+            self.cache.put(key, documents, version)
+        return {"documents": documents}
@@ -0,0 +1,51 @@
+import time
+import asyncio
+import weakref
+import threading
+from typing import Optional
+
+
+class TokenBucket():
+    # allows `rate` tokens per second on average and bursts of up to `capacity` tokens
+    def __init__(self, rate:float, capacity:Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # the bucket can be shared by several threads and event loops (e.g. consecutive or parallel asyncio.run calls)
+        self._thread_lock = threading.Lock()
+        self._loop_locks = weakref.WeakKeyDictionary()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait_time(self, tokens:float) -> float:
+        # a request bigger than the bucket waits for a full bucket and then takes it into debt
+        needed = min(tokens, self.capacity)
+        with self._thread_lock:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= tokens
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    async def acquire(self, tokens:float = 1.0) -> None:
+        # an asyncio lock belongs to one event loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._loop_locks:
+            self._loop_locks[loop] = asyncio.Lock()
+        async with self._loop_locks[loop]:
+            while (wait := self._wait_time(tokens)) > 0:
+                await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens:float = 1.0) -> None:
+        while (wait := self._wait_time(tokens)) > 0:
+            time.sleep(wait)
+
+    def credit(self, tokens:float) -> None:
+        # correct an estimate after the fact, a negative value charges the difference
+        with self._thread_lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + tokens)
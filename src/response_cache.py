@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# Two-tier cache for generator replies, persisted in SQLite:
+# - exact: key is the hash of model, system_prompt, generation_kwargs and the rendered prompt
+# - semantic: prompts with the same model, system_prompt and generation_kwargs (the scope) whose embeddings
+#   have a cosine similarity above the threshold share the reply
+# Entries expire after ttl seconds, above max_entries the least recently used ones are evicted.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY, scope TEXT, prompt TEXT, response TEXT, embedding BLOB, created_at REAL, last_used REAL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def scope_key(model:str, system_prompt:Optional[str], generation_kwargs:Dict[str, Any]) -> str:
+    data = json.dumps({"model": model, "system_prompt": system_prompt, "generation_kwargs": generation_kwargs}, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def exact_key(scope:str, prompt:str) -> str:
+    return hashlib.sha256(f"{scope}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache():
+    def __init__(
+        self,
+        path:str = "cache/responses.sqlite",
+        max_entries:int = 10000,
+        ttl:Optional[float] = 7 * 24 * 3600,
+        embedder = None,
+        similarity_threshold:float = 0.95,
+        cache_sampled:bool = False,
+    ) -> None:
+        # embedder is a text embedder component like SentenceTransformersTextEmbedder, without it only the exact tier is used
+        # replies sampled with temperature > 0 (or without a temperature) are only cached with cache_sampled=True
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.cache_sampled = cache_sampled
+        self.metrics = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "skipped": 0}
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        # normalized embeddings per scope for the semantic tier, built from the table on first use
+        self._scopes: Dict[str, Any] = {}
+        # a miss embeds the prompt in lookup, store reuses that embedding
+        self._last_embedding = (None, None)
+        self.expire()
+        if self.embedder is not None and hasattr(self.embedder, "warm_up"):
+            self.embedder.warm_up()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def cacheable(self, generation_kwargs:Dict[str, Any]) -> bool:
+        return self.cache_sampled or generation_kwargs.get("temperature") == 0
+
+    def lookup(self, model:str, system_prompt:Optional[str], generation_kwargs:Dict[str, Any], prompt:str) -> Optional[dict]:
+        if not self.cacheable(generation_kwargs):
+            self.metrics["skipped"] += 1
+            return None
+        scope = scope_key(model, system_prompt, generation_kwargs)
+        key = exact_key(scope, prompt)
+        with self.lock:
+            response = self._get(key)
+            if response is not None:
+                self.metrics["exact_hits"] += 1
+                return response
+
+        if self.embedder is not None:
+            embedding = self._embed(prompt)
+            with self.lock:
+                keys, matrix = self._scope_matrix(scope)
+                if len(keys):
+                    similarities = matrix @ embedding
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        response = self._get(keys[best])
+                        if response is not None:
+                            self.metrics["semantic_hits"] += 1
+                            return response
+
+        self.metrics["misses"] += 1
+        return None
+
+    def store(self, model:str, system_prompt:Optional[str], generation_kwargs:Dict[str, Any], prompt:str, response:dict) -> None:
+        if not self.cacheable(generation_kwargs):
+            return
+        scope = scope_key(model, system_prompt, generation_kwargs)
+        key = exact_key(scope, prompt)
+        embedding = self._embed(prompt) if self.embedder is not None else None
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, prompt, json.dumps(response), embedding.tobytes() if embedding is not None else None, now, now),
+            )
+            self.connection.commit()
+            self._scopes.pop(scope, None)
+            self.metrics["stores"] += 1
+            self._evict()
+
+    def expire(self) -> None:
+        if self.ttl is None:
+            return
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+            self.connection.commit()
+            if removed:
+                self._scopes.clear()
+                self.metrics["evictions"] += removed
+
+    def stats(self) -> dict:
+        hits = self.metrics["exact_hits"] + self.metrics["semantic_hits"]
+        lookups = hits + self.metrics["misses"]
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {**self.metrics, "entries": entries, "hit_rate": hits / lookups if lookups else 0.0}
+
+    def _get(self, key:str) -> Optional[dict]:
+        row = self.connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.connection.commit()
+            self._scopes.clear()
+            self.metrics["evictions"] += 1
+            return None
+        self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return json.loads(row[0])
+
+    def _evict(self) -> None:
+        # least recently used entries above max_entries
+        removed = self.connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self.connection.commit()
+        if removed:
+            self._scopes.clear()
+            self.metrics["evictions"] += removed
+
+    def _embed(self, prompt:str) -> np.ndarray:
+        last_prompt, last_embedding = self._last_embedding
+        if last_prompt == prompt:
+            return last_embedding
+        embedding = np.asarray(self.embedder.run(text=prompt)["embedding"], dtype=np.float32)
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        self._last_embedding = (prompt, embedding)
+        return embedding
+
+    def _scope_matrix(self, scope:str):
+        if scope not in self._scopes:
+            rows = self.connection.execute(
+                "SELECT key, embedding FROM responses WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+            ).fetchall()
+            keys = [key for key, _ in rows]
+            matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]) if rows else np.zeros((0, 0), dtype=np.float32)
+            self._scopes[scope] = (keys, matrix)
+        return self._scopes[scope]
@@ -0,0 +1,65 @@
+from typing import Dict, Iterator, List, Tuple
+
+from haystack import Document
+
+from src.chunking import split_songs
+from src.embedding_cache import hash_text
+
+# Bookkeeping for incremental index updates. Every document of a song carries the title (the song_names of the
+# preprocessed json) and the hash of the song lyrics in its meta, so the document ids only change with the lyrics.
+# The song index maps each title to its lyrics hash and document ids:
+#   {title: {"hash": "<sha256 of the lyrics>", "ids": [document ids of the song or its passages]}}
+# Diffing a new json against it tells which songs have to be embedded, replaced or deleted.
+
+
+def song_documents(songs:Dict[str, str], split_length:int = None, split_overlap:int = 1) -> List[Document]:
+    documents = [Document(content=lyrics, meta={"title": title, "song_hash": hash_text(lyrics)}) for title, lyrics in songs.items()]
+    if split_length:
+        documents = split_songs(documents, split_length=split_length, split_overlap=split_overlap)
+    return documents
+
+
+def add_to_song_index(song_index:Dict[str, dict], documents:List[Document]) -> None:
+    for doc in documents:
+        entry = song_index.setdefault(doc.meta["title"], {"hash": doc.meta.get("song_hash"), "ids": []})
+        entry["ids"].append(doc.id)
+
+
+def _meta_items(document_store) -> Iterator[Tuple[str, dict]]:
+    # a compact storage reads the meta without building the documents (see src/compact_store.py)
+    storage = document_store.storage
+    if hasattr(storage, "meta_items"):
+        return storage.meta_items()
+    return ((doc.id, doc.meta) for doc in storage.values())
+
+
+def stored_contents(document_store) -> Iterator[str]:
+    # a compact storage decodes the contents without building the embeddings
+    storage = document_store.storage
+    if hasattr(storage, "get_document"):
+        return (storage.get_document(doc_id, return_embedding=False).content for doc_id in storage)
+    return (doc.content for doc in storage.values())
+
+
+def song_index_from_store(document_store) -> Dict[str, dict]:
+    # rebuilds the song index of a restored snapshot, documents without a title are not part of any song
+    song_index = {}
+    for doc_id, meta in _meta_items(document_store):
+        if "title" in meta:
+            entry = song_index.setdefault(meta["title"], {"hash": meta.get("song_hash"), "ids": []})
+            entry["ids"].append(doc_id)
+    return song_index
+
+
+def diff_songs(song_index:Dict[str, dict], songs:Dict[str, str]) -> Tuple[List[str], List[str], List[str], List[str]]:
+    # (added, changed, unchanged, removed) titles of songs against the song index
+    added, changed, unchanged = [], [], []
+    for title, lyrics in songs.items():
+        if title not in song_index:
+            added.append(title)
+        elif song_index[title]["hash"] != hash_text(lyrics):
+            changed.append(title)
+        else:
+            unchanged.append(title)
+    removed = [title for title in song_index if title not in songs]
+    return added, changed, unchanged, removed
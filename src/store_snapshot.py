@@ -0,0 +1,80 @@
+import os
+import json
+from collections import Counter
+
+import numpy as np
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from src.helper import load_json
+from src.compact_store import CompactDocumentStore, CompactStorage, CompactBM25Stats
+
+# A snapshot is the CompactStorage layout of a document store, one file per buffer:
+# - store.json: store settings, ids, meta, documents that are not compact, the BM25 vocabulary and document frequencies
+# - text.npy: all contents as one utf-8 buffer, offsets.npy and lengths.npy locate the content of a row in it
+# - embeddings.npy: the embedding matrix of the storage (row i belongs to ids[i]), norms.npy and has_embedding.npy
+# - meta_key_rows.npy: the meta keys of a row as index into the meta keys in store.json
+# - bm25_*.npy: the term frequencies and document lengths of CompactBM25Stats
+# A snapshot is always restored into a CompactDocumentStore, so the embedding matrix can stay a memory map of the file.
+STORE_FILE = "store.json"
+ARRAY_FILES = ["text", "offsets", "lengths", "meta_key_rows", "norms", "has_embedding", "embeddings",
+               "bm25_starts", "bm25_counts", "bm25_doc_lens", "bm25_term_ids", "bm25_tfs"]
+
+
+def save_document_store(document_store:InMemoryDocumentStore, path:str) -> None:
+    os.makedirs(path, exist_ok=True)
+    storage = document_store.storage
+    if not isinstance(storage, CompactStorage):
+        # a plain store is converted first, its embeddings become rows of one matrix
+        storage = CompactStorage(normalize=document_store.embedding_similarity_function == "cosine")
+        for doc_id, doc in document_store.storage.items():
+            storage[doc_id] = doc
+    arrays, state = storage.to_snapshot()
+    bm25 = document_store._bm25_attr
+    if not isinstance(bm25, CompactBM25Stats):
+        # the same for the BM25 statistics, the Counter of each document becomes a slice of the arrays
+        bm25 = CompactBM25Stats()
+        for doc_id, stats in document_store._bm25_attr.items():
+            bm25[doc_id] = stats
+    bm25_arrays, bm25_state = bm25.to_snapshot()
+    arrays.update(bm25_arrays)
+
+    snapshot = {
+        "init_parameters": document_store.to_dict()["init_parameters"],
+        "storage": state,
+        "bm25": {"freq_vocab_for_idf": dict(document_store._freq_vocab_for_idf), **bm25_state},
+    }
+
+    # write to temporary files first so a crash never leaves a half written snapshot behind,
+    # store.json is replaced last, it names the arrays that belong to the snapshot
+    for name in ARRAY_FILES:
+        if name in arrays:
+            np.save(os.path.join(path, f"{name}.tmp.npy"), arrays[name])
+    store_path = os.path.join(path, STORE_FILE)
+    with open(store_path + ".tmp", "w") as f:
+        json.dump({**snapshot, "arrays": sorted(arrays)}, f)
+    for name in ARRAY_FILES:
+        if name in arrays:
+            os.replace(os.path.join(path, f"{name}.tmp.npy"), os.path.join(path, f"{name}.npy"))
+    os.replace(store_path + ".tmp", store_path)
+
+
+def load_document_store(path:str, mmap:bool = True, embedding_dtype:str = "float32") -> CompactDocumentStore:
+    snapshot = load_json(os.path.join(path, STORE_FILE))
+    # with mmap the embedding matrix of the store is a copy-on-write memory map of embeddings.npy: rows are read
+    # from the file on access and writes to the store never change the file; a different embedding_dtype than
+    # the one of the snapshot converts the matrix into memory
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c" if mmap and name == "embeddings" else None)
+              for name in snapshot["arrays"]}
+
+    document_store = CompactDocumentStore(**snapshot["init_parameters"], embedding_dtype=embedding_dtype)
+    document_store.storage = CompactStorage.from_snapshot(arrays, snapshot["storage"], normalize=document_store.storage.normalize,
+                                                          embedding_dtype=embedding_dtype)
+
+    # the BM25 statistics are restored as they are, so no text has to be tokenized again
+    bm25 = snapshot["bm25"]
+    document_store._bm25_attr = CompactBM25Stats.from_snapshot(arrays, bm25)
+    document_store._freq_vocab_for_idf = Counter(bm25["freq_vocab_for_idf"])
+    document_store.count_doc_lengths()
+    document_store.bump_version()
+
+    return document_store
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import uuid
+import resource
+import threading
+import functools
+import contextvars
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Per-component tracing for haystack pipelines: every component.run becomes a span with wall time, CPU time,
+# the increase of the peak RSS, the batch size and, for generators, the token usage from meta["usage"].
+# Spans of one pipeline run share a trace id and are children of a span for the whole run.
+# The batch and scheduled modes of NLP_pipeline and the async generator calls do not run components through a
+# Pipeline, they open their spans explicitly (maybe_span, traced). The current span is a context variable, so
+# concurrent coroutines of one event loop each have their own parent.
+# The CPU time is the one of the process, torch runs its kernels in worker threads.
+# Export formats: "jsonl" (one span per line) or "otel" (OTLP/JSON, e.g. for the file receiver of the collector).
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def batch_size(inputs:Dict[str, Any]) -> int:
+    # number of documents, prompts or texts a component got, 1 for a single query or prompt
+    for name in ("documents", "prompts", "texts"):
+        if isinstance(inputs.get(name), list):
+            return len(inputs[name])
+    return 1
+
+
+def token_usage(outputs:Any) -> Dict[str, int]:
+    # sum of meta["usage"] over all replies, the GroqGenerator reports the OpenAI usage fields
+    usage = defaultdict(int)
+    for meta in (outputs.get("meta") or []) if isinstance(outputs, dict) else []:
+        for key, value in (meta.get("usage") or {}).items():
+            if isinstance(value, (int, float)):
+                usage[key] += value
+    return dict(usage)
+
+
+def maybe_span(tracer:Optional["Tracer"], name:str, attributes:Dict[str, Any] = None, parent:Optional[dict] = None):
+    # tracer.span, or a context without span if tracing is off; both yield a dict of attributes
+    return tracer.span(name, attributes, parent) if tracer is not None else nullcontext({})
+
+
+def traced(name:str):
+    # span around a method of an object with a `tracer` attribute (None: tracing is off),
+    # the batch size is the length of the first argument (the queries or prompts)
+    def decorator(method):
+        @functools.wraps(method)
+        def traced_method(self, items, *args, **kwargs):
+            with maybe_span(getattr(self, "tracer", None), name, {"component": type(self).__name__, "batch_size": len(items)}):
+                return method(self, items, *args, **kwargs)
+        return traced_method
+    return decorator
+
+
+class Tracer():
+    def __init__(self, service_name:str = "rga-playground", max_spans:int = 100000) -> None:
+        self.service_name = service_name
+        self.spans: "deque[dict]" = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self._current = contextvars.ContextVar(f"current_span_{id(self)}", default=None)
+
+    def current_span(self) -> Optional[dict]:
+        return self._current.get()
+
+    @contextmanager
+    def span(self, name:str, attributes:Dict[str, Any] = None, parent:Optional[dict] = None):
+        # yields the attributes of the span, the caller can add to them while it runs
+        # parent: e.g. the current_span() of the thread that handed the work to another thread or event loop
+        parent = parent or self._current.get()
+        span = {
+            "name": name,
+            "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_span_id": parent["span_id"] if parent else None,
+            "start_time": time.time(),
+            "attributes": dict(attributes or {}),
+        }
+        token = self._current.set(span)
+        wall_start, cpu_start, rss_start = time.perf_counter(), time.process_time(), peak_rss_mb()
+        try:
+            yield span["attributes"]
+        except Exception as error:
+            span["error"] = repr(error)
+            raise
+        finally:
+            span["wall_ms"] = 1000 * (time.perf_counter() - wall_start)
+            span["cpu_ms"] = 1000 * (time.process_time() - cpu_start)
+            span["peak_rss_delta_mb"] = peak_rss_mb() - rss_start
+            self._current.reset(token)
+            with self.lock:
+                self.spans.append(span)
+
+    def trace_component(self, name:str, instance) -> None:
+        # replaces run of this instance, the pipeline looks it up on the instance
+        if getattr(instance.run, "__traced__", False):
+            return
+        run = instance.run
+
+        @functools.wraps(run)
+        def traced_run(**inputs):
+            with self.span(name, {"component": type(instance).__name__, "batch_size": batch_size(inputs)}) as attributes:
+                outputs = run(**inputs)
+                usage = token_usage(outputs)
+                if usage:
+                    attributes.update({f"tokens.{key}": value for key, value in usage.items()})
+                return outputs
+
+        traced_run.__traced__ = True
+        instance.run = traced_run
+
+    def trace_pipeline(self, pipeline, name:str) -> None:
+        # every component of the pipeline plus one span around each pipeline run
+        for component_name, instance in pipeline.walk():
+            self.trace_component(component_name, instance)
+        if getattr(pipeline.run, "__traced__", False):
+            return
+        run = pipeline.run
+
+        @functools.wraps(run)
+        def traced_run(*args, **kwargs):
+            with self.span(name, {"component": "Pipeline"}):
+                return run(*args, **kwargs)
+
+        traced_run.__traced__ = True
+        pipeline.run = traced_run
+
+    def summary(self) -> Dict[str, dict]:
+        # p50/p95 of wall and CPU time per stage (component or pipeline name)
+        with self.lock:
+            spans = list(self.spans)
+        stages = defaultdict(list)
+        for span in spans:
+            stages[span["name"]].append(span)
+        summary = {}
+        for name, stage_spans in stages.items():
+            wall = np.array([span["wall_ms"] for span in stage_spans])
+            cpu = np.array([span["cpu_ms"] for span in stage_spans])
+            summary[name] = {
+                "count": len(stage_spans),
+                "wall_p50_ms": float(np.percentile(wall, 50)),
+                "wall_p95_ms": float(np.percentile(wall, 95)),
+                "cpu_p50_ms": float(np.percentile(cpu, 50)),
+                "cpu_p95_ms": float(np.percentile(cpu, 95)),
+                "max_peak_rss_delta_mb": max(span["peak_rss_delta_mb"] for span in stage_spans),
+                "tokens": sum(span["attributes"].get("tokens.total_tokens", 0) for span in stage_spans),
+            }
+        return summary
+
+    def print_summary(self) -> None:
+        print(f"{'stage':<24}{'count':>7}{'wall p50':>11}{'wall p95':>11}{'cpu p50':>11}{'cpu p95':>11}{'rss +MB':>9}{'tokens':>8}")
+        for name, stage in sorted(self.summary().items(), key=lambda item: -item[1]["wall_p50_ms"]):
+            print(f"{name:<24}{stage['count']:>7}{stage['wall_p50_ms']:>9.1f}ms{stage['wall_p95_ms']:>9.1f}ms"
+                  f"{stage['cpu_p50_ms']:>9.1f}ms{stage['cpu_p95_ms']:>9.1f}ms{stage['max_peak_rss_delta_mb']:>9.1f}{stage['tokens']:>8}")
+
+    def _to_otel(self, spans:List[dict]) -> dict:
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        otel_spans = []
+        for span in spans:
+            start = int(span["start_time"] * 1e9)
+            attributes = {**span["attributes"], "wall_ms": span["wall_ms"], "cpu_ms": span["cpu_ms"],
+                          "peak_rss_delta_mb": span["peak_rss_delta_mb"]}
+            otel_span = {
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(start + int(span["wall_ms"] * 1e6)),
+                "attributes": [{"key": key, "value": value(v)} for key, v in attributes.items()],
+                # status code 2 is an error, 0 is unset
+                "status": {"code": 2, "message": span["error"]} if "error" in span else {"code": 0},
+            }
+            if span["parent_span_id"]:
+                otel_span["parentSpanId"] = span["parent_span_id"]
+            otel_spans.append(otel_span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "src.tracing"}, "spans": otel_spans}],
+        }]}
+
+    def export(self, path:str, export_format:str = "jsonl", clear:bool = True) -> int:
+        # appends the finished spans to the file, returns the number of exported spans
+        if export_format not in ("jsonl", "otel"):
+            raise ValueError(f"Unknown export format '{export_format}', choose 'jsonl' or 'otel'")
+        with self.lock:
+            spans = list(self.spans)
+            if clear:
+                self.spans.clear()
+        if not spans:
+            return 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            if export_format == "jsonl":
+                for span in spans:
+                    f.write(json.dumps(span) + "\n")
+            else:
+                # one OTLP export request per line, like the file exporter of the collector
+                f.write(json.dumps(self._to_otel(spans)) + "\n")
+        return len(spans)
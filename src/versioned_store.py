@@ -0,0 +1,63 @@
+from typing import Any, Dict, List
+
+from haystack import Document
+from haystack.core.serialization import generate_qualified_class_name
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+from haystack.document_stores.types import DuplicatePolicy
+
+
+class VersionedInMemoryDocumentStore(InMemoryDocumentStore):
+    """
+    InMemoryDocumentStore with a version counter that changes with every write or delete.
+
+    Caches and indexes built on top of the store compare the version instead of scanning the documents.
+    Code that fills `storage` directly has to call `bump_version()`.
+
+    The average document length of BM25 is the exact mean of the document lengths. The running mean of the
+    InMemoryDocumentStore counts the new document twice and depends on the order of writes and deletes, so an
+    incrementally updated store would score differently than a rebuilt one. Code that fills `_bm25_attr` directly
+    has to call `count_doc_lengths()`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self._total_doc_len = 0
+
+    def bump_version(self) -> None:
+        self.version += 1
+
+    def count_doc_lengths(self) -> None:
+        self._total_doc_len = sum(stats.doc_len for stats in self._bm25_attr.values())
+        self._update_avg_doc_len()
+
+    def _doc_lengths(self, document_ids) -> int:
+        return sum(self._bm25_attr[doc_id].doc_len for doc_id in set(document_ids) if doc_id in self._bm25_attr)
+
+    def _update_avg_doc_len(self) -> None:
+        self._avg_doc_len = self._total_doc_len / len(self._bm25_attr) if self._bm25_attr else 0
+
+    def write_documents(self, documents:List[Document], policy:DuplicatePolicy = DuplicatePolicy.NONE) -> int:
+        document_ids = [doc.id for doc in documents] if isinstance(documents, list) else []
+        before = self._doc_lengths(document_ids)
+        try:
+            return super().write_documents(documents, policy)
+        finally:
+            self._total_doc_len += self._doc_lengths(document_ids) - before
+            self._update_avg_doc_len()
+            self.bump_version()
+
+    def delete_documents(self, document_ids:List[str]) -> None:
+        before = self._doc_lengths(document_ids)
+        try:
+            super().delete_documents(document_ids)
+        finally:
+            self._total_doc_len -= before - self._doc_lengths(document_ids)
+            self._update_avg_doc_len()
+            self.bump_version()
+
+    def to_dict(self) -> Dict[str, Any]:
+        # serialized as a plain InMemoryDocumentStore, the haystack retrievers only deserialize that type
+        data = super().to_dict()
+        data["type"] = generate_qualified_class_name(InMemoryDocumentStore)
+        return data
@@ -1,15 +1,16 @@
-import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 
+from src.http_client import HTTPClient, shared_client
+
 # Function to clean text by removing non-ASCII characters
 def clean_text(text: str) -> str:
     return text.encode('ascii', 'ignore').decode('ascii')
 
 # DEPRATED: Function to scrape the Wikipedia page for song names
-def scrap_wiki_for_songnames(wiki_url: str) -> pd.DataFrame:
+def scrap_wiki_for_songnames(wiki_url: str, client: HTTPClient = None) -> pd.DataFrame:
     # Fetch the content of the page
-    response = requests.get(wiki_url)
+    response = (client or shared_client()).get(wiki_url)
     soup = BeautifulSoup(response.content, 'html.parser')
 
     # Find the specific table with the given classes
@@ -56,9 +57,18 @@ def scrap_wiki_for_songnames(wiki_url: str) -> pd.DataFrame:
     return df
 
 
-def get_from_genius(endpoint: str, access_token: str) -> dict:
-    # Make the GET request
-    response = requests.get(endpoint, headers={'Authorization': 'Bearer ' + access_token})
+def extract_lyrics_from_html(html: str) -> str:
+    # Check if lyrics exist on the page, None if not
+    soup = BeautifulSoup(html, 'html.parser')
+    lyrics_div = soup.find('div', attrs={'data-lyrics-container': 'true'})
+    if lyrics_div:
+        return lyrics_div.get_text(separator='\n')
+    return None
+
+
+def get_from_genius(endpoint: str, access_token: str, client: HTTPClient = None) -> dict:
+    # Make the GET request, the shared client of the token keeps the connection and the Authorization header
+    response = (client or shared_client(access_token)).get(endpoint)
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -71,8 +81,9 @@ def get_from_genius(endpoint: str, access_token: str) -> dict:
         return None
 
     
-def get_artist_id(artist_name: str, access_token: str) -> int:
-    search_endpoint = f'https://api.genius.com/search?q={artist_name}'
-    data = get_from_genius(search_endpoint, access_token)
+def get_artist_id(artist_name: str, access_token: str, client: HTTPClient = None, api_base_url: str = 'https://api.genius.com') -> int:
+    # api_base_url can point to a local stub server (see src/local_stubs.py)
+    search_endpoint = f'{api_base_url}/search?q={artist_name}'
+    data = get_from_genius(search_endpoint, access_token, client)
     return data['response']['hits'][0]['result']['primary_artist']['id']
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the modules of the repository root, e.g. `import src.preprocess_helper`, from any working directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
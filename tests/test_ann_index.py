@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from src.ann_index import FlatIndex, IVFIndex, HNSWIndex, hnswlib, recall_at_k
+
+
+def clustered_vectors(n:int, dim:int = 8, n_clusters:int = 10, seed:int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)) * 5
+    return (centers[rng.integers(n_clusters, size=n)] + rng.normal(size=(n, dim))).astype(np.float32)
+
+
+INDEXES = [FlatIndex, IVFIndex] + ([HNSWIndex] if hnswlib is not None else [])
+
+
+@pytest.mark.parametrize("index_class", INDEXES)
+def test_repeated_ids_keep_the_last_vector(index_class):
+    index = index_class()
+    index.add(["a", "b", "a"], [[1.0, 0.0], [0.0, 1.0], [0.0, 2.0]])
+    assert len(index) == 2
+    ids, scores = index.search([[0.0, 1.0]], top_k=5)
+    assert ids[0] == ["a", "b"]
+    assert scores[0] == pytest.approx([2.0, 1.0])
+
+    # also against an id that is already indexed
+    index.add(["b", "c", "b"], [[5.0, 5.0], [1.0, 1.0], [-1.0, 0.0]])
+    ids, scores = index.search([[1.0, 0.0]], top_k=5)
+    assert sorted(ids[0]) == ["a", "b", "c"]
+    assert dict(zip(ids[0], scores[0]))["b"] == pytest.approx(-1.0)
+
+
+def test_recall_at_k():
+    vectors = clustered_vectors(500)
+    ids = [str(i) for i in range(len(vectors))]
+    queries = clustered_vectors(20, seed=1)
+    exact = FlatIndex()
+    exact.build(ids, vectors)
+    assert recall_at_k(exact, exact, queries, k=10) == 1.0
+
+    probe_all = IVFIndex(n_lists=10, n_probe=10)
+    probe_all.build(ids, vectors)
+    assert recall_at_k(probe_all, exact, queries, k=10) == 1.0
+
+    probe_one = IVFIndex(n_lists=20, n_probe=1)
+    probe_one.build(ids, vectors)
+    assert 0.0 < recall_at_k(probe_one, exact, queries, k=10) < 1.0
+
+    # half of the exact top-k
+    class HalfIndex():
+        def search(self, query_vectors, top_k):
+            exact_ids, exact_scores = exact.search(query_vectors, top_k)
+            return [row[:top_k // 2] for row in exact_ids], [row[:top_k // 2] for row in exact_scores]
+
+    assert recall_at_k(HalfIndex(), exact, queries, k=10) == 0.5
+
+
+def test_ivf_retrains_after_the_index_doubled():
+    vectors = clustered_vectors(400)
+    ids = [str(i) for i in range(len(vectors))]
+    index = IVFIndex(n_probe=64)
+    index.build(ids[:100], vectors[:100])
+    assert (index._trained_size, len(index.lists)) == (100, 10)
+
+    # twice the trained size: the new vectors go into the existing clusters
+    index.add(ids[100:200], vectors[100:200])
+    assert (index._trained_size, len(index.lists)) == (100, 10)
+    # more than twice: k-means runs again on all vectors
+    index.add(ids[200:201], vectors[200:201])
+    assert (index._trained_size, len(index.lists)) == (201, 14)
+    assert sorted(np.concatenate(index.lists).tolist()) == list(range(201))
+
+    # the doubling counts the alive vectors: 51 left plus 199 new stay below 2 * 201
+    index.remove(ids[:150])
+    index.add(ids[201:], vectors[201:])
+    assert (index._trained_size, len(index)) == (201, 250)
+
+    exact = FlatIndex()
+    exact.build(ids[150:], vectors[150:])
+    assert recall_at_k(index, exact, clustered_vectors(20, seed=1), k=10) == 1.0
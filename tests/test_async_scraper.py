@@ -0,0 +1,76 @@
+import time
+import asyncio
+from urllib.parse import urlsplit
+
+import pytest
+
+from src.async_scraper import AsyncGeniusScraper
+from src.fetch_cache import FetchCache
+from src.local_stubs import start_genius_stub
+
+
+@pytest.fixture
+def stub():
+    # 60 songs are two pages of the songs endpoint
+    server, url = start_genius_stub(n_songs=60)
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+def scraper(url:str, cache:FetchCache = None, **kwargs) -> AsyncGeniusScraper:
+    # a backoff of 30s would time out the tests, only the Retry-After of the stub keeps retries fast
+    return AsyncGeniusScraper("stub", requests_per_second=None, backoff=30.0, api_base_url=url, web_base_url=url,
+                              cache=cache, **kwargs)
+
+
+def requests_seen(server) -> int:
+    return server.RequestHandlerClass.requests_seen
+
+
+def test_retries_follow_retry_after(stub):
+    server, url = stub
+    # every third request is answered with 429 and Retry-After: 0
+    server.RequestHandlerClass.fail_every = 3
+    genius = scraper(url)
+    start = time.perf_counter()
+    lyrics, missing = asyncio.run(genius.scrape_artist(1))
+    assert time.perf_counter() - start < 10
+    assert len(lyrics) == 60 and missing == {}
+
+    # 2 pages and 60 lyrics pages, one in three attempts failed
+    stats = genius.stats()[urlsplit(url).netloc]
+    assert stats["requests"] == requests_seen(server)
+    assert stats["retries"] == requests_seen(server) // 3
+    assert stats["requests"] == 62 + stats["retries"]
+
+
+def test_second_run_resumes_without_requests(stub, tmp_path):
+    server, url = stub
+    cache = FetchCache(str(tmp_path / "cache.sqlite"))
+    lyrics, missing = asyncio.run(scraper(url, cache).scrape_artist(1))
+    assert len(lyrics) == 60 and missing == {}
+    seen = requests_seen(server)
+
+    # completed pages are fresh and all lyrics are stored
+    second = scraper(url, cache)
+    assert asyncio.run(second.scrape_artist(1)) == (lyrics, missing)
+    assert requests_seen(server) == seen
+    assert second.stats() == {}
+    cache.close()
+
+
+def test_stale_pages_are_revalidated_with_the_etag(stub, tmp_path):
+    server, url = stub
+    cache = FetchCache(str(tmp_path / "cache.sqlite"))
+    lyrics, _ = asyncio.run(scraper(url, cache).scrape_artist(1))
+    seen = requests_seen(server)
+
+    # with page_max_age 0 every page is stale: the two pages are requested again with If-None-Match, the stub
+    # answers 304 without body and the lyrics come from the cache
+    second = scraper(url, cache, page_max_age=0)
+    assert asyncio.run(second.scrape_artist(1))[0] == lyrics
+    assert requests_seen(server) == seen + 2
+    stats = second.stats()[urlsplit(url).netloc]
+    assert stats["requests"] == 2 and stats["bytes"] == 0
+    cache.close()
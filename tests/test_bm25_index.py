@@ -0,0 +1,98 @@
+import pytest
+from haystack import Document
+from haystack.components.retrievers.in_memory import InMemoryBM25Retriever
+from haystack.document_stores.types import DuplicatePolicy
+
+from src.bm25_index import IndexedBM25Retriever
+from src.benchmark_helper import make_synthetic_corpus, make_queries
+from src.compact_store import CompactDocumentStore
+from src.versioned_store import VersionedInMemoryDocumentStore
+
+TOP_KS = [1, 5, 10, 50]
+
+
+def song_documents(corpus:dict) -> list:
+    return [Document(content=lyrics, meta={"title": title}) for title, lyrics in corpus.items()]
+
+
+def assert_same_as_store(retriever:IndexedBM25Retriever, document_store, queries:list) -> None:
+    for top_k in TOP_KS:
+        reference_retriever = InMemoryBM25Retriever(document_store, top_k=top_k)
+        for query in queries:
+            reference = reference_retriever.run(query=query)["documents"]
+            indexed = retriever.run(query=query, top_k=top_k)["documents"]
+            assert [doc.id for doc in indexed] == [doc.id for doc in reference], (query, top_k)
+            assert [doc.score for doc in indexed] == [doc.score for doc in reference], (query, top_k)
+
+
+@pytest.fixture(params=["versioned", "compact"])
+def document_store(request):
+    if request.param == "compact":
+        return CompactDocumentStore()
+    return VersionedInMemoryDocumentStore()
+
+
+def test_parity_after_incremental_writes_and_deletes(document_store):
+    # a small vocabulary, so queries match many documents with tied scores
+    corpus = make_synthetic_corpus(400, words_per_song=60, vocabulary_size=300)
+    queries = make_queries(corpus, n_queries=20) + ["a query without any known token", "zzz"]
+    documents = song_documents(corpus)
+    document_store.write_documents(documents[:300])
+    retriever = IndexedBM25Retriever(document_store)
+    retriever.sync()
+    assert_same_as_store(retriever, document_store, queries)
+
+    # new songs
+    version = document_store.version
+    document_store.write_documents(documents[300:350])
+    retriever.update([doc.id for doc in documents[300:350]], [], since_version=version)
+    assert_same_as_store(retriever, document_store, queries)
+
+    # deleted songs
+    version = document_store.version
+    removed = [doc.id for doc in documents[10:60]]
+    document_store.delete_documents(removed)
+    retriever.update([], removed, since_version=version)
+    assert_same_as_store(retriever, document_store, queries)
+
+    # changed songs: the old documents are deleted and the new ones written, like NLP_pipeline.upsert_songs
+    version = document_store.version
+    changed = [Document(content=doc.content + " encore encore", meta=doc.meta) for doc in documents[100:120]]
+    removed = [doc.id for doc in documents[100:120]]
+    document_store.delete_documents(removed)
+    document_store.write_documents(changed + documents[350:], policy=DuplicatePolicy.OVERWRITE)
+    retriever.update([doc.id for doc in changed + documents[350:]], removed, since_version=version)
+    assert_same_as_store(retriever, document_store, queries)
+    assert not retriever._needs_sync()
+
+
+def test_parity_after_unannounced_change(document_store):
+    # a write without update() is noticed by the version and the index is rebuilt
+    corpus = make_synthetic_corpus(200, words_per_song=60, vocabulary_size=300)
+    documents = song_documents(corpus)
+    document_store.write_documents(documents[:150])
+    retriever = IndexedBM25Retriever(document_store)
+    retriever.sync()
+    document_store.write_documents(documents[150:])
+    assert_same_as_store(retriever, document_store, make_queries(corpus, n_queries=10))
+
+
+def test_duplicate_ids_in_one_update(document_store):
+    corpus = make_synthetic_corpus(100, words_per_song=60, vocabulary_size=300)
+    documents = song_documents(corpus)
+    document_store.write_documents(documents[:80])
+    retriever = IndexedBM25Retriever(document_store)
+    retriever.sync()
+
+    version = document_store.version
+    added = [doc.id for doc in documents[80:]]
+    document_store.write_documents(documents[80:])
+    retriever.update(added + added[:5], [], since_version=version)
+    assert len(retriever.index) == len(document_store.storage)
+
+    # the deleted ids must not survive in a second row
+    version = document_store.version
+    document_store.delete_documents(added[:5])
+    retriever.update([], added[:5], since_version=version)
+    queries = make_queries(corpus, n_queries=10) + [documents[80].content]
+    assert_same_as_store(retriever, document_store, queries)
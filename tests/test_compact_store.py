@@ -0,0 +1,106 @@
+import tracemalloc
+from collections import Counter
+
+from haystack import Document
+from haystack.document_stores.in_memory.document_store import BM25DocumentStats
+from haystack.document_stores.types import DuplicatePolicy
+
+from src.benchmark_helper import make_synthetic_corpus, make_queries
+from src.compact_store import CompactBM25Stats, CompactDocumentStore
+from src.store_snapshot import save_document_store, load_document_store
+from src.versioned_store import VersionedInMemoryDocumentStore
+
+
+def write_corpus(document_store, corpus:dict) -> list:
+    documents = [Document(content=lyrics, meta={"title": title}) for title, lyrics in corpus.items()]
+    document_store.write_documents(documents)
+    return documents
+
+
+def assert_same_bm25(document_store, reference) -> None:
+    assert sorted(document_store._bm25_attr) == sorted(reference._bm25_attr)
+    for doc_id, expected in reference._bm25_attr.items():
+        stats = document_store._bm25_attr[doc_id]
+        assert dict(stats.freq_token.items()) == dict(expected.freq_token)
+        assert stats.doc_len == expected.doc_len
+    assert document_store._avg_doc_len == reference._avg_doc_len
+
+
+def test_flat_statistics_match_the_counters():
+    corpus = make_synthetic_corpus(300, words_per_song=60, vocabulary_size=500)
+    store, reference = CompactDocumentStore(), VersionedInMemoryDocumentStore()
+    for document_store in (store, reference):
+        documents = write_corpus(document_store, corpus)
+        # overwrites and deletes leave dead rows behind
+        document_store.write_documents([Document(id=doc.id, content="basket case " * 3, meta=doc.meta) for doc in documents[:20]],
+                                       policy=DuplicatePolicy.OVERWRITE)
+        document_store.delete_documents([doc.id for doc in documents[20:60]])
+    assert isinstance(store._bm25_attr, CompactBM25Stats)
+    assert_same_bm25(store, reference)
+
+    stats = store._bm25_attr[documents[0].id].freq_token
+    assert stats["basket"] == 3 and stats.get("paradise", 0) == 0 and "case" in stats
+
+    store._bm25_attr.compact()
+    assert_same_bm25(store, reference)
+    for query in make_queries(corpus, n_queries=10) + ["basket case"]:
+        expected = reference.bm25_retrieval(query, top_k=10)
+        assert [(doc.id, doc.score) for doc in store.bm25_retrieval(query, top_k=10)] == [(doc.id, doc.score) for doc in expected]
+
+
+def test_popped_statistics_survive_compaction():
+    stats = CompactBM25Stats()
+    for i in range(3000):
+        stats[str(i)] = BM25DocumentStats(Counter({f"token{i % 7}": i % 5 + 1, "shared": 1}), i % 5 + 2)
+    popped = [stats.pop(str(i)) for i in range(2000)]
+    # compacted once more than 1024 rows and more than half of all rows were dead, at the 1501st pop
+    assert len(stats) == 1000 and len(stats._ids) == 1499
+    assert popped[0].freq_token == {"token0": 1, "shared": 1} and popped[0].doc_len == 2
+    assert popped[-1].freq_token == {"token4": 5, "shared": 1} and popped[-1].doc_len == 6
+    assert dict(stats["2999"].freq_token.items()) == {"token3": 5, "shared": 1}
+    assert stats.pop("missing", None) is None
+
+
+def test_snapshot_round_trip_keeps_the_statistics(tmp_path):
+    corpus = make_synthetic_corpus(200, words_per_song=40, vocabulary_size=300)
+    for document_store in (CompactDocumentStore(), VersionedInMemoryDocumentStore()):
+        documents = write_corpus(document_store, corpus)
+        document_store.delete_documents([doc.id for doc in documents[:10]])
+        path = tmp_path / type(document_store).__name__
+        save_document_store(document_store, str(path))
+        restored = load_document_store(str(path))
+        assert isinstance(restored._bm25_attr, CompactBM25Stats)
+        assert_same_bm25(restored, document_store)
+        assert restored._freq_vocab_for_idf == document_store._freq_vocab_for_idf
+
+        # the restored statistics keep following writes and deletes
+        restored.write_documents([Document(content="a new song about paradise")])
+        restored.delete_documents([doc.id for doc in documents[10:20]])
+        assert len(restored._bm25_attr) == len(corpus) - 19
+
+
+def test_flat_statistics_use_less_memory():
+    corpus = make_synthetic_corpus(2000, words_per_song=100, vocabulary_size=2000)
+    reference = VersionedInMemoryDocumentStore()
+    write_corpus(reference, corpus)
+    counters = list(reference._bm25_attr.items())
+
+    def allocated(build) -> tuple:
+        tracemalloc.start()
+        try:
+            result = build()
+            return tracemalloc.get_traced_memory()[0], result
+        finally:
+            tracemalloc.stop()
+
+    def build_flat():
+        stats = CompactBM25Stats()
+        for doc_id, doc_stats in counters:
+            stats[doc_id] = doc_stats
+        return stats
+
+    dict_bytes, _ = allocated(lambda: {doc_id: BM25DocumentStats(Counter(stats.freq_token), stats.doc_len) for doc_id, stats in counters})
+    flat_bytes, flat = allocated(build_flat)
+    assert flat_bytes * 2 < dict_bytes
+    # the arrays hold the term frequencies: 8 bytes per distinct token of a document plus 20 bytes per document
+    assert flat.memory_usage() == 8 * sum(len(stats.freq_token) for _, stats in counters) + 20 * len(counters)
@@ -0,0 +1,50 @@
+import json
+
+import pandas as pd
+
+from src.benchmark_helper import make_synthetic_corpus, make_raw_lyrics
+from src.dedup import find_duplicate_clusters
+from src.preprocess_helper import find_duplicates_in_file, iter_green_day_songs, remove_duplicate_songs
+
+
+def raw_lyrics() -> pd.DataFrame:
+    raw = make_raw_lyrics(make_synthetic_corpus(500, words_per_song=80, seed=1), duplicate_share=0.1)
+    extra = pd.DataFrame([
+        # the same song name with different lyrics, the lyrics break the tie of the kept song
+        ("https://genius.com/Green-day-song-5-demo-lyrics", "x y z " * 30),
+        ("https://genius.com/Green-day-song-5-annotated", "a b c " * 30),
+        # a re-upload under another title
+        ("https://genius.com/Green-day-reupload-lyrics", raw["lyrics"].iloc[7]),
+        # a cover, not a Green Day song
+        ("https://genius.com/Other-band-song-1-lyrics", raw["lyrics"].iloc[1]),
+    ], columns=["url", "lyrics"])
+    return pd.concat([raw, extra], ignore_index=True)
+
+
+def test_streamed_duplicates_match_remove_duplicate_songs(tmp_path):
+    raw = raw_lyrics()
+    json_path = str(tmp_path / "lyrics.json")
+    with open(json_path, "w") as f:
+        json.dump(dict(zip(raw["url"], raw["lyrics"])), f)
+
+    expected = remove_duplicate_songs(raw, report_path=str(tmp_path / "expected.csv"))
+    report, titles = find_duplicates_in_file(json_path, batch_size=64, report_path=str(tmp_path / "streamed.csv"))
+    assert (tmp_path / "expected.csv").read_text() == (tmp_path / "streamed.csv").read_text()
+
+    songs = pd.concat(list(iter_green_day_songs(json_path, batch_size=64)))
+    assert list(songs["song_names"]) == titles
+    kept = songs[~songs.index.isin(report["position"])]
+    assert list(kept["song_names"]) == list(expected["song_names"])
+    assert list(kept["lyrics"]) == list(expected["lyrics"])
+    assert "reupload" not in set(kept["song_names"])
+
+
+def test_oversized_buckets_are_skipped():
+    # 60 songs with the same placeholder text fill one bucket per band
+    titles = pd.Series([f"song {i}" for i in range(60)] + ["original", "re-upload"])
+    lyrics = pd.Series(["lyrics for this song have yet to be released"] * 60 + ["one two three four five six seven"] * 2)
+    report = find_duplicate_clusters(titles, lyrics)
+    assert list(zip(report["kept"], report["merged"])) == [("original", "re-upload")]
+
+    report = find_duplicate_clusters(titles, lyrics, max_bucket_size=100)
+    assert len(report) == 59 + 1
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+
+import numpy as np
+from haystack import Document
+
+from src.embedding_cache import EmbeddingCache, hash_text, model_to_dirname
+
+
+class FakeDocumentEmbedder():
+    # the interface of SentenceTransformersDocumentEmbedder, counts the documents it embeds
+    def __init__(self) -> None:
+        self.embedded = 0
+
+    def warm_up(self) -> None:
+        pass
+
+    def run(self, documents):
+        self.embedded += len(documents)
+        for doc in documents:
+            doc.embedding = [float(len(doc.content)), float(sum(map(ord, doc.content)) % 97), 1.0]
+        return {"documents": documents}
+
+
+def docs(*contents) -> list:
+    return [Document(content=content) for content in contents]
+
+
+def test_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    embedder = FakeDocumentEmbedder()
+    cache.embed_documents(docs("a", "b", "c"), embedder)
+    cache.embed_documents(docs("a", "b", "d"), embedder)
+    assert (cache.hits, cache.misses, embedder.embedded) == (2, 4, 4)
+    assert cache.stats()["hit_rate"] == 2 / 6
+    assert cache.stats()["cached_vectors"] == 4
+
+    # a new session reads the vectors from disk
+    reopened = EmbeddingCache(str(tmp_path), "model")
+    result = reopened.embed_documents(docs("d", "c"), embedder)
+    assert (reopened.hits, reopened.misses, embedder.embedded) == (2, 0, 4)
+    assert result[0].embedding == FakeDocumentEmbedder().run(docs("d"))["documents"][0].embedding
+
+
+def test_keys_are_the_content_hash(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    embedder = FakeDocumentEmbedder()
+    cache.embed_documents([Document(id="1", content="same lyrics", meta={"title": "x"})], embedder)
+    # another id and meta with the same content hit, a changed content misses
+    cache.embed_documents([Document(id="2", content="same lyrics", meta={"title": "y"})], embedder)
+    cache.embed_documents([Document(id="1", content="same lyrics!")], embedder)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert hash_text("same lyrics") in cache.rows
+
+
+def test_flush_appends(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    embedder = FakeDocumentEmbedder()
+    cache.embed_documents(docs("a", "b"), embedder)
+    vectors_path = os.path.join(cache.model_dir, "vectors.f32")
+    inode, first_rows = os.stat(vectors_path).st_ino, open(vectors_path, "rb").read()
+
+    cache.embed_documents(docs("c"), embedder)
+    # the same file, the rows before stay as they are
+    assert os.stat(vectors_path).st_ino == inode
+    assert open(vectors_path, "rb").read()[:len(first_rows)] == first_rows
+    assert os.path.getsize(vectors_path) == 3 * 3 * 4
+
+    # rows behind the count of the manifest (an interrupted flush) are ignored and overwritten
+    with open(vectors_path, "ab") as f:
+        f.write(b"\0" * 12)
+    reopened = EmbeddingCache(str(tmp_path), "model")
+    assert len(reopened) == 3
+    reopened.embed_documents(docs("d"), embedder)
+    assert os.path.getsize(vectors_path) == 4 * 3 * 4
+    assert EmbeddingCache(str(tmp_path), "model").get("d").tolist() == embedder.run(docs("d"))["documents"][0].embedding
+
+
+def test_prune(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    embedder = FakeDocumentEmbedder()
+    cache.embed_documents(docs("a", "b", "c"), embedder)
+    expected = cache.get("c").tolist()
+    cache.prune(["c", "a", "not cached"])
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    reopened = EmbeddingCache(str(tmp_path), "model")
+    assert reopened.get("c").tolist() == expected
+    assert reopened.get("b") is None
+
+    cache.prune([])
+    assert len(EmbeddingCache(str(tmp_path), "model")) == 0
+
+
+def test_legacy_layout_is_migrated(tmp_path):
+    model_dir = tmp_path / model_to_dirname("org/model")
+    model_dir.mkdir()
+    np.save(model_dir / "vectors.npy", np.array([[1, 2], [3, 4]], dtype=np.float32))
+    (model_dir / "manifest.json").write_text(json.dumps({"model": "org/model", "dim": 2, "rows": {hash_text("b"): 1, hash_text("a"): 0}}))
+    cache = EmbeddingCache(str(tmp_path), "org/model")
+    assert cache.get("a").tolist() == [1, 2] and cache.get("b").tolist() == [3, 4]
+    assert not (model_dir / "vectors.npy").exists()
+
+
+def test_evict_stale_models(tmp_path):
+    embedder = FakeDocumentEmbedder()
+    for model in ("old/model", "recent/model", "current/model"):
+        EmbeddingCache(str(tmp_path), model).embed_documents(docs("a"), embedder)
+    month_ago = time.time() - 31 * 24 * 3600
+    os.utime(tmp_path / model_to_dirname("old/model") / "manifest.json", (month_ago, month_ago))
+
+    cache = EmbeddingCache(str(tmp_path), "current/model")
+    assert cache.evict_stale_models(max_age_days=30) == [model_to_dirname("old/model")]
+    assert sorted(os.listdir(tmp_path)) == [model_to_dirname("current/model"), model_to_dirname("recent/model")]
+    # None evicts every other model, the current one stays
+    assert cache.evict_stale_models(max_age_days=None) == [model_to_dirname("recent/model")]
+    assert cache.get("a") is not None
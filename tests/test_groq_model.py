@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from src.groq_model import GroqGenerator
+from src.local_stubs import start_groq_stub
+from src.response_cache import ResponseCache
+
+
+@pytest.fixture
+def generator():
+    server, url = start_groq_stub(reply="a stub reply")
+    generator = GroqGenerator("stub", api_base_url=url, max_retries=0)
+    yield generator
+    generator.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_run_batch_keeps_one_loop_and_client(generator):
+    replies = generator.run_batch(["first", "second", "third"])
+    assert [reply["replies"][0] for reply in replies] == ["a stub reply"] * 3
+    loop = generator._loop
+    client, _ = generator._async_clients[loop]
+
+    generator.run_batch(["fourth"])
+    assert generator._loop is loop
+    assert generator._async_clients[loop][0] is client
+    assert not client.is_closed()
+
+    generator.close()
+    assert client.is_closed()
+    assert not generator._loop_thread
+    # a batch after close starts a new loop
+    assert generator.run_batch(["fifth"])[0]["replies"] == ["a stub reply"]
+    assert generator._loop is not loop
+
+
+def test_run_batch_inside_a_running_event_loop(generator):
+    async def caller():
+        return generator.run_batch(["from a coroutine"])
+
+    assert asyncio.run(caller())[0]["replies"] == ["a stub reply"]
+
+
+def test_run_batch_sends_identical_deterministic_prompts_once(tmp_path):
+    server, url = start_groq_stub(reply="a stub reply")
+    handler = server.RequestHandlerClass
+    cached = GroqGenerator("stub", api_base_url=url, max_retries=0, response_cache=ResponseCache(str(tmp_path / "cache.sqlite")))
+    plain = GroqGenerator("stub", api_base_url=url, max_retries=0)
+    try:
+        prompts = ["a", "b", "a", "a"]
+        replies = cached.run_batch(prompts, generation_kwargs={"temperature": 0})
+        assert handler.requests_seen == 2
+        assert [reply["replies"] for reply in replies] == [["a stub reply"]] * 4
+        # the repeated prompts get copies, not the same dict
+        assert replies[0] == replies[2] and replies[0] is not replies[2]
+        assert cached.run_batch(prompts, generation_kwargs={"temperature": 0})[3]["replies"] == ["a stub reply"]
+        assert handler.requests_seen == 2
+
+        # without a cache temperature 0 is enough, sampled prompts are all sent
+        plain.run_batch(prompts, generation_kwargs={"temperature": 0})
+        assert handler.requests_seen == 4
+        plain.run_batch(prompts, generation_kwargs={"temperature": 0.7})
+        assert handler.requests_seen == 8
+    finally:
+        cached.close()
+        plain.close()
+        server.shutdown()
+        server.server_close()
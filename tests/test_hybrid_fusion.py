@@ -0,0 +1,48 @@
+from haystack import Document
+
+from src.chunking import documents_per_song
+from src.hybrid_fusion import rank_fused
+
+
+def fused(n:int, title_every:int = 1) -> list:
+    # reciprocal rank fusion scores, higher than the scores of the cross-encoder below
+    return [Document(content=f"passage {i}", meta={"title": f"song {i // title_every}"}, score=1 / (60 + i)) for i in range(n)]
+
+
+def fake_rank(queries, heads, top_k):
+    # like batch_rank: sigmoid scores, sorted, cut to top_k or the default top_k of the ranker
+    ranked = []
+    for head in heads:
+        documents = [Document(id=doc.id, content=doc.content, meta=doc.meta, score=0.001 * (i + 1)) for i, doc in enumerate(head)]
+        ranked.append(sorted(documents, key=lambda doc: doc.score, reverse=True)[:top_k or 10])
+    return ranked
+
+
+def test_the_whole_head_is_ranked():
+    documents = fused(30)
+    result = rank_fused(fake_rank, ["query"], [documents], [0.0], top_k=None, head_size=15)[0]
+    assert len(result) == 30
+    # the head in the order of the cross-encoder, the tail in the fused order behind it
+    assert [doc.content for doc in result[:15]] == [f"passage {i}" for i in range(14, -1, -1)]
+    assert [doc.content for doc in result[15:]] == [f"passage {i}" for i in range(15, 30)]
+
+
+def test_tail_scores_stay_below_the_head():
+    documents = fused(20, title_every=2)
+    result = rank_fused(fake_rank, ["query"], [documents], [0.0], top_k=None, head_size=5)[0]
+    scores = [doc.score for doc in result]
+    assert scores == sorted(scores, reverse=True)
+    assert len(set(scores)) == len(scores)
+    assert min(doc.score for doc in result[:5]) > max(doc.score for doc in result[5:])
+    # the fusion score of the tail is kept
+    assert [doc.meta["fusion_score"] for doc in result[5:]] == [doc.score for doc in documents[5:]]
+    # passage 5 is the second passage of song 2, its fusion score is higher than the cross-encoder score of passage 4
+    songs = documents_per_song(result)
+    assert songs[0].content == "passage 4"
+    assert [doc.meta["title"] for doc in songs][:3] == ["song 2", "song 1", "song 0"]
+
+
+def test_skipped_queries_keep_the_fused_scores():
+    documents = fused(12)
+    result = rank_fused(fake_rank, ["query"], [documents], [1.0], top_k=5, head_size=3, skip_agreement=0.5)[0]
+    assert result == documents[:5]
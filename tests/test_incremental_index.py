@@ -0,0 +1,103 @@
+import json
+import hashlib
+
+import numpy as np
+import pytest
+
+import LLM_pipeline
+from LLM_pipeline import NLP_pipeline
+from src.benchmark_helper import make_synthetic_corpus, make_queries
+
+
+def fake_embedding(text:str, dim:int = 16) -> list:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).normal(size=dim).tolist()
+
+
+class FakeDocumentEmbedder():
+    # deterministic stand-in for SentenceTransformersDocumentEmbedder: the embedding only depends on the content
+    def __init__(self, model:str, **kwargs) -> None:
+        self.model = model
+
+    def warm_up(self) -> None:
+        pass
+
+    def run(self, documents):
+        for doc in documents:
+            doc.embedding = fake_embedding(doc.content)
+        return {"documents": documents}
+
+
+CONFIGS = {
+    "default": {},
+    "ivf": {"ann_index": "ivf", "ann_parameters": {"n_probe": 64}},
+    "bm25_index": {"bm25_index": True},
+    "compact_store": {"compact_store": True},
+    "passages": {"split_length": 2},
+}
+
+
+def write_json(path, songs:dict) -> str:
+    path.write_text(json.dumps(songs))
+    return str(path)
+
+
+def build(config:dict, json_path:str, cache_dir:str) -> NLP_pipeline:
+    pipeline = NLP_pipeline(**config)
+    pipeline.load_data(json_path)
+    pipeline.create_embeddings_with_retriever(cache_dir=cache_dir)
+    return pipeline
+
+
+def bm25_scores(pipeline:NLP_pipeline, query:str) -> dict:
+    # all documents, so ties at the cut-off cannot hide a difference
+    documents = pipeline.bm25_retriever.run(query=query, top_k=pipeline.document_store.count_documents())["documents"]
+    return {doc.id: pytest.approx(doc.score) for doc in documents}
+
+
+def embedding_scores(pipeline:NLP_pipeline, queries:list) -> list:
+    query_embeddings = np.asarray([fake_embedding(q) for q in queries], dtype=np.float32)
+    results = pipeline.retrieve_batch(query_embeddings, top_k=pipeline.document_store.count_documents())
+    return [{doc.id: pytest.approx(doc.score, rel=1e-5) for doc in documents} for documents in results]
+
+
+@pytest.mark.parametrize("name", list(CONFIGS))
+def test_incremental_updates_match_a_full_rebuild(name, tmp_path, monkeypatch):
+    monkeypatch.setattr(LLM_pipeline, "SentenceTransformersDocumentEmbedder", FakeDocumentEmbedder)
+    config = CONFIGS[name]
+    corpus = make_synthetic_corpus(60, words_per_song=40, vocabulary_size=300, seed=0)
+    new_lyrics = list(make_synthetic_corpus(10, words_per_song=40, vocabulary_size=300, seed=1).values())
+    titles = list(corpus)
+
+    # 50 songs, then: 5 added, 5 changed and one unchanged song upserted, 3 songs deleted
+    songs = {title: corpus[title] for title in titles[:50]}
+    incremental = build(config, write_json(tmp_path / "v1.json", songs), str(tmp_path / "incremental_cache"))
+    update = {title: corpus[title] for title in titles[50:55]}
+    update.update({title: lyrics for title, lyrics in zip(titles[:5], new_lyrics)})
+    update[titles[5]] = corpus[titles[5]]
+    report = incremental.upsert_songs(update)
+    assert (report["added"], report["changed"], report["unchanged"]) == (5, 5, 1)
+    songs.update(update)
+    assert incremental.delete_songs(titles[10:13]) > 0
+    for title in titles[10:13]:
+        del songs[title]
+
+    # a new json in several batches: 3 songs missing, 3 changed, 5 added
+    for title in titles[20:23]:
+        del songs[title]
+    songs.update({title: lyrics for title, lyrics in zip(titles[30:33], new_lyrics[5:])})
+    songs.update({title: corpus[title] for title in titles[55:]})
+    final_json = write_json(tmp_path / "v2.json", songs)
+    report = incremental.update_from_json(final_json, batch_size=7)
+    assert (report["added"], report["changed"], report["removed"]) == (5, 3, 3)
+
+    full = build(config, final_json, str(tmp_path / "full_cache"))
+
+    assert sorted(incremental.document_store.storage) == sorted(full.document_store.storage)
+    assert incremental.song_index == full.song_index
+    queries = make_queries(songs, n_queries=8)
+    for query in queries:
+        assert bm25_scores(incremental, query) == bm25_scores(full, query)
+    assert embedding_scores(incremental, queries) == embedding_scores(full, queries)
+    # the embedding cache only holds the indexed contents
+    assert len(incremental.embedding_cache) == full.document_store.count_documents()
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from src.preprocess_helper import clean_up_lyrics, clean_up_lyrics_batch, benchmark_clean_up
+
+LYRICS = [
+    "[Verse 1]\nI walk a lonely road\nThe only one that I have ever known\n[Chorus]",
+    "[Intro] [Verse 1: Billie Joe Armstrong]\nDo you know the enemy?\n[Bridge]\nDo you know your enemy?",
+    "Café naïve über 日本語 — “quotes”\nand émojis \U0001f3b8\U0001f3b8 here",
+    "Special chars: @#$%^&*()!? <tags> {braces} 'single' \"double\" back\\slash / - _ underscore",
+    "",
+    " ",
+    "\n\n\n",
+    "[only brackets]",
+    "...",
+    "dots . in . between . words, and, commas",
+    "  leading and trailing spaces \t\r\n with\ttabs\fand\vother whitespace  ",
+    "[unclosed bracket\nstays] open [ and ] nested [a [b] c]",
+    "line one\r\nline two\r\n[Outro]\r\n",
+    "àáâ",
+]
+
+
+def assert_same_as_rowwise(lyrics: pd.Series, **kwargs) -> None:
+    expected = lyrics.apply(clean_up_lyrics)
+    result = clean_up_lyrics_batch(lyrics, **kwargs)
+    assert list(result.index) == list(lyrics.index)
+    assert list(result) == list(expected)
+
+
+@pytest.mark.parametrize("lyrics", LYRICS)
+def test_batch_matches_rowwise_per_song(lyrics):
+    assert_same_as_rowwise(pd.Series([lyrics]))
+
+
+def test_batch_matches_rowwise_for_mixed_corpus():
+    # the songs are cleaned as one joined string, so neighbours must not leak into each other
+    lyrics = pd.Series(LYRICS * 3, index=range(100, 100 + 3 * len(LYRICS)))
+    assert_same_as_rowwise(lyrics)
+
+
+def test_empty_series():
+    result = clean_up_lyrics_batch(pd.Series([], dtype=object))
+    assert len(result) == 0
+
+
+def test_process_pool_matches_rowwise():
+    lyrics = pd.Series(LYRICS * 20)
+    assert_same_as_rowwise(lyrics, n_jobs=2, chunk_size=7)
+
+
+def test_benchmark_raises_on_mismatch(monkeypatch):
+    lyrics = pd.Series(LYRICS)
+    assert benchmark_clean_up(lyrics)["songs"] == len(LYRICS)
+    monkeypatch.setattr("src.preprocess_helper.clean_up_lyrics", lambda text: text)
+    with pytest.raises(ValueError):
+        benchmark_clean_up(lyrics)
@@ -0,0 +1,117 @@
+import sys
+import random
+import threading
+from types import SimpleNamespace
+
+from haystack import Document
+
+from src.query_cache import CachedBM25Retriever, CachedTextEmbedder, LRUCache, RetrievalCache, add_counts
+from src.versioned_store import VersionedInMemoryDocumentStore
+
+
+def run_threads(target, n_threads:int = 8) -> list:
+    # switches threads as often as possible, so races show up within a few thousand operations
+    errors = []
+
+    def run(seed):
+        try:
+            target(random.Random(seed))
+        except Exception as error:
+            errors.append(error)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    return errors
+
+
+def test_lru_cache_concurrent_access():
+    cache = LRUCache(max_size=8)
+
+    def work(rng):
+        for _ in range(5000):
+            key = rng.randrange(16)
+            if cache.get(key) is None:
+                cache.put(key, [key])
+
+    assert run_threads(work) == []
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 8 * 5000
+    assert stats["entries"] <= 8
+
+
+def test_retrieval_cache_concurrent_version_changes():
+    document_store = VersionedInMemoryDocumentStore()
+    cache = RetrievalCache(document_store, max_size=8)
+
+    def work(rng):
+        for i in range(3000):
+            if i % 100 == 0:
+                document_store.bump_version()
+            key = rng.randrange(16)
+            version = cache.current_version()
+            if cache.get(key) is None:
+                cache.put(key, [Document(content=str(key))], version)
+
+    assert run_threads(work) == []
+
+
+def test_retrieval_cache_skips_results_of_an_older_version():
+    document_store = VersionedInMemoryDocumentStore()
+    cache = RetrievalCache(document_store)
+    version = cache.current_version()
+    # the store changes while the documents are retrieved
+    document_store.bump_version()
+    cache.put("query", [Document(content="old")], version)
+    assert cache.get("query") is None
+    cache.put("query", [Document(content="new")], cache.current_version())
+    assert cache.get("query")[0].content == "new"
+
+
+def test_add_counts_concurrent():
+    stats = {}
+
+    def work(rng):
+        for _ in range(5000):
+            add_counts(stats, queries=1, pairs=2)
+
+    assert run_threads(work) == []
+    assert stats == {"queries": 8 * 5000, "pairs": 8 * 2 * 5000}
+
+
+class FakeModel(list):
+    # a sentence-transformers model: indexable modules and the tokenizer of the first one
+    def __init__(self, do_lower_case:bool) -> None:
+        super().__init__([SimpleNamespace(do_lower_case=False)])
+        self.tokenizer = SimpleNamespace(do_lower_case=do_lower_case)
+
+
+def test_embedding_keys_follow_the_tokenizer():
+    embedder = CachedTextEmbedder(model="uncased")
+    # not warmed up yet: the exact text
+    assert embedder.cache_key("Basket Case") == "Basket Case"
+    embedder.embedding_backend = SimpleNamespace(model=FakeModel(do_lower_case=True))
+    assert embedder.cache_key("Basket Case") == embedder.cache_key("basket case")
+    # whitespace is part of the key
+    assert embedder.cache_key("basket  case") != embedder.cache_key("basket case")
+
+    cased = CachedTextEmbedder(model="cased")
+    cased.embedding_backend = SimpleNamespace(model=FakeModel(do_lower_case=False))
+    assert cased.cache_key("Basket Case") != cased.cache_key("basket case")
+
+
+def test_bm25_keys_are_the_query_tokens():
+    document_store = VersionedInMemoryDocumentStore()
+    document_store.write_documents([Document(content="basket case"), Document(content="welcome to paradise")])
+    retriever = CachedBM25Retriever(document_store)
+    first = retriever.run(query="Basket  Case!")["documents"]
+    second = retriever.run(query="basket case")["documents"]
+    assert [doc.id for doc in first] == [doc.id for doc in second]
+    assert retriever.cache.stats()["hits"] == 1
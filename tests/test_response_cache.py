@@ -0,0 +1,111 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import src.response_cache as response_cache
+from src.response_cache import ResponseCache
+
+DETERMINISTIC = {"temperature": 0}
+
+
+class FakeEmbedder():
+    # prompt -> 2d unit vector at the given cosine similarity to "base", unknown prompts are orthogonal
+    def __init__(self, similarities:dict) -> None:
+        self.similarities = similarities
+
+    def run(self, text:str):
+        if text == "base":
+            return {"embedding": [1.0, 0.0]}
+        similarity = self.similarities.get(text, 0.0)
+        return {"embedding": [similarity, math.sqrt(1 - similarity ** 2)]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # time.time of the cache, tests move it forward
+    now = [1000.0]
+    monkeypatch.setattr(response_cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def reply(text:str) -> dict:
+    return {"replies": [text], "meta": [{"usage": {"total_tokens": 3}}]}
+
+
+def test_exact_tier(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    cache.store("model", None, DETERMINISTIC, "prompt", reply("cached"))
+    assert cache.lookup("model", None, DETERMINISTIC, "prompt") == reply("cached")
+    # the model, system prompt and generation kwargs are part of the key
+    assert cache.lookup("other model", None, DETERMINISTIC, "prompt") is None
+    assert cache.lookup("model", "a system prompt", DETERMINISTIC, "prompt") is None
+    assert cache.lookup("model", None, {"temperature": 0, "max_tokens": 10}, "prompt") is None
+    assert cache.lookup("model", None, DETERMINISTIC, "prompt ") is None
+    assert (cache.metrics["exact_hits"], cache.metrics["misses"]) == (1, 4)
+
+    # the entries are persisted
+    cache.close()
+    assert ResponseCache(str(tmp_path / "cache.sqlite")).lookup("model", None, DETERMINISTIC, "prompt") == reply("cached")
+
+
+def test_semantic_tier_threshold(tmp_path):
+    embedder = FakeEmbedder({"close": 0.96, "just above": 0.951, "just below": 0.949})
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), embedder=embedder)
+    assert cache.similarity_threshold == 0.95
+    cache.store("model", None, DETERMINISTIC, "base", reply("base reply"))
+
+    assert cache.lookup("model", None, DETERMINISTIC, "close") == reply("base reply")
+    assert cache.lookup("model", None, DETERMINISTIC, "just above") == reply("base reply")
+    assert cache.lookup("model", None, DETERMINISTIC, "just below") is None
+    # similar prompts of another scope do not share the reply
+    assert cache.lookup("other model", None, DETERMINISTIC, "close") is None
+    assert (cache.metrics["semantic_hits"], cache.metrics["misses"]) == (2, 2)
+
+
+def test_ttl_expiry(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path, ttl=60)
+    cache.store("model", None, DETERMINISTIC, "old", reply("old"))
+    clock[0] += 30
+    cache.store("model", None, DETERMINISTIC, "new", reply("new"))
+    assert cache.lookup("model", None, DETERMINISTIC, "old") == reply("old")
+
+    # the age counts from the store, a hit does not extend it
+    clock[0] += 31
+    assert cache.lookup("model", None, DETERMINISTIC, "old") is None
+    assert cache.lookup("model", None, DETERMINISTIC, "new") == reply("new")
+    assert cache.metrics["evictions"] == 1
+
+    # a new cache removes the expired entries when it opens
+    clock[0] += 30
+    reopened = ResponseCache(path, ttl=60)
+    assert reopened.stats()["entries"] == 0 and reopened.metrics["evictions"] == 1
+
+
+def test_lru_eviction(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=2, ttl=None)
+    for prompt in ("a", "b"):
+        cache.store("model", None, DETERMINISTIC, prompt, reply(prompt))
+        clock[0] += 1
+    # a is used again, so b is the least recently used entry
+    assert cache.lookup("model", None, DETERMINISTIC, "a") == reply("a")
+    clock[0] += 1
+    cache.store("model", None, DETERMINISTIC, "c", reply("c"))
+    assert cache.lookup("model", None, DETERMINISTIC, "b") is None
+    assert cache.lookup("model", None, DETERMINISTIC, "a") == reply("a")
+    assert cache.lookup("model", None, DETERMINISTIC, "c") == reply("c")
+    assert cache.stats()["entries"] == 2 and cache.metrics["evictions"] == 1
+
+
+def test_only_temperature_zero_is_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    for generation_kwargs in ({"temperature": 0.7}, {}):
+        cache.store("model", None, generation_kwargs, "prompt", reply("sampled"))
+        assert cache.lookup("model", None, generation_kwargs, "prompt") is None
+    assert cache.stats()["entries"] == 0
+    assert cache.metrics["skipped"] == 2 and cache.metrics["misses"] == 0
+
+    sampled = ResponseCache(str(tmp_path / "sampled.sqlite"), cache_sampled=True)
+    sampled.store("model", None, {"temperature": 0.7}, "prompt", reply("sampled"))
+    assert sampled.lookup("model", None, {"temperature": 0.7}, "prompt") == reply("sampled")
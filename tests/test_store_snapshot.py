@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+from haystack import Document
+from haystack.document_stores.types import DuplicatePolicy
+
+from src.benchmark_helper import make_synthetic_corpus, make_queries
+from src.compact_store import CompactDocumentStore
+from src.store_snapshot import save_document_store, load_document_store
+from src.versioned_store import VersionedInMemoryDocumentStore
+
+
+def documents(n_songs:int = 60, dim:int = 8) -> list:
+    rng = np.random.default_rng(0)
+    corpus = make_synthetic_corpus(n_songs, words_per_song=40, vocabulary_size=200)
+    docs = [Document(content=lyrics, meta={"title": title, "song_id": i}, embedding=rng.normal(size=dim).tolist())
+            for i, (title, lyrics) in enumerate(corpus.items())]
+    # a document without embedding, one without content and one that does not fit the compact layout
+    docs.append(Document(content="no embedding here", meta={"title": "plain"}))
+    docs.append(Document(meta={"title": "empty"}, embedding=rng.normal(size=dim).tolist()))
+    docs.append(Document(content="with a table", dataframe=pd.DataFrame({"a": [1]}), embedding=rng.normal(size=dim).tolist()))
+    return docs
+
+
+@pytest.fixture(params=["versioned", "compact", "compact_float16"])
+def document_store(request):
+    if request.param == "versioned":
+        store = VersionedInMemoryDocumentStore(embedding_similarity_function="cosine")
+    else:
+        store = CompactDocumentStore(embedding_similarity_function="cosine",
+                                     embedding_dtype="float16" if request.param == "compact_float16" else "float32")
+    docs = documents()
+    store.write_documents(docs)
+    # deleted rows stay in the buffers of a compact store until it is compacted
+    store.delete_documents([doc.id for doc in docs[5:10]])
+    return store
+
+
+def test_round_trip(document_store, tmp_path):
+    save_document_store(document_store, str(tmp_path))
+    embedding_dtype = getattr(document_store, "embedding_dtype", "float32")
+    restored = load_document_store(str(tmp_path), embedding_dtype=embedding_dtype)
+
+    assert isinstance(restored, CompactDocumentStore)
+    assert sorted(restored.storage) == sorted(document_store.storage)
+    for doc_id in document_store.storage:
+        original, loaded = document_store.storage[doc_id], restored.storage[doc_id]
+        assert (loaded.content, loaded.meta) == (original.content, original.meta)
+        if original.embedding is None:
+            assert loaded.embedding is None
+        else:
+            np.testing.assert_allclose(loaded.embedding, original.embedding, rtol=1e-2 if embedding_dtype == "float16" else 1e-6)
+
+    for query in make_queries(make_synthetic_corpus(60, words_per_song=40, vocabulary_size=200), n_queries=5):
+        expected = document_store.bm25_retrieval(query, top_k=10)
+        result = restored.bm25_retrieval(query, top_k=10)
+        assert [(doc.id, doc.score) for doc in result] == [(doc.id, doc.score) for doc in expected]
+    query_embedding = np.random.default_rng(1).normal(size=8).tolist()
+    expected = document_store.embedding_retrieval(query_embedding, top_k=10)
+    result = restored.embedding_retrieval(query_embedding, top_k=10)
+    assert [doc.id for doc in result] == [doc.id for doc in expected]
+
+
+def test_embeddings_stay_memory_mapped(tmp_path):
+    store = CompactDocumentStore()
+    store.write_documents(documents())
+    save_document_store(store, str(tmp_path))
+    restored = load_document_store(str(tmp_path))
+    assert isinstance(restored.storage._matrix, np.memmap)
+
+    # writes go to memory, the snapshot file stays as it is
+    before = (tmp_path / "embeddings.npy").read_bytes()
+    doc = restored.storage[restored.storage._ids[0]]
+    restored.write_documents([Document(id=doc.id, content=doc.content, meta=doc.meta, embedding=[0.5] * 8)], policy=DuplicatePolicy.OVERWRITE)
+    restored.write_documents([Document(content="a new song", embedding=[1.0] * 8)])
+    assert (tmp_path / "embeddings.npy").read_bytes() == before
+    assert restored.storage.embedding(doc.id).tolist() == [0.5] * 8
+
+
+def test_mmap_off_and_dtype_conversion(tmp_path):
+    store = CompactDocumentStore()
+    store.write_documents(documents())
+    save_document_store(store, str(tmp_path))
+    restored = load_document_store(str(tmp_path), mmap=False, embedding_dtype="float16")
+    assert restored.storage._matrix.dtype == np.float16
+    assert not isinstance(restored.storage._matrix, np.memmap)
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from haystack import Document
+
+from LLM_pipeline import NLP_pipeline
+from src.local_stubs import start_groq_stub
+from src.tracing import Tracer
+
+
+class FakeEncoder(list):
+    # the sentence-transformers model of the text embedder: a module list and encode
+    def __init__(self) -> None:
+        super().__init__([SimpleNamespace(do_lower_case=False)])
+
+    def encode(self, texts, **kwargs):
+        return np.asarray([[len(text), 1.0, 0.5] for text in texts], dtype=np.float32)
+
+
+@pytest.fixture
+def pipeline():
+    server, url = start_groq_stub(reply="a stub reply")
+    pipeline = NLP_pipeline()
+    pipeline.document_store.write_documents([Document(content=f"song {i}", embedding=[float(i), 1.0, 0.5]) for i in range(5)])
+    pipeline.create_retrievers()
+    pipeline.create_text_embedder()
+    pipeline.text_embedder.embedding_backend = SimpleNamespace(model=FakeEncoder())
+    pipeline.create_prompt_builder()
+    pipeline.create_llm_generator(api_base_url=url)
+    pipeline.enable_tracing()
+    yield pipeline
+    pipeline.llm_generator.close()
+    if getattr(pipeline, "scheduler", None) is not None:
+        pipeline.scheduler.close()
+    server.shutdown()
+    server.server_close()
+
+
+def spans_by_name(tracer:Tracer) -> dict:
+    spans = {}
+    for span in tracer.spans:
+        spans.setdefault(span["name"], []).append(span)
+    return spans
+
+
+def test_batch_mode_has_stage_and_generator_spans(pipeline):
+    pipeline.run_rag_batch(["first query", "second query"], top_k=2)
+    spans = spans_by_name(pipeline.tracer)
+    run = spans["run_rag_batch"][0]
+    assert run["parent_span_id"] is None
+    assert run["attributes"]["batch_size"] == 2
+    for name in ("embedder", "retriever", "generator.batch"):
+        assert spans[name][0]["parent_span_id"] == run["span_id"]
+    # the requests run in the event loop of the generator, they are still part of the trace of the batch
+    batch = spans["generator.batch"][0]
+    requests = spans["generator.request"]
+    assert len(requests) == 2
+    assert all(span["parent_span_id"] == batch["span_id"] and span["trace_id"] == run["trace_id"] for span in requests)
+    assert all(span["attributes"]["tokens.total_tokens"] > 0 for span in requests)
+
+
+def test_scheduled_mode_has_micro_batch_spans(pipeline):
+    pipeline.create_scheduler(max_wait_ms=1.0)
+    pipeline.run_rag_scheduled(["first query", "second query"], top_k=2)
+    spans = spans_by_name(pipeline.tracer)
+    run = spans["run_rag_scheduled"][0]
+    assert spans["embedder"][0]["parent_span_id"] == run["span_id"]
+    # a micro-batch serves several requests, it is a trace of its own
+    micro_batches = spans["scheduler.embedder"]
+    assert sum(span["attributes"]["batch_size"] for span in micro_batches) == 2
+    assert all(span["parent_span_id"] is None for span in micro_batches)
+
+
+def test_concurrent_async_requests_have_their_own_parents(pipeline):
+    tracer, generator = pipeline.tracer, pipeline.llm_generator
+
+    async def request(name:str):
+        with tracer.span(name):
+            return await generator.run_async(f"prompt of {name}")
+
+    async def main():
+        return await asyncio.gather(request("caller 1"), request("caller 2"))
+
+    asyncio.run(main())
+    spans = spans_by_name(tracer)
+    for name in ("caller 1", "caller 2"):
+        caller = spans[name][0]
+        assert [span for span in spans["generator.request"] if span["parent_span_id"] == caller["span_id"]]